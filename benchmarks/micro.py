@@ -0,0 +1,345 @@
+"""Microbenchmarks for the per-request hot paths of the server.
+
+Run from the repository root:
+
+    python -m benchmarks.micro [--only history,broadcast] [--quick]
+    python -m benchmarks.micro --save-baseline      # write benchmarks/baselines/micro.json
+    python -m benchmarks.micro --compare [--threshold 0.25]
+
+Every run works in a scratch directory with a freshly seeded database
+(`--storage sqlite|memory`), so results do not depend on local data. Each
+benchmark is repeated; the median and the best time per operation are
+reported. `--compare` checks the best times (the least noisy figure on a
+shared machine) against the stored baseline and exits with
+status 1 if any benchmark got slower by more than the threshold. Baselines
+are only meaningful on the machine that recorded them; re-record after
+changing hardware.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE_PATH = ROOT / "benchmarks" / "baselines" / "micro.json"
+SENDERS = 50
+HISTORY_SIZES = (10_000, 100_000)
+FANOUT_SIZES = (10, 100, 1000)
+REPEAT = 5
+
+class FakeSocket:
+    """Stands in for a WebSocket in ConnectionManager; sending costs nothing."""
+
+    async def send_text(self, text: str):
+        pass
+
+    async def send_bytes(self, data: bytes):
+        pass
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def message_content(i: int) -> str:
+    if i % 10 == 0:
+        return "photo.jpg"
+    return f"Seeded message number {i} with a bit of text to shape"
+
+def message_attachment(i: int) -> dict | None:
+    if i % 10 == 0:
+        return {"file_url": f"/static/uploads/{i:08d}_photo.jpg", "file_name": "photo.jpg",
+                "file_type": "image", "file_size": 71865}
+    return None
+
+class Bench:
+    def __init__(self, name: str, fn, number: int, is_async: bool = True):
+        self.name = name
+        self.fn = fn
+        self.number = number
+        self.is_async = is_async
+
+async def measure(bench: Bench, repeat: int) -> dict:
+    """Median and best time per call over `repeat` samples of `bench.number` calls."""
+    samples = []
+    for i in range(repeat + 1):  # The first sample is a warm-up
+        start = time.perf_counter()
+        for _ in range(bench.number):
+            if bench.is_async:
+                await bench.fn()
+            else:
+                bench.fn()
+        elapsed = time.perf_counter() - start
+        if i:
+            samples.append(elapsed / bench.number * 1e6)
+    return {"median_us": statistics.median(samples), "min_us": min(samples), "calls": bench.number * repeat}
+
+async def seed(storage_backend: str, quick: bool) -> dict:
+    from server import storage
+    from server.routes.auth import create_access_token, hash_password_with_salt
+
+    repos = storage.repos
+    password = hash_password_with_salt("benchmark")
+    user_ids = [await repos.users.create(f"bench{i}", password, "", "cp", b"salt", "v") for i in range(SENDERS)]
+
+    chats = {}
+    for size in HISTORY_SIZES:
+        size = size // 10 if quick else size
+        chat_id = await repos.chats.create_group(f"history {size}", user_ids[0], user_ids)
+        await seed_messages(storage_backend, chat_id, user_ids, size)
+        chats[size] = chat_id
+
+    # Fresh messages from another user for the read-receipt benchmark
+    reader, author = user_ids[0], user_ids[1]
+    receipts_chat = await repos.chats.create_group("receipts", reader, [reader, author])
+    unread = [await repos.messages.insert(receipts_chat, author, "bench1", f"unread {i}") for i in range(5000)]
+    return {
+        "user_id": reader,
+        "token": create_access_token(reader),
+        "password": password,
+        "history_chats": chats,
+        "receipts_chat": receipts_chat,
+        "unread": unread,
+    }
+
+async def seed_messages(storage_backend: str, chat_id: int, user_ids: list[int], count: int):
+    from server import storage
+
+    rng = random.Random(chat_id)
+    if storage_backend == "memory":
+        for i in range(count):
+            sender = user_ids[i % len(user_ids)]
+            await storage.repos.messages.insert(chat_id, sender, f"bench{i % len(user_ids)}", message_content(i),
+                                                attachment=message_attachment(i))
+        return
+
+    # Bulk insert straight into the shard; going through the writer thread
+    # one message at a time would make seeding the slowest part of the run.
+    from server import shards
+    conn = shards.get_shard_connection(chat_id)
+    try:
+        rows = []
+        for i in range(count):
+            sender = i % len(user_ids)
+            reactions = [{"user_id": user_ids[(sender + 1) % len(user_ids)], "reaction": "👍"}] if rng.random() < 0.2 else []
+            read_by = [{"user_id": user_ids[(sender + 2) % len(user_ids)], "read_at": "2025-01-01T00:00:00"}] if rng.random() < 0.5 else []
+            attachment = message_attachment(i) or {}
+            rows.append((chat_id, user_ids[sender], f"bench{sender}", message_content(i),
+                         json.dumps(reactions), json.dumps(read_by), "file" if attachment else "message",
+                         attachment.get("file_url"), attachment.get("file_name"), attachment.get("file_type"),
+                         attachment.get("file_size")))
+        conn.executemany("""
+            INSERT INTO messages (chat_id, sender_id, sender_name, content, timestamp, reactions, read_by,
+                                  type, file_url, file_name, file_type, file_size)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+async def build_benches(ctx: dict, quick: bool) -> list[Bench]:
+    from server import metrics, storage
+    from server.routes import auth
+    from server.routes.messages import get_message_history, shape_message
+    from server.websocket import ConnectionManager
+    from server.wire import JSON
+
+    from fastapi import Request, Response
+
+    benches = []
+    user = {"id": ctx["user_id"], "username": "bench0", "avatar_url": None, "bio": ""}
+
+    def request(if_none_match: str | None = None) -> Request:
+        headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+        return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+    for size, chat_id in ctx["history_chats"].items():
+        # The whole route: membership check, query, avatar lookup and shaping
+        benches.append(Bench(
+            f"history_route_{size}",
+            lambda chat_id=chat_id: get_message_history(chat_id, request(), Response(), None, None, current_user=user),
+            number=1
+        ))
+        # The first page of an active chat, answered by the history cache after the warm-up call
+        benches.append(Bench(
+            f"history_page_cached_{size}",
+            lambda chat_id=chat_id: get_message_history(chat_id, request(), Response(), None, 50, current_user=user),
+            number=100
+        ))
+        # An unchanged poll: membership check, version lookup and a 304
+        response = Response()
+        await get_message_history(chat_id, request(), response, None, 50, current_user=user)
+        benches.append(Bench(
+            f"history_not_modified_{size}",
+            lambda chat_id=chat_id, tag=response.headers["etag"]: get_message_history(
+                chat_id, request(tag), Response(), None, 50, current_user=user),
+            number=100
+        ))
+        # Row shaping alone, on rows fetched once up front
+        rows = await storage.repos.messages.history(chat_id)
+        avatars = await storage.repos.users.avatars(list({row["sender_id"] for row in rows}))
+        benches.append(Bench(
+            f"history_shape_{size}",
+            lambda rows=rows, avatars=avatars: [shape_message(row, avatars.get(row["sender_id"])) for row in rows],
+            number=1, is_async=False
+        ))
+
+    for fanout in FANOUT_SIZES:
+        manager = ConnectionManager()
+        for _ in range(fanout):
+            socket = FakeSocket()
+            manager.encodings[socket] = JSON
+            manager.active_chats.setdefault(1, []).append(socket)
+        event = {"type": "message", "username": "bench0", "avatar_url": "/static/avatars/default.jpg",
+                 "is_deleted": False, "data": {"chat_id": 1, "content": "Hello there", "message_id": 1, "reply_to": None},
+                 "timestamp": "2025-01-01T00:00:00"}
+        benches.append(Bench(f"broadcast_fanout_{fanout}", lambda manager=manager, event=event: manager.broadcast(1, event),
+                             number=max(1, 20000 // fanout)))
+
+    token = ctx["token"]
+    benches.append(Bench("verify_token", lambda: auth.verify_token(token), number=2000))
+    benches.append(Bench("get_current_user", lambda: auth.get_current_user(token), number=2000))
+
+    password = ctx["password"]
+    hashes = 3 if quick else 10
+    benches.append(Bench("hash_password_with_salt", lambda: auth.hash_password_with_salt("benchmark"),
+                         number=hashes, is_async=False))
+    benches.append(Bench("verify_password", lambda: auth.verify_password(password, "benchmark"),
+                         number=hashes, is_async=False))
+
+    chat_id = ctx["history_chats"][min(ctx["history_chats"])]
+    message_id = (await storage.repos.messages.history(chat_id, limit=1))[0]["id"]
+
+    async def toggle_reaction():
+        await storage.repos.messages.add_reaction(chat_id, message_id, ctx["user_id"], "🔥")
+        await storage.repos.messages.remove_reaction(chat_id, message_id, ctx["user_id"], "🔥")
+    benches.append(Bench("reaction_add_remove", toggle_reaction, number=500))
+
+    # Instrumentation overhead: one histogram update, and the whole middleware
+    # around an app that answers immediately
+    benches.append(Bench("metrics_observe", lambda: metrics.HTTP_REQUEST_DURATION.observe(0.003, "GET", "/bench", "200"),
+                         number=20000, is_async=False))
+
+    async def empty_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def discard(message):
+        pass
+
+    middleware = metrics.MetricsMiddleware(empty_app)
+    scope = {"type": "http", "method": "GET", "path": "/bench"}
+    benches.append(Bench("metrics_middleware", lambda: middleware(scope, None, discard), number=20000))
+
+    # Every call marks a different unread message, so the receipt is always new
+    unread = iter(ctx["unread"])
+    receipts_chat = ctx["receipts_chat"]
+    benches.append(Bench(
+        "read_receipt",
+        lambda: storage.repos.messages.mark_read(receipts_chat, next(unread), ctx["user_id"]),
+        number=len(ctx["unread"]) // (REPEAT + 1)
+    ))
+    return benches
+
+async def run(args) -> dict:
+    if args.storage == "sqlite":
+        from server import migrations
+        migrations.migrate()
+    ctx = await seed(args.storage, args.quick)
+    benches = await build_benches(ctx, args.quick)
+    if args.only:
+        prefixes = tuple(args.only.split(","))
+        benches = [bench for bench in benches if bench.name.startswith(prefixes)]
+    results = {}
+    for bench in benches:
+        results[bench.name] = await measure(bench, REPEAT)
+        print(f"{bench.name:<28} median {results[bench.name]['median_us']:>12.1f} us   best {results[bench.name]['min_us']:>12.1f} us",
+              file=sys.stderr)
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Print current vs baseline best times and return the regressed benchmark names."""
+    regressions = []
+    print(f"{'benchmark':<28} {'baseline us':>14} {'current us':>14} {'change':>8}")
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<28} {'-':>14} {result['min_us']:>14.1f} {'new':>8}")
+            continue
+        change = result["min_us"] / base["min_us"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<28} {base['min_us']:>14.1f} {result['min_us']:>14.1f} {change:>+8.1%}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--storage", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--only", help="comma-separated benchmark name prefixes")
+    parser.add_argument("--quick", action="store_true", help="10x smaller histories and fewer password hashes")
+    parser.add_argument("--save-baseline", action="store_true", help=f"write results to {BASELINE_PATH.relative_to(ROOT)}")
+    parser.add_argument("--compare", action="store_true", help="compare with the stored baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown before flagging, 0.25 = 25%%")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        if not args.baseline.exists():
+            parser.error(f"No baseline at {args.baseline}, record one with --save-baseline")
+        baseline = json.loads(args.baseline.read_text())
+
+    # The server uses paths relative to the working directory, so it is
+    # imported only after moving into a scratch directory.
+    sys.path.insert(0, str(ROOT))
+    workdir = tempfile.TemporaryDirectory(prefix="micro_")
+    os.chdir(workdir.name)
+    Path("server").mkdir()
+    Path("static").mkdir()
+    os.environ["MESSENGER_STORAGE"] = args.storage
+    os.environ["MESSENGER_ARCHIVE_DIR"] = str(Path(workdir.name) / "archive")
+    logging.disable(logging.CRITICAL)  # Keep log output out of the timings and the report
+
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        os.chdir(ROOT)
+        workdir.cleanup()
+
+    report = {
+        "commit": current_commit(),
+        "storage": args.storage,
+        "quick": args.quick,
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()} {platform.processor() or ''}".strip(),
+        "results": results,
+    }
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    if baseline is not None:
+        if (baseline.get("storage"), baseline.get("quick")) != (args.storage, args.quick):
+            print("Warning: baseline was recorded with different --storage/--quick settings", file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
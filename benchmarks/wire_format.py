@@ -0,0 +1,102 @@
+"""Compare WebSocket wire formats: bytes and encode time per event.
+
+Run from the repository root:
+
+    python -m benchmarks.wire_format [--events 20000] [--recipients 200]
+
+"deflate" rows emulate permessage-deflate with context takeover (one raw
+deflate stream per connection, flushed after every frame), which is what
+uvicorn negotiates with browsers when `--ws-per-message-deflate` is on.
+"""
+import argparse
+import json
+import time
+import zlib
+from datetime import datetime
+
+from server.wire import MSGPACK, encode, supported_encodings
+
+def sample_events(count: int) -> list[dict]:
+    events = []
+    for i in range(count):
+        kind = i % 4
+        base = {
+            "username": f"user{i % 50}",
+            "avatar_url": f"/static/avatars/user{i % 50}/avatar.jpg",
+            "timestamp": datetime.utcnow().isoformat(),
+        }
+        if kind == 0:
+            events.append({**base, "type": "message", "is_deleted": False, "data": {
+                "chat_id": 42, "content": f"Hello there, this is message number {i}",
+                "message_id": 100000 + i, "reply_to": None}})
+        elif kind == 1:
+            events.append({**base, "type": "file", "is_deleted": False, "data": {
+                "chat_id": 42, "file_url": f"/static/uploads/3f1c2d9e-{i:08d}_photo.jpg",
+                "file_name": "photo.jpg", "file_type": "image", "file_size": 71865,
+                "message_id": 100000 + i, "reply_to": None}})
+        elif kind == 2:
+            events.append({"type": "reaction_add", "message_id": 100000 + i, "user_id": i % 50,
+                           "reaction": "👍", "timestamp": base["timestamp"]})
+        else:
+            events.append({"type": "is_read", "message_id": 100000 + i, "user_id": i % 50,
+                           "username": base["username"], "timestamp": base["timestamp"]})
+    return events
+
+def legacy_encode(message: dict) -> str:
+    # What ConnectionManager.broadcast did before: json.dumps once per recipient
+    return json.dumps(message)
+
+def run(events: list[dict], recipients: int) -> list[dict]:
+    formats = [("json-legacy", legacy_encode, True)]
+    for encoding in supported_encodings():
+        formats.append((encoding, lambda m, e=encoding: encode(m, e), False))
+
+    results = []
+    for name, encoder, per_recipient in formats:
+        start = time.perf_counter()
+        frames = [encoder(event) for event in events]
+        encode_s = time.perf_counter() - start
+        raw_bytes = sum(len(f.encode() if isinstance(f, str) else f) for f in frames)
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        start = time.perf_counter()
+        deflated_bytes = 0
+        for frame in frames:
+            payload = frame.encode() if isinstance(frame, str) else frame
+            deflated_bytes += len(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+        deflate_s = time.perf_counter() - start
+
+        encodes_per_event = recipients if per_recipient else 1
+        results.append({
+            "format": name,
+            "bytes_per_event": raw_bytes / len(events),
+            "deflate_bytes_per_event": deflated_bytes / len(events),
+            "encode_us_per_event": encode_s / len(events) * 1e6,
+            "deflate_us_per_event": deflate_s / len(events) * 1e6,
+            "broadcast_encode_us": encode_s / len(events) * 1e6 * encodes_per_event,
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--recipients", type=int, default=200,
+                        help="group size used for the per-broadcast encode cost column")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = run(sample_events(args.events), args.recipients)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    if MSGPACK not in supported_encodings():
+        print("msgpack is not installed, only JSON formats are measured\n")
+    print(f"{'format':<12} {'bytes':>8} {'deflated':>9} {'encode us':>10} {'deflate us':>11} "
+          f"{'us/broadcast(' + str(args.recipients) + ')':>20}")
+    for r in results:
+        print(f"{r['format']:<12} {r['bytes_per_event']:>8.1f} {r['deflate_bytes_per_event']:>9.1f} "
+              f"{r['encode_us_per_event']:>10.2f} {r['deflate_us_per_event']:>11.2f} "
+              f"{r['broadcast_encode_us']:>20.2f}")
+
+if __name__ == "__main__":
+    main()
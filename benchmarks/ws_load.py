@@ -0,0 +1,392 @@
+"""Load-test the WebSocket server: throughput and send-to-receive latency.
+
+Run from the repository root:
+
+    python -m benchmarks.ws_load [--users 1000] [--chats 500] [--members 10]
+                                 [--rate 500] [--duration 30] [--mix send=8,react=1,read=1]
+                                 [--output results.json]
+
+Without `--url` a local uvicorn instance of `server.main:app` is started in a
+scratch directory (fresh database, `--storage sqlite|memory`) and stopped at
+the end. Synthetic users are registered through `/auth/register`, which needs
+the `ssss` tools installed like for a normal registration. Chats and groups
+are created through the existing routes, then every member of every chat opens
+`/ws/chat/{chat_id}`, so `--chats 500 --members 10` means 5,000 sockets (raise
+`ulimit -n` accordingly).
+
+Latency is measured from the moment a frame is sent to the moment each member
+of the chat (the sender included) receives the matching broadcast. Results are
+printed as JSON, tagged with the current commit, so runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import websockets
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ROOT = Path(__file__).resolve().parent.parent
+OPS = ("send", "react", "read")
+
+def percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {name!r}, expected one of {', '.join(OPS)}")
+        mix[name] = float(weight)
+    return mix
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class LocalServer:
+    """uvicorn running server.main:app in a scratch working directory."""
+
+    def __init__(self, storage: str, extra_env: dict | None = None):
+        self.storage = storage
+        self.extra_env = extra_env or {}
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = None
+        self.workdir = None
+
+    def __enter__(self):
+        self.workdir = tempfile.TemporaryDirectory(prefix="ws_load_")
+        work = Path(self.workdir.name)
+        (work / "static").mkdir()
+        (work / "server").mkdir()
+        env = {**os.environ, **self.extra_env, "PYTHONPATH": str(ROOT), "MESSENGER_STORAGE": self.storage}
+        self.log = open(work / "server.log", "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server.main:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--ws", "websockets", "--ws-per-message-deflate", "true", "--log-level", "warning"],
+            cwd=work, env=env, stdout=self.log, stderr=subprocess.STDOUT
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited, see {work / 'server.log'}")
+            try:
+                urllib.request.urlopen(self.url + "/", timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("Server did not start within 30 seconds")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+        self.workdir.cleanup()
+
+def http_json(method: str, url: str, body: dict | None = None, token: str | None = None) -> dict:
+    request = urllib.request.Request(url, method=method, data=json.dumps(body).encode() if body is not None else None)
+    request.add_header("Content-Type", "application/json")
+    if token:
+        request.add_header("Authorization", f"Bearer {token}")
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return json.loads(response.read())
+
+async def http_many(calls, concurrency: int) -> list:
+    """Run blocking HTTP calls in threads, at most `concurrency` at a time."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(call):
+        async with semaphore:
+            return await asyncio.to_thread(*call)
+    return await asyncio.gather(*(run(call) for call in calls))
+
+class Stats:
+    def __init__(self):
+        self.sent = {op: 0 for op in OPS}
+        self.expected = {op: 0 for op in OPS}
+        self.latencies = {op: [] for op in OPS}
+        self.errors = {}
+        self.pending = {}  # { key: (op, sent_at) }
+
+    def error(self, message: str):
+        self.errors[message] = self.errors.get(message, 0) + 1
+
+class Client:
+    """One socket of one user in one chat."""
+
+    def __init__(self, user: dict, chat: dict, encoding: str):
+        self.user = user
+        self.chat = chat
+        self.encoding = encoding
+        self.ws = None
+
+    async def connect(self, ws_url: str):
+        query = f"token={self.user['token']}"
+        subprotocols = None
+        if self.encoding == "msgpack":
+            subprotocols = ["msgpack"]
+        self.ws = await websockets.connect(f"{ws_url}/ws/chat/{self.chat['id']}?{query}", subprotocols=subprotocols,
+                                           max_size=None, open_timeout=60, ping_interval=None)
+
+    async def send(self, frame: dict):
+        if self.encoding == "msgpack":
+            await self.ws.send(msgpack.packb(frame, use_bin_type=True))
+        else:
+            await self.ws.send(json.dumps(frame))
+
+    async def listen(self, stats: Stats):
+        try:
+            async for raw in self.ws:
+                received_at = time.perf_counter()
+                event = msgpack.unpackb(raw, raw=False) if isinstance(raw, bytes) else json.loads(raw)
+                key = None
+                kind = event.get("type")
+                if kind == "message":
+                    data = event["data"]
+                    if data.get("content", "").startswith("lt:"):
+                        key = ("send", data["content"])
+                        if self.user["id"] == self.chat["owner_of"].get(data["content"]):
+                            # Only the sender's socket records the id, once
+                            self.chat["messages"].append((data["message_id"], self.user["id"]))
+                elif kind == "reaction_add":
+                    key = ("react", event["reaction"])
+                elif kind == "is_read":
+                    key = ("read", event["message_id"], event["user_id"])
+                elif kind == "error":
+                    stats.error(event.get("message", "error"))
+                if key is not None and key in stats.pending:
+                    op, sent_at = stats.pending[key]
+                    stats.latencies[op].append((received_at - sent_at) * 1000)
+        except websockets.ConnectionClosed:
+            pass
+
+async def setup(args, base_url: str) -> tuple[list[dict], dict]:
+    rng = random.Random(args.seed)
+    run_id = f"{int(time.time())}{rng.randrange(1000):03d}"
+
+    started = time.perf_counter()
+    names = [f"lt{run_id}_{i}" for i in range(args.users)]
+    tokens = await http_many(
+        [(http_json, "POST", base_url + "/auth/register", {"username": name, "password": "load-test"}) for name in names],
+        args.http_concurrency
+    )
+    profiles = await http_many(
+        [(http_json, "GET", base_url + "/auth/me", None, response["access_token"]) for response in tokens],
+        args.http_concurrency
+    )
+    users = [
+        {"id": me["id"], "username": name, "token": response["access_token"]}
+        for name, response, me in zip(names, tokens, profiles)
+    ]
+    register_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    members = min(args.members, args.users)
+    pairs = set()
+    calls = []
+    memberships = []
+    for i in range(args.chats):
+        chosen = rng.sample(users, members)
+        pair = tuple(sorted(user["id"] for user in chosen[:2]))
+        # Only one one-on-one chat may exist per pair, repeats become groups
+        if pair not in pairs and (members == 2 or rng.random() < args.direct_ratio):
+            chosen = chosen[:2]
+            pairs.add(pair)
+            calls.append((http_json, "POST", base_url + "/chats/create",
+                          {"user1": chosen[0]["username"], "user2": chosen[1]["username"]}, chosen[0]["token"]))
+        else:
+            calls.append((http_json, "POST", base_url + "/groups/create",
+                          {"name": f"load {i}", "participants": [user["username"] for user in chosen[1:]]},
+                          chosen[0]["token"]))
+        memberships.append(chosen)
+    responses = await http_many(calls, args.http_concurrency)
+    chats = [
+        {"id": response["chat_id"], "members": chosen, "messages": [], "owner_of": {}, "read": set()}
+        for response, chosen in zip(responses, memberships)
+    ]
+    return chats, {"register_s": register_s, "create_chats_s": time.perf_counter() - started}
+
+async def drive(args, ws_url: str, chats: list[dict], stats: Stats) -> dict:
+    clients = [Client(user, chat, args.encoding) for chat in chats for user in chat["members"]]
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    failures = 0
+
+    async def connect(client):
+        nonlocal failures
+        async with semaphore:
+            try:
+                await client.connect(ws_url)
+            except Exception as e:
+                failures += 1
+                stats.error(f"connect: {type(e).__name__}")
+    await asyncio.gather(*(connect(client) for client in clients))
+    clients = [client for client in clients if client.ws is not None]
+    connect_s = time.perf_counter() - started
+    listeners = [asyncio.create_task(client.listen(stats)) for client in clients]
+    sockets_in_chat = {}
+    for client in clients:
+        sockets_in_chat[client.chat["id"]] = sockets_in_chat.get(client.chat["id"], 0) + 1
+
+    rng = random.Random(args.seed + 1)
+    ops, weights = zip(*args.mix.items())
+    seq = 0
+    issued = 0
+    started = time.perf_counter()
+    while (elapsed := time.perf_counter() - started) < args.duration:
+        due = int(elapsed * args.rate) - issued
+        for _ in range(due):
+            issued += 1
+            client = rng.choice(clients)
+            chat = client.chat
+            op = rng.choices(ops, weights)[0]
+            recent = chat["messages"][-50:]
+            others = [m for m in recent if m[1] != client.user["id"]]
+            if op == "react" and recent:
+                seq += 1
+                message_id = rng.choice(recent)[0]
+                key = ("react", f"r{seq}")
+                frame = {"type": "reaction_add", "message_id": message_id, "reaction": f"r{seq}"}
+            elif op == "read" and others:
+                unread = [m for m in others if (m[0], client.user["id"]) not in chat["read"]]
+                if not unread:
+                    op = "send"
+                else:
+                    message_id = rng.choice(unread)[0]
+                    chat["read"].add((message_id, client.user["id"]))
+                    key = ("read", message_id, client.user["id"])
+                    frame = {"type": "is_read", "message_id": message_id}
+            else:
+                op = "send"
+            if op == "send":
+                seq += 1
+                content = f"lt:{seq}"
+                chat["owner_of"][content] = client.user["id"]
+                key = ("send", content)
+                frame = {"type": "message", "content": content}
+            stats.pending[key] = (op, time.perf_counter())
+            stats.sent[op] += 1
+            stats.expected[op] += sockets_in_chat[chat["id"]]
+            try:
+                await client.send(frame)
+            except websockets.ConnectionClosed:
+                stats.error("send on closed socket")
+        await asyncio.sleep(0.001)
+    drive_s = time.perf_counter() - started
+
+    await asyncio.sleep(args.drain)
+    await asyncio.gather(*(client.ws.close() for client in clients), return_exceptions=True)
+    for listener in listeners:
+        listener.cancel()
+    return {"sockets": len(clients), "connect_failures": failures, "connect_s": connect_s, "drive_s": drive_s}
+
+def report(args, setup_info: dict, drive_info: dict, stats: Stats) -> dict:
+    ops = {}
+    for op in OPS:
+        latencies = stats.latencies[op]
+        ops[op] = {
+            "sent": stats.sent[op],
+            "expected_deliveries": stats.expected[op],
+            "deliveries": len(latencies),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": max(latencies) if latencies else None,
+        }
+    total_sent = sum(stats.sent.values())
+    total_delivered = sum(len(latencies) for latencies in stats.latencies.values())
+    return {
+        "commit": current_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "url")},
+        "setup": setup_info,
+        "connections": drive_info,
+        "throughput": {
+            "ops_per_s": total_sent / drive_info["drive_s"] if drive_info["drive_s"] else 0,
+            "deliveries_per_s": total_delivered / drive_info["drive_s"] if drive_info["drive_s"] else 0,
+        },
+        "ops": ops,
+        "errors": stats.errors,
+    }
+
+async def run(args, base_url: str) -> dict:
+    ws_url = "ws" + base_url[len("http"):]
+    chats, setup_info = await setup(args, base_url)
+    stats = Stats()
+    drive_info = await drive(args, ws_url, chats, stats)
+    return report(args, setup_info, drive_info, stats)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="target a running server instead of starting one, e.g. http://127.0.0.1:8000")
+    parser.add_argument("--storage", choices=["sqlite", "memory"], default="sqlite",
+                        help="storage backend of the local server")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--members", type=int, default=10, help="members (and sockets) per chat")
+    parser.add_argument("--direct-ratio", type=float, default=0.0,
+                        help="share of chats created as one-on-one chats instead of groups")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("send=8,react=1,read=1"),
+                        help="relative weights of the operations")
+    parser.add_argument("--rate", type=float, default=500, help="operations per second over all sockets")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for late broadcasts")
+    parser.add_argument("--encoding", choices=["json", "msgpack"], default="json")
+    parser.add_argument("--http-concurrency", type=int, default=32)
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+    if args.encoding == "msgpack" and msgpack is None:
+        parser.error("msgpack is not installed")
+    if args.members < 2:
+        parser.error("--members must be at least 2")
+
+    if args.url:
+        result = asyncio.run(run(args, args.url.rstrip("/")))
+    else:
+        with LocalServer(args.storage) as server:
+            result = asyncio.run(run(args, server.url))
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+    for op, numbers in result["ops"].items():
+        pcts = " ".join(
+            f"{name}={numbers[name + '_ms']:.2f}" if numbers[name + "_ms"] is not None else f"{name}=-"
+            for name in ("p50", "p95", "p99")
+        )
+        print(f"{op:<6} sent={numbers['sent']:<7} delivered={numbers['deliveries']}/{numbers['expected_deliveries']:<9} "
+              f"{pcts} ms", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+import asyncio
+import logging
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from pathlib import Path
+from server import shards
+from server.database import (
+    ATTACHMENT_COLUMNS, LEGACY_FILE_CONTENT, MESSAGE_COLUMNS, VOICE_COLUMNS, add_columns, migrate_attachments
+)
+from server.slow_queries import TracedConnection
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = Path(os.environ.get("MESSENGER_ARCHIVE_DIR", "server/archive"))
+ARCHIVE_AFTER_DAYS = int(os.environ.get("MESSENGER_ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_PAUSE_SECONDS = 0.1
+ARCHIVE_INTERVAL_SECONDS = 3600
+ARCHIVE_MMAP_SIZE = 256 * 1024 * 1024
+ARCHIVE_SCHEMA_VERSION = 2
+
+# Files sealed before voice messages had a duration and waveform
+PRE_VOICE_MESSAGE_COLUMNS = MESSAGE_COLUMNS.replace("duration_ms, waveform", "NULL AS duration_ms, NULL AS waveform")
+# Files sealed before attachments got their own columns are read-only; their
+# JSON content is split into the same columns on the fly.
+LEGACY_MESSAGE_COLUMNS = f"""
+    id, chat_id, sender_id, sender_name,
+    CASE WHEN {LEGACY_FILE_CONTENT}
+         THEN COALESCE(json_extract(content, '$.file_name'), json_extract(content, '$.file_url'))
+         ELSE content END AS content,
+    timestamp, edited_at, reply_to, reactions, read_by,
+    CASE WHEN {LEGACY_FILE_CONTENT} THEN 'file' ELSE 'message' END AS type,
+    CASE WHEN {LEGACY_FILE_CONTENT} THEN json_extract(content, '$.file_url') END AS file_url,
+    CASE WHEN {LEGACY_FILE_CONTENT} THEN json_extract(content, '$.file_name') END AS file_name,
+    CASE WHEN {LEGACY_FILE_CONTENT} THEN json_extract(content, '$.file_type') END AS file_type,
+    CASE WHEN {LEGACY_FILE_CONTENT} THEN json_extract(content, '$.file_size') END AS file_size,
+    NULL AS duration_ms, NULL AS waveform
+"""
+
+def archive_path(shard: int, month: str) -> Path:
+    if shards.SHARD_COUNT == 1:
+        return ARCHIVE_DIR / f"messages_{month}.db"
+    return ARCHIVE_DIR / f"shard_{shard}" / f"messages_{month}.db"
+
+def cutoff() -> str:
+    return (datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+
+def create_archive_schema(conn, schema: str = "main"):
+    # Archive files carry their own user_version, so batches skip this once a file is current
+    version = conn.execute(f"PRAGMA {schema}.user_version").fetchone()[0]
+    if version >= ARCHIVE_SCHEMA_VERSION:
+        return
+    cursor = conn.cursor()
+    if version < 1:
+        create_archive_tables(conn, cursor, schema)
+    if version < 2:
+        add_columns(cursor, f"{schema}.messages", VOICE_COLUMNS)
+    conn.execute(f"PRAGMA {schema}.user_version = {ARCHIVE_SCHEMA_VERSION}")
+
+def create_archive_tables(conn, cursor, schema: str):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.messages (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            sender_name TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp DATETIME,
+            edited_at DATETIME,
+            reply_to INTEGER,
+            reactions TEXT DEFAULT '[]',
+            read_by TEXT DEFAULT '[]',
+            type TEXT NOT NULL DEFAULT 'message',
+            file_url TEXT,
+            file_name TEXT,
+            file_type TEXT,
+            file_size INTEGER
+        )
+    """)
+    if add_columns(cursor, f"{schema}.messages", ATTACHMENT_COLUMNS):
+        migrate_attachments(cursor, schema)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_messages_chat ON messages (chat_id, id)")
+
+def archive_batch(shard: int) -> int:
+    """Move a shard's oldest batch of messages past the cutoff into monthly archive files.
+
+    Message ids grow with time, so the batch is the id-ordered prefix of the
+    hot table whose timestamps are older than the cutoff. Messages of months
+    already sealed are left in the hot table (seal_finished_months reports
+    them). Returns the number of messages moved; 0 means nothing is left to
+    archive.
+    """
+    archive_path(shard, "").parent.mkdir(parents=True, exist_ok=True)
+    conn = shards.connect_shard(shard)
+    try:
+        rows = conn.execute("""
+            SELECT id, chat_id, strftime('%Y_%m', timestamp) AS month, timestamp < ? AS is_old
+            FROM messages
+            WHERE COALESCE(strftime('%Y_%m', timestamp), '') NOT IN (SELECT month FROM archive_files WHERE sealed = 1)
+            ORDER BY id LIMIT ?
+        """, (cutoff(), ARCHIVE_BATCH_SIZE)).fetchall()
+
+        by_month = {}
+        for row in rows:
+            if not row["is_old"]:
+                break
+            by_month.setdefault(row["month"], []).append(row)
+
+        moved = 0
+        for month, month_rows in by_month.items():
+            ids = [row["id"] for row in month_rows]
+            placeholders = ", ".join("?" * len(ids))
+            conn.execute("ATTACH DATABASE ? AS arch", (str(archive_path(shard, month)),))
+            try:
+                create_archive_schema(conn, "arch")
+                conn.execute(f"""
+                    INSERT OR IGNORE INTO arch.messages ({MESSAGE_COLUMNS})
+                    SELECT {MESSAGE_COLUMNS} FROM main.messages WHERE id IN ({placeholders})
+                """, ids)
+                conn.execute(f"DELETE FROM main.messages WHERE id IN ({placeholders})", ids)
+                conn.executemany("""
+                    INSERT INTO archived_chunks (chat_id, month, min_id, max_id) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (chat_id, month) DO UPDATE SET
+                        min_id = MIN(min_id, excluded.min_id),
+                        max_id = MAX(max_id, excluded.max_id)
+                """, [(row["chat_id"], month, row["id"], row["id"]) for row in month_rows])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute("DETACH DATABASE arch")
+            moved += len(ids)
+        return moved
+    finally:
+        conn.close()
+
+def seal_finished_months(shard: int) -> list[str]:
+    """Compact and make read-only the archive files no new message can land in."""
+    current = datetime.strptime(cutoff(), "%Y-%m-%d %H:%M:%S")
+    conn = shards.connect_shard(shard)
+    try:
+        # archive_batch stops at the first message (by id) that is not old
+        # enough, so an older message with a later id (sent around a month
+        # boundary, or copied in by a migration) can still be waiting here
+        waiting = dict(conn.execute("""
+            SELECT strftime('%Y_%m', timestamp) AS month, COUNT(*) FROM messages
+            WHERE timestamp < ? GROUP BY month
+        """, (current.strftime("%Y-%m-01 00:00:00"),)).fetchall())
+        for row in conn.execute("SELECT month FROM archive_files WHERE sealed = 1").fetchall():
+            if row["month"] in waiting:
+                logger.error(f"{waiting[row['month']]} messages of sealed archive month {row['month']} "
+                             f"stay in the hot table of shard {shard}")
+        rows = conn.execute("""
+            SELECT DISTINCT month FROM archived_chunks
+            WHERE month < ? AND month NOT IN (SELECT month FROM archive_files WHERE sealed = 1)
+        """, (current.strftime("%Y_%m"),)).fetchall()
+        sealed = []
+        for row in rows:
+            if row["month"] in waiting:
+                continue
+            path = archive_path(shard, row["month"])
+            if not path.exists():
+                continue
+            arch = sqlite3.connect(path)
+            try:
+                create_archive_schema(arch)
+                arch.commit()
+                arch.execute("PRAGMA journal_mode=DELETE")
+                arch.execute("VACUUM")
+            finally:
+                arch.close()
+            path.chmod(0o444)
+            conn.execute("INSERT OR REPLACE INTO archive_files (month, sealed) VALUES (?, 1)", (row["month"],))
+            conn.commit()
+            sealed.append(row["month"])
+            logger.info(f"Sealed archive {path}")
+        return sealed
+    finally:
+        conn.close()
+
+def open_archive(shard: int, month: str, sealed: bool):
+    # Sealed files never change, so SQLite can skip locking and map them
+    mode = "ro&immutable=1" if sealed else "ro"
+    conn = sqlite3.connect(f"file:{archive_path(shard, month)}?mode={mode}", uri=True, check_same_thread=False,
+                           factory=TracedConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA mmap_size={ARCHIVE_MMAP_SIZE}")
+    return conn
+
+def archive_columns(arch) -> str:
+    """Select list for an archive file, whichever layout it was written with."""
+    columns = {row[1] for row in arch.execute("PRAGMA table_info(messages)")}
+    if "duration_ms" in columns:
+        return MESSAGE_COLUMNS
+    return PRE_VOICE_MESSAGE_COLUMNS if "type" in columns else LEGACY_MESSAGE_COLUMNS
+
+def file_usage(shard: int, month: str, sealed: bool, chat_id: int | None = None) -> list[sqlite3.Row]:
+    """[{sender_id, chat_id, bytes, files}] of the file messages in a monthly
+    file, optionally only of one chat; empty if the file is missing."""
+    if not archive_path(shard, month).exists():
+        return []
+    arch = open_archive(shard, month, sealed)
+    try:
+        where, params = ("WHERE chat_id = ?", (chat_id,)) if chat_id is not None else ("", ())
+        return arch.execute(f"""
+            SELECT sender_id, chat_id, COALESCE(SUM(CAST(file_size AS INTEGER)), 0) AS bytes, COUNT(*) AS files
+            FROM (SELECT {archive_columns(arch)} FROM messages {where}) WHERE type = 'file'
+            GROUP BY sender_id, chat_id
+        """, params).fetchall()
+    finally:
+        arch.close()
+
+def file_urls(shard: int, month: str, sealed: bool) -> list[sqlite3.Row]:
+    """[{chat_id, file_url}] of the file messages in a monthly file; empty if the file is missing."""
+    if not archive_path(shard, month).exists():
+        return []
+    arch = open_archive(shard, month, sealed)
+    try:
+        return arch.execute(f"""
+            SELECT chat_id, file_url FROM (SELECT {archive_columns(arch)} FROM messages) WHERE file_url IS NOT NULL
+        """).fetchall()
+    finally:
+        arch.close()
+
+def holds(cursor, chat_id: int, message_id: int) -> bool:
+    """Whether a message of a chat was moved to the archive. `cursor` is a
+    cursor on the chat's shard."""
+    cursor.execute("""
+        SELECT a.month, COALESCE(f.sealed, 0) AS sealed
+        FROM archived_chunks a
+        LEFT JOIN archive_files f ON f.month = a.month
+        WHERE a.chat_id = ? AND ? BETWEEN a.min_id AND a.max_id
+    """, (chat_id, message_id))
+    for chunk in cursor.fetchall():
+        if not archive_path(shards.shard_for(chat_id), chunk["month"]).exists():
+            continue
+        arch = open_archive(shards.shard_for(chat_id), chunk["month"], bool(chunk["sealed"]))
+        try:
+            if arch.execute("SELECT 1 FROM messages WHERE id = ? AND chat_id = ?", (message_id, chat_id)).fetchone():
+                return True
+        finally:
+            arch.close()
+    return False
+
+def chunks_before(cursor, chat_id: int, before_id: int | None) -> list[sqlite3.Row]:
+    """Months holding messages of a chat with id < before_id, newest first.
+
+    `cursor` is a cursor on the chat's shard; the chunk index lets readers
+    open only the monthly files that hold messages of this chat.
+    """
+    cursor.execute("""
+        SELECT a.month, COALESCE(f.sealed, 0) AS sealed
+        FROM archived_chunks a
+        LEFT JOIN archive_files f ON f.month = a.month
+        WHERE a.chat_id = ? AND a.min_id < ?
+        ORDER BY a.month DESC
+    """, (chat_id, before_id if before_id is not None else 2 ** 63 - 1))
+    return cursor.fetchall()
+
+def read_history(cursor, chat_id: int, before_id: int | None, limit: int | None) -> list[sqlite3.Row]:
+    """Archived messages of a chat with id < before_id, newest first."""
+    rows = []
+    for chunk in chunks_before(cursor, chat_id, before_id):
+        remaining = None if limit is None else limit - len(rows)
+        if remaining == 0:
+            break
+        arch = open_archive(shards.shard_for(chat_id), chunk["month"], bool(chunk["sealed"]))
+        try:
+            params = [chat_id]
+            query = f"SELECT {archive_columns(arch)} FROM messages WHERE chat_id = ?"
+            if before_id is not None:
+                query += " AND id < ?"
+                params.append(before_id)
+            query += " ORDER BY id DESC"
+            if remaining is not None:
+                query += " LIMIT ?"
+                params.append(remaining)
+            rows.extend(arch.execute(query, params).fetchall())
+        finally:
+            arch.close()
+    return rows
+
+def read_files(cursor, chat_id: int, file_type: str | None, before_id: int | None, limit: int) -> list[sqlite3.Row]:
+    """Archived file messages of a chat with id < before_id, newest first."""
+    rows = []
+    for chunk in chunks_before(cursor, chat_id, before_id):
+        if len(rows) == limit:
+            break
+        arch = open_archive(shards.shard_for(chat_id), chunk["month"], bool(chunk["sealed"]))
+        try:
+            # Through a subquery so legacy files filter on their projected columns
+            query = f"SELECT * FROM (SELECT {archive_columns(arch)} FROM messages WHERE chat_id = ?) WHERE type = 'file'"
+            params = [chat_id]
+            if file_type is not None:
+                query += " AND file_type = ?"
+                params.append(file_type)
+            if before_id is not None:
+                query += " AND id < ?"
+                params.append(before_id)
+            query += " ORDER BY id DESC LIMIT ?"
+            params.append(limit - len(rows))
+            rows.extend(arch.execute(query, params).fetchall())
+        finally:
+            arch.close()
+    return rows
+
+def read_after(cursor, chat_id: int, after_id: int, limit: int,
+               since: str | None = None, until: str | None = None) -> list[sqlite3.Row]:
+    """Archived messages of a chat with id > after_id, oldest first, optionally
+    restricted to since <= timestamp < until. Months outside the range are not opened."""
+    query = """
+        SELECT a.month, COALESCE(f.sealed, 0) AS sealed
+        FROM archived_chunks a
+        LEFT JOIN archive_files f ON f.month = a.month
+        WHERE a.chat_id = ? AND a.max_id > ?
+    """
+    params = [chat_id, after_id]
+    # Months are named like "2024_01" after the timestamps they hold
+    if since is not None:
+        query += " AND a.month >= ?"
+        params.append(since[:7].replace("-", "_"))
+    if until is not None:
+        query += " AND a.month <= ?"
+        params.append(until[:7].replace("-", "_"))
+    cursor.execute(query + " ORDER BY a.month", params)
+    chunks = cursor.fetchall()
+
+    rows = []
+    for chunk in chunks:
+        if len(rows) == limit:
+            break
+        arch = open_archive(shards.shard_for(chat_id), chunk["month"], bool(chunk["sealed"]))
+        try:
+            query, params = range_query(chat_id, rows[-1]["id"] if rows else after_id, since, until, limit - len(rows),
+                                        archive_columns(arch))
+            rows.extend(arch.execute(query, params).fetchall())
+        finally:
+            arch.close()
+    return rows
+
+def range_query(chat_id: int, after_id: int, since: str | None, until: str | None, limit: int,
+                columns: str = MESSAGE_COLUMNS):
+    """Query and parameters for a chat's messages after `after_id` in id order."""
+    query = f"SELECT {columns} FROM messages WHERE chat_id = ? AND id > ?"
+    params = [chat_id, after_id]
+    if since is not None:
+        query += " AND timestamp >= ?"
+        params.append(since)
+    if until is not None:
+        query += " AND timestamp < ?"
+        params.append(until)
+    query += " ORDER BY id LIMIT ?"
+    params.append(limit)
+    return query, params
+
+async def run_archiver():
+    """Background task: archive old messages in small batches, then seal finished months."""
+    while True:
+        try:
+            for shard in shards.all_shards():
+                while await asyncio.to_thread(archive_batch, shard):
+                    await asyncio.sleep(ARCHIVE_PAUSE_SECONDS)
+                await asyncio.to_thread(seal_finished_months, shard)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error while archiving messages: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+if __name__ == "__main__":
+    from server import migrations
+    migrations.migrate()
+    for shard in shards.all_shards():
+        total = 0
+        while moved := archive_batch(shard):
+            total += moved
+        print(f"Shard {shard}: archived {total} messages, sealed: {seal_finished_months(shard)}")
@@ -0,0 +1,49 @@
+import os
+from collections import OrderedDict
+from server import metrics
+
+# Message ids recently stored per user under their client_msg_id, so a frame
+# resent over a flaky connection is acked from memory without touching the
+# shard. The unique index on messages (chat_id, sender_id, client_msg_id)
+# catches the duplicates this window has already forgotten.
+#
+#   MESSENGER_CLIENT_ID_WINDOW   client ids remembered per user (default 256)
+#   MESSENGER_CLIENT_ID_USERS    users remembered, least recently sending dropped first (default 10000)
+
+CLIENT_ID_WINDOW = int(os.environ.get("MESSENGER_CLIENT_ID_WINDOW", "256"))
+CLIENT_ID_USERS = int(os.environ.get("MESSENGER_CLIENT_ID_USERS", "10000"))
+MAX_CLIENT_MSG_ID_LENGTH = 64
+
+DUPLICATES = metrics.Counter(
+    "ws_duplicate_messages_total", "Resent message frames acked without a write, by where the original was found.",
+    ["source"]
+)
+
+def valid(client_msg_id) -> bool:
+    return isinstance(client_msg_id, str) and 0 < len(client_msg_id) <= MAX_CLIENT_MSG_ID_LENGTH
+
+class RecentClientIds:
+    def __init__(self, window: int = CLIENT_ID_WINDOW, max_users: int = CLIENT_ID_USERS):
+        self.window = window
+        self.max_users = max_users
+        self.users = OrderedDict()  # { user_id: OrderedDict{ (chat_id, client_msg_id): message_id } }
+
+    def get(self, user_id: int, chat_id: int, client_msg_id: str) -> int | None:
+        ids = self.users.get(user_id)
+        return ids.get((chat_id, client_msg_id)) if ids is not None else None
+
+    def add(self, user_id: int, chat_id: int, client_msg_id: str, message_id: int):
+        if self.window <= 0:
+            return
+        ids = self.users.get(user_id)
+        if ids is None:
+            ids = self.users[user_id] = OrderedDict()
+            if len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(user_id)
+        ids[(chat_id, client_msg_id)] = message_id
+        if len(ids) > self.window:
+            ids.popitem(last=False)
+
+recent = RecentClientIds()
@@ -1,151 +1,82 @@
 import sqlite3
 from pathlib import Path
+from server.slow_queries import TracedConnection
 
 DB_PATH = "server/messenger.db"
 
+# File and voice messages keep their attachment in typed columns; `content`
+# holds the file name. Rows written before that kept a JSON object in `content`.
+ATTACHMENT_COLUMNS = [
+    ("type", "TEXT NOT NULL DEFAULT 'message'"),  # 'message' or 'file'
+    ("file_url", "TEXT DEFAULT NULL"),
+    ("file_name", "TEXT DEFAULT NULL"),
+    ("file_type", "TEXT DEFAULT NULL"),
+    ("file_size", "INTEGER DEFAULT NULL")
+]
+# Filled in for voice messages once the upload has been parsed (see server/voice.py)
+VOICE_COLUMNS = [
+    ("duration_ms", "INTEGER DEFAULT NULL"),
+    ("waveform", "TEXT DEFAULT NULL")  # base64, one byte per peak
+]
+# Message columns kept when a message moves between files (archive, shards)
+MESSAGE_COLUMNS = ("id, chat_id, sender_id, sender_name, content, timestamp, edited_at, reply_to, reactions, read_by, "
+                   "type, file_url, file_name, file_type, file_size, duration_ms, waveform")
+LEGACY_FILE_CONTENT = "(content LIKE '{%' AND json_valid(content) AND json_extract(content, '$.file_url') IS NOT NULL)"
+
 def get_connection():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=TracedConnection)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL")  # Parallel work
     return conn
 
-def setup_database():
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    # Users table with avatar_url, bio, encrypted_cloud_part, salt, and verification_ciphertext
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            avatar_url TEXT,
-            bio TEXT,
-            encrypted_cloud_part TEXT,
-            salt BLOB,
-            verification_ciphertext TEXT
-        )
-    """)
-
-    # Add columns to users if not exist
-    for column, definition in [
-        ("avatar_url", "TEXT"),
-        ("bio", "TEXT"),
-        ("encrypted_cloud_part", "TEXT"),
-        ("salt", "BLOB"),
-        ("verification_ciphertext", "TEXT")
-    ]:
+def add_columns(cursor, table: str, columns: list[tuple[str, str]]) -> bool:
+    """Add the missing columns to a table. Returns True if any was added."""
+    added = False
+    for column, definition in columns:
         try:
-            cursor.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            added = True
         except sqlite3.OperationalError as e:
             if "duplicate column name" not in str(e).lower():
                 raise
-
-    # Check if chats table exists and has the old schema
-    cursor.execute("PRAGMA table_info(chats)")
-    columns = [col['name'] for col in cursor.fetchall()]
-    needs_migration = 'user1_id' in columns and 'user2_id' in columns and 'type' in columns
-
-    if needs_migration:
-        # Create a new chats table with nullable user1_id and user2_id
-        cursor.execute("""
-            CREATE TABLE chats_new (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                type TEXT NOT NULL DEFAULT 'one-on-one',
-                user1_id INTEGER,
-                user2_id INTEGER,
-                FOREIGN KEY (user1_id) REFERENCES users (id),
-                FOREIGN KEY (user2_id) REFERENCES users (id)
-            )
-        """)
-
-        # Copy data from old chats table to new one
-        cursor.execute("""
-            INSERT INTO chats_new (id, name, type, user1_id, user2_id)
-            SELECT id, name, COALESCE(type, 'one-on-one'), user1_id, user2_id
-            FROM chats
-        """)
-
-        # Drop the old chats table
-        cursor.execute("DROP TABLE chats")
-
-        # Rename the new table to chats
-        cursor.execute("ALTER TABLE chats_new RENAME TO chats")
-
-    else:
-        # Create chats table if it doesn't exist
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                type TEXT NOT NULL DEFAULT 'one-on-one',
-                user1_id INTEGER,
-                user2_id INTEGER,
-                FOREIGN KEY (user1_id) REFERENCES users (id),
-                FOREIGN KEY (user2_id) REFERENCES users (id)
-            )
-        """)
-
-    # Groups table for group chat metadata
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS groups (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER NOT NULL,
-            admin_id INTEGER NOT NULL,
-            FOREIGN KEY (chat_id) REFERENCES chats (id),
-            FOREIGN KEY (admin_id) REFERENCES users (id)
-        )
-    """)
-
-    # Participants table for chat memberships
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS participants (
-            chat_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            PRIMARY KEY (chat_id, user_id),
-            FOREIGN KEY (chat_id) REFERENCES chats (id),
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
+    return added
+
+def migrate_attachments(cursor, schema: str = "main"):
+    """Move the attachment of JSON-content file messages into the typed columns."""
+    cursor.execute(f"""
+        UPDATE {schema}.messages SET
+            type = 'file',
+            file_url = json_extract(content, '$.file_url'),
+            file_name = json_extract(content, '$.file_name'),
+            file_type = json_extract(content, '$.file_type'),
+            file_size = json_extract(content, '$.file_size'),
+            content = COALESCE(json_extract(content, '$.file_name'), json_extract(content, '$.file_url'))
+        WHERE type = 'message' AND {LEGACY_FILE_CONTENT}
     """)
 
-    # Messages table with sender_name, reactions, and read_by
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER NOT NULL,
-            sender_id INTEGER NOT NULL,
-            sender_name TEXT NOT NULL,
-            content TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            edited_at DATETIME DEFAULT NULL,
-            reply_to INTEGER DEFAULT NULL,
-            reactions TEXT DEFAULT '[]',
-            read_by TEXT DEFAULT '[]',
-            FOREIGN KEY (chat_id) REFERENCES chats (id),
-            FOREIGN KEY (reply_to) REFERENCES messages (id)
-        )
-    """)
-
-    # Add columns to messages if not exist
-    for column, definition in [
-        ("edited_at", "DATETIME DEFAULT NULL"),
-        ("sender_name", "TEXT NOT NULL"),
-        ("reactions", "TEXT DEFAULT '[]'"),
-        ("read_by", "TEXT DEFAULT '[]'")  # Add read_by column
-    ]:
-        try:
-            cursor.execute(f"ALTER TABLE messages ADD COLUMN {column} {definition}")
-        except sqlite3.OperationalError as e:
-            if "duplicate column name" not in str(e).lower():
-                raise
-
-    # Ensure existing chats have type='one-on-one'
-    cursor.execute("""
-        UPDATE chats SET type = 'one-on-one' WHERE type IS NULL
+def backfill_chat_summaries(cursor, participants_source: str = "participants"):
+    cursor.execute(f"""
+        INSERT OR REPLACE INTO chat_summaries (chat_id, user_id, last_message_id, last_message_preview,
+                                               last_sender, last_activity, unread_count)
+        SELECT p.chat_id, p.user_id, m.id,
+               CASE WHEN m.type = 'file' AND m.file_type = 'voice' THEN '[voice message]'
+                    WHEN m.type = 'file' THEN substr('[file] ' || m.content, 1, 100)
+                    ELSE substr(m.content, 1, 100) END,
+               m.sender_name, COALESCE(m.timestamp, CURRENT_TIMESTAMP),
+               (SELECT COUNT(*) FROM messages u
+                WHERE u.chat_id = p.chat_id AND u.sender_id != p.user_id
+                  AND NOT EXISTS (SELECT 1 FROM json_each(COALESCE(u.read_by, '[]')) r
+                                  WHERE json_extract(r.value, '$.user_id') = p.user_id))
+        FROM {participants_source} p
+        LEFT JOIN messages m ON m.id = (SELECT MAX(id) FROM messages WHERE chat_id = p.chat_id)
     """)
 
-    conn.commit()
-    conn.close()
-
-setup_database()
\ No newline at end of file
+def backfill_storage_usage(cursor):
+    """Recount the storage counters from the file messages in the messages table."""
+    for table, key, owner in (("user_storage", "user_id", "sender_id"), ("chat_storage", "chat_id", "chat_id")):
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.execute(f"""
+            INSERT INTO {table} ({key}, bytes, files)
+            SELECT {owner}, COALESCE(SUM(CAST(file_size AS INTEGER)), 0), COUNT(*)
+            FROM messages WHERE type = 'file' GROUP BY {owner}
+        """)
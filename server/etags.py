@@ -0,0 +1,26 @@
+from fastapi import Request, Response
+
+# Strong ETags for polled endpoints, built from version counters that storage
+# bumps in the same transaction as the change (see chat_versions and
+# list_versions), so an unchanged poll costs one counter lookup and a 304.
+
+ETAG_FORMAT = 1  # Bump when a polled response changes shape, so old ETags stop matching
+CACHE_CONTROL = "private, no-cache"  # Clients may keep the body but must revalidate
+
+def etag(kind: str, key: int, version: int) -> str:
+    return f'"{kind}{ETAG_FORMAT}-{key}-{version}"'
+
+def matches(request: Request, tag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    # If-None-Match uses the weak comparison
+    candidates = [candidate.strip().removeprefix("W/") for candidate in header.split(",")]
+    return "*" in candidates or tag in candidates
+
+def not_modified(tag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": tag, "Cache-Control": CACHE_CONTROL})
+
+def set_headers(response: Response, tag: str):
+    response.headers["ETag"] = tag
+    response.headers["Cache-Control"] = CACHE_CONTROL
@@ -0,0 +1,284 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from server import metrics
+
+# Newest messages of recently read chats, shaped exactly as /messages/history
+# returns them, so the first page of an active chat is served without
+# touching SQLite. Writers call the update functions below after their
+# storage write succeeded; chats that are not cached are left alone and are
+# filled by the next history read.
+#
+#   MESSENGER_HISTORY_CACHE_TAIL   newest messages kept per chat (default 200)
+#   MESSENGER_HISTORY_CACHE_MB     approximate memory budget (default 64, 0 disables the cache)
+#   MESSENGER_HISTORY_CACHE_IDLE   seconds after which an unread chat is dropped (default 900)
+#
+# Each tail records the chat version (see chat_versions) its content matches:
+# the version read before the fill, plus one for every write applied since,
+# as every storage write bumps the version once. A read is only answered
+# when that equals the version the ETag was built from, so a write committed
+# but not yet applied here, or made by another worker, is a miss rather than
+# stale history under a new ETag.
+
+HISTORY_CACHE_TAIL = int(os.environ.get("MESSENGER_HISTORY_CACHE_TAIL", "200"))
+HISTORY_CACHE_BYTES = int(float(os.environ.get("MESSENGER_HISTORY_CACHE_MB", "64")) * 1024 * 1024)
+HISTORY_CACHE_IDLE_SECONDS = float(os.environ.get("MESSENGER_HISTORY_CACHE_IDLE", "900"))
+MESSAGE_OVERHEAD = 800  # Rough size of a shaped message dict without its strings
+
+DEFAULT_AVATAR = "/static/avatars/default.jpg"
+
+REQUESTS = metrics.Counter(
+    "history_cache_requests_total", "History requests by cache outcome (hit, miss, bypass).", ["result"]
+)
+
+def timestamp() -> str:
+    """Now in the format SQLite's CURRENT_TIMESTAMP stores."""
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+def shape_message(msg, avatar_url: str | None) -> dict:
+    if msg["type"] == "file":
+        content = {
+            "file_url": msg["file_url"],
+            "file_name": msg["file_name"],
+            "file_type": msg["file_type"],
+            "file_size": msg["file_size"]
+        }
+        if msg["file_type"] == "voice":
+            content["duration_ms"] = msg["duration_ms"]
+            content["waveform"] = msg["waveform"]
+    else:
+        content = msg["content"]
+
+    return {
+        "id": msg["id"],
+        "content": content,
+        "timestamp": msg["timestamp"],
+        "sender": msg["sender_name"],
+        "avatar_url": avatar_url if avatar_url else DEFAULT_AVATAR,
+        "reply_to": msg["reply_to"],
+        "reactions": msg["reactions"] or "[]",  # Return JSON string
+        "read_by": msg["read_by"] or "[]",
+        "is_deleted": not bool(content),
+        "type": msg["type"]
+    }
+
+def message_size(message: dict) -> int:
+    content = message["content"]
+    text = content if isinstance(content, str) else "".join(str(value) for value in content.values())
+    return MESSAGE_OVERHEAD + len(text) + len(message["reactions"]) + len(message["read_by"])
+
+class ChatTail:
+    __slots__ = ("messages", "senders", "complete", "size", "last_used", "version")
+
+    def __init__(self, version: int | None = None):
+        self.messages = {}  # { message_id: shaped message } in id order
+        self.senders = {}  # { message_id: sender_id }
+        self.complete = False  # The tail holds every message of the chat
+        self.size = 0
+        self.last_used = time.monotonic()
+        self.version = version  # None once it is unknown; refilled by the next miss
+
+class HistoryCache:
+    def __init__(self, tail: int = HISTORY_CACHE_TAIL, max_bytes: int = HISTORY_CACHE_BYTES,
+                 idle_seconds: float = HISTORY_CACHE_IDLE_SECONDS):
+        self.tail = tail
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.chats = OrderedDict()  # { chat_id: ChatTail }, least recently used first
+        self.size = 0
+        self.avatars = {}  # { user_id: avatar_url } of senders seen in cached chats
+        self.fills = {}  # { chat_id: [fills in flight, writes seen meanwhile] }
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.tail > 0
+
+    def get(self, chat_id: int, limit: int | None, version: int) -> list[dict] | None:
+        """The newest `limit` messages (all if None) in ascending order, or None
+        if the cache cannot answer for the chat at `version`."""
+        tail = self.chats.get(chat_id)
+        if tail is None or tail.version != version:
+            return None
+        if time.monotonic() - tail.last_used > self.idle_seconds:
+            self._drop(chat_id)
+            return None
+        if limit is None:
+            if not tail.complete:
+                return None
+            messages = list(tail.messages.values())
+        elif len(tail.messages) >= limit or tail.complete:
+            messages = list(tail.messages.values())[-limit:]
+        else:
+            return None
+        self._use(chat_id, tail)
+        return messages
+
+    def start_fill(self, chat_id: int) -> int:
+        """Call before reading the chat from storage; pass the result to `finish_fill`."""
+        fill = self.fills.setdefault(chat_id, [0, 0])
+        fill[0] += 1
+        return fill[1]
+
+    def finish_fill(self, chat_id: int, writes_seen: int, rows: list[dict] | None = None,
+                    avatars: dict[int, str | None] | None = None, complete: bool = False,
+                    version: int | None = None):
+        """Store the newest `rows` (newest first, as storage returns them), read
+        after the chat was at `version`, unless the chat was written to while
+        they were read. Call with no rows to give up."""
+        fill = self.fills[chat_id]
+        fill[0] -= 1
+        fresh = fill[1] == writes_seen
+        if not fill[0]:
+            del self.fills[chat_id]
+        if rows is None or not fresh or not self.enabled:
+            return
+        self._drop(chat_id)
+        self.avatars.update(avatars)
+        tail = ChatTail(version)
+        for row in reversed(rows[:self.tail]):
+            self._put(tail, row["id"], row["sender_id"], shape_message(row, avatars.get(row["sender_id"])))
+        tail.complete = complete and len(rows) <= self.tail
+        self.chats[chat_id] = tail
+        self.size += tail.size
+        self._evict()
+
+    def _written(self, chat_id: int) -> ChatTail | None:
+        fill = self.fills.get(chat_id)
+        if fill is not None:
+            fill[1] += 1
+        tail = self.chats.get(chat_id)
+        if tail is not None:
+            if tail.version is not None:
+                tail.version += 1
+            self._use(chat_id, tail)
+        return tail
+
+    def _use(self, chat_id: int, tail: ChatTail):
+        tail.last_used = time.monotonic()
+        self.chats.move_to_end(chat_id)
+
+    def _put(self, tail: ChatTail, message_id: int, sender_id: int, message: dict):
+        old = tail.messages.get(message_id)
+        if old is not None:
+            tail.size -= message_size(old)
+        tail.messages[message_id] = message
+        tail.senders[message_id] = sender_id
+        tail.size += message_size(message)
+
+    def _update(self, chat_id: int, message_id: int, **changes):
+        tail = self._written(chat_id)
+        if tail is None or message_id not in tail.messages:
+            return
+        before = tail.size
+        # A new dict, so responses already handed out are never changed underneath
+        self._put(tail, message_id, tail.senders[message_id], {**tail.messages[message_id], **changes})
+        self.size += tail.size - before
+        self._evict()
+
+    def _drop(self, chat_id: int):
+        tail = self.chats.pop(chat_id, None)
+        if tail is not None:
+            self.size -= tail.size
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.chats:
+            chat_id, tail = next(iter(self.chats.items()))
+            if self.size <= self.max_bytes and now - tail.last_used <= self.idle_seconds:
+                break
+            self._drop(chat_id)
+
+    def add_message(self, chat_id: int, message_id: int, sender_id: int, sender_name: str, avatar_url: str | None,
+                    content: str, created_at: str, reply_to: int | None = None, attachment: dict | None = None):
+        tail = self._written(chat_id)
+        if tail is None:
+            return
+        attachment = attachment or {}
+        row = {
+            "id": message_id, "content": content, "timestamp": created_at, "sender_name": sender_name,
+            "reply_to": reply_to, "reactions": "[]", "read_by": "[]", "type": "file" if attachment else "message",
+            "file_url": attachment.get("file_url"), "file_name": attachment.get("file_name"),
+            "file_type": attachment.get("file_type"), "file_size": attachment.get("file_size"),
+            "duration_ms": attachment.get("duration_ms"), "waveform": attachment.get("waveform")
+        }
+        # A socket keeps the avatar its user had when it connected; prefer a newer one
+        avatar_url = self.avatars.get(sender_id, avatar_url)
+        before = tail.size
+        self._put(tail, message_id, sender_id, shape_message(row, avatar_url))
+        while len(tail.messages) > self.tail:
+            oldest = next(iter(tail.messages))
+            tail.size -= message_size(tail.messages.pop(oldest))
+            del tail.senders[oldest]
+            tail.complete = False
+        self.size += tail.size - before
+        self._evict()
+
+    def edit_message(self, chat_id: int, message_id: int, content: str):
+        # Editing turns a file message into text, see message_store.edit_message
+        self._update(chat_id, message_id, content=content, type="message", is_deleted=not bool(content))
+
+    def delete_message(self, chat_id: int, message_id: int):
+        tail = self._written(chat_id)
+        if tail is None or message_id not in tail.messages:
+            return
+        size = message_size(tail.messages.pop(message_id))
+        del tail.senders[message_id]
+        tail.size -= size
+        self.size -= size
+
+    def add_reaction(self, chat_id: int, message_id: int, user_id: int, reaction: str):
+        tail = self.chats.get(chat_id)
+        if tail is None or message_id not in tail.messages:
+            self._written(chat_id)
+            return
+        reactions = json.loads(tail.messages[message_id]["reactions"])
+        reactions.append({"user_id": user_id, "reaction": reaction})
+        self._update(chat_id, message_id, reactions=json.dumps(reactions))
+
+    def remove_reaction(self, chat_id: int, message_id: int, user_id: int, reaction: str):
+        tail = self.chats.get(chat_id)
+        if tail is None or message_id not in tail.messages:
+            self._written(chat_id)
+            return
+        reactions = json.loads(tail.messages[message_id]["reactions"])
+        reactions = [r for r in reactions if not (r["user_id"] == user_id and r["reaction"] == reaction)]
+        self._update(chat_id, message_id, reactions=json.dumps(reactions))
+
+    def mark_read(self, chat_id: int, message_id: int, user_id: int, read_at: str):
+        tail = self.chats.get(chat_id)
+        if tail is None or message_id not in tail.messages:
+            self._written(chat_id)
+            return
+        read_by = json.loads(tail.messages[message_id]["read_by"])
+        read_by.append({"user_id": user_id, "read_at": read_at})
+        self._update(chat_id, message_id, read_by=json.dumps(read_by))
+
+    def drop_chat(self, chat_id: int):
+        self._written(chat_id)
+        self._drop(chat_id)
+
+    def set_avatar(self, user_id: int, avatar_url: str | None):
+        """Re-shape the cached messages of a user whose avatar changed or who was deleted."""
+        self.avatars[user_id] = avatar_url
+        for fill in self.fills.values():
+            fill[1] += 1
+        for tail in self.chats.values():
+            for message_id, sender_id in tail.senders.items():
+                if sender_id == user_id:
+                    # Storage bumps the chats the user is in, which need not be the ones they wrote to
+                    tail.version = None
+                    message = tail.messages[message_id]
+                    tail.messages[message_id] = {**message, "avatar_url": avatar_url or DEFAULT_AVATAR}
+
+    def gauges(self):
+        return [
+            ("history_cache_chats", "Chats with a cached history tail.", [({}, len(self.chats))]),
+            ("history_cache_messages", "Messages held by the history cache.",
+             [({}, sum(len(tail.messages) for tail in self.chats.values()))]),
+            ("history_cache_bytes", "Approximate memory held by the history cache.", [({}, self.size)]),
+        ]
+
+cache = HistoryCache()
+metrics.register_collector(cache.gauges)
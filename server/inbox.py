@@ -0,0 +1,74 @@
+PREVIEW_LENGTH = 100
+
+def message_preview(content: str, message_type: str = "message", file_type: str | None = None) -> str:
+    """Short text shown in the chat list for the last message of a chat.
+
+    For file messages `content` is the file name.
+    """
+    if message_type == "file":
+        if file_type == "voice":
+            return "[voice message]"
+        return f"[file] {content or ''}"[:PREVIEW_LENGTH]
+    return (content or "")[:PREVIEW_LENGTH]
+
+# All helpers below take a cursor on the chat's shard and never commit, so the
+# summary rows change in the same transaction as the message write they describe.
+
+def add_members(cursor, chat_id: int, user_ids):
+    cursor.executemany("""
+        INSERT OR IGNORE INTO chat_summaries (chat_id, user_id, last_activity)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+    """, [(chat_id, user_id) for user_id in user_ids])
+
+def remove_members(cursor, chat_id: int, user_ids):
+    cursor.executemany("DELETE FROM chat_summaries WHERE chat_id = ? AND user_id = ?",
+                       [(chat_id, user_id) for user_id in user_ids])
+
+def record_message(cursor, chat_id: int, sender_id: int, sender_name: str, message_id: int, content: str,
+                   message_type: str = "message", file_type: str | None = None):
+    cursor.execute("""
+        UPDATE chat_summaries
+        SET last_message_id = ?, last_message_preview = ?, last_sender = ?,
+            last_activity = CURRENT_TIMESTAMP,
+            unread_count = unread_count + (user_id != ?)
+        WHERE chat_id = ?
+    """, (message_id, message_preview(content, message_type, file_type), sender_name, sender_id, chat_id))
+
+def record_edit(cursor, chat_id: int, message_id: int, content: str):
+    cursor.execute("""
+        UPDATE chat_summaries SET last_message_preview = ?
+        WHERE chat_id = ? AND last_message_id = ?
+    """, (message_preview(content), chat_id, message_id))
+
+def record_delete(cursor, chat_id: int, message_id: int, sender_id: int, read_by: str | None):
+    """Point summaries whose last message was deleted at the previous message,
+    and take it off the unread count of the members who had not read it.
+    `read_by` is the deleted row's read_by JSON."""
+    cursor.execute("""
+        SELECT id, sender_name, content, type, file_type FROM messages
+        WHERE chat_id = ? ORDER BY id DESC LIMIT 1
+    """, (chat_id,))
+    previous = cursor.fetchone()
+    cursor.execute("""
+        UPDATE chat_summaries
+        SET last_message_id = CASE WHEN last_message_id = :message_id THEN :id ELSE last_message_id END,
+            last_message_preview = CASE WHEN last_message_id = :message_id THEN :preview ELSE last_message_preview END,
+            last_sender = CASE WHEN last_message_id = :message_id THEN :sender_name ELSE last_sender END,
+            unread_count = CASE
+                WHEN user_id != :sender_id AND user_id NOT IN (
+                    SELECT json_extract(value, '$.user_id') FROM json_each(:read_by)
+                ) THEN MAX(unread_count - 1, 0)
+                ELSE unread_count END
+        WHERE chat_id = :chat_id
+    """, {
+        "id": previous["id"] if previous else None,
+        "preview": message_preview(previous["content"], previous["type"], previous["file_type"]) if previous else None,
+        "sender_name": previous["sender_name"] if previous else None,
+        "message_id": message_id, "sender_id": sender_id, "read_by": read_by or "[]", "chat_id": chat_id
+    })
+
+def record_read(cursor, chat_id: int, user_id: int):
+    cursor.execute("""
+        UPDATE chat_summaries SET unread_count = MAX(unread_count - 1, 0)
+        WHERE chat_id = ? AND user_id = ?
+    """, (chat_id, user_id))
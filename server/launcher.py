@@ -0,0 +1,156 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import uvicorn
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Runs uvicorn workers on one shared listening socket and restarts them
+# without dropping clients:
+#
+#   python -m server.launcher --workers 1 --port 8000
+#   kill -HUP <launcher pid>    # roll the workers one at a time
+#   kill -TERM <launcher pid>   # drain every worker and exit
+#
+# A roll starts the replacement first and only then drains the old worker
+# (see ConnectionManager.drain), so the port never stops answering. Sockets,
+# broadcasts and the history cache are per process: with more than one worker
+# the members of a chat must all reach the same process, so keep the default
+# of one worker unless a proxy routes by chat.
+
+WORKERS = int(os.environ.get("MESSENGER_WORKERS", "1"))
+WORKER_START_TIMEOUT_SECONDS = 60
+WORKER_STOP_TIMEOUT_SECONDS = 60  # Drain plus uvicorn's own graceful shutdown
+SUPERVISE_INTERVAL_SECONDS = 0.5
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn server that drains its WebSockets before the usual shutdown,
+    which would close them all at once."""
+
+    def __init__(self, config: uvicorn.Config, ready=None):
+        super().__init__(config)
+        self.ready = ready
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets)
+        if self.ready is not None and self.started:
+            self.ready.set()
+
+    async def shutdown(self, sockets=None):
+        # Stop accepting first, so the other workers take the new connections
+        for server in self.servers:
+            server.close()
+        from server.websocket import manager
+        await manager.drain()
+        await super().shutdown(sockets)
+
+def run_worker(config: uvicorn.Config, sockets, ready):
+    config.configure_logging()
+    DrainingServer(config, ready).run(sockets=sockets)
+
+class Worker:
+    def __init__(self, process: multiprocessing.Process, ready):
+        self.process = process
+        self.ready = ready
+
+class Launcher:
+    def __init__(self, config: uvicorn.Config, workers: int):
+        self.config = config
+        self.count = workers
+        self.context = multiprocessing.get_context("spawn")
+        self.sockets = []
+        self.workers: list[Worker] = []
+        self.roll_requested = False
+        self.stop_requested = False
+
+    def spawn(self) -> Worker:
+        ready = self.context.Event()
+        process = self.context.Process(target=run_worker, args=(self.config, self.sockets, ready))
+        process.start()
+        logger.info(f"Started worker {process.pid}")
+        return Worker(process, ready)
+
+    def wait_ready(self, worker: Worker) -> bool:
+        deadline = time.monotonic() + WORKER_START_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            if worker.ready.wait(SUPERVISE_INTERVAL_SECONDS):
+                return True
+            if not worker.process.is_alive():
+                return False
+        return False
+
+    def stop(self, worker: Worker):
+        if worker.process.is_alive():
+            worker.process.terminate()  # SIGTERM: the worker drains, then exits
+        worker.process.join(WORKER_STOP_TIMEOUT_SECONDS)
+        if worker.process.is_alive():
+            logger.error(f"Worker {worker.process.pid} did not exit in time, killing it")
+            worker.process.kill()
+            worker.process.join()
+        logger.info(f"Stopped worker {worker.process.pid}")
+
+    def roll(self):
+        """Replace the workers one at a time; stops at the first replacement that fails to start."""
+        logger.info(f"Rolling {len(self.workers)} workers")
+        for i, old in enumerate(list(self.workers)):
+            new = self.spawn()
+            if not self.wait_ready(new):
+                logger.error(f"Worker {new.process.pid} failed to start, keeping the remaining old workers")
+                self.stop(new)
+                return
+            self.workers[i] = new
+            self.stop(old)
+        logger.info("Rolled all workers")
+
+    def supervise(self):
+        for i, worker in enumerate(self.workers):
+            if not worker.process.is_alive():
+                logger.error(f"Worker {worker.process.pid} exited with code {worker.process.exitcode}, restarting it")
+                self.workers[i] = self.spawn()
+
+    def run(self):
+        self.sockets = [self.config.bind_socket()]
+        signal.signal(signal.SIGHUP, self.request_roll)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        self.workers = [self.spawn() for _ in range(self.count)]
+        while not self.stop_requested:
+            time.sleep(SUPERVISE_INTERVAL_SECONDS)
+            if self.roll_requested:
+                self.roll_requested = False
+                self.roll()
+            self.supervise()
+        logger.info(f"Stopping {len(self.workers)} workers")
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            self.stop(worker)
+        for sock in self.sockets:
+            sock.close()
+
+    def request_roll(self, signum, frame):
+        self.roll_requested = True
+
+    def request_stop(self, signum, frame):
+        self.stop_requested = True
+
+def main():
+    parser = argparse.ArgumentParser(description="Run messenger workers with graceful rolling restarts")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    config = uvicorn.Config(
+        "server.main:app", host=args.host, port=args.port, ws="websockets", ws_per_message_deflate=True,
+        timeout_graceful_shutdown=WORKER_STOP_TIMEOUT_SECONDS // 2
+    )
+    Launcher(config, args.workers).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+# Log records are handed to a bounded queue and written by a background
+# thread, so a slow stderr or disk never stalls the event loop. Hot paths
+# guard their calls with `enabled()`, which checks the level and the
+# per-event sample rate before any message is formatted.
+#
+#   MESSENGER_LOG_LEVEL     root level (default INFO)
+#   MESSENGER_LOG_SAMPLE    per-event sample rates, e.g. "ws.frame=0.01,ws.save=0.1"
+#   MESSENGER_LOG_CONTENT   set to 1 to log message content and secrets unredacted
+#   MESSENGER_LOG_QUEUE     queue size before records are dropped (default 10000)
+
+LOG_LEVEL = os.environ.get("MESSENGER_LOG_LEVEL", "INFO").upper()
+LOG_CONTENT = os.environ.get("MESSENGER_LOG_CONTENT") == "1"
+QUEUE_SIZE = int(os.environ.get("MESSENGER_LOG_QUEUE", "10000"))
+
+logger = logging.getLogger(__name__)
+
+def parse_sample_rates(spec: str) -> dict[str, float]:
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        event, _, rate = item.partition("=")
+        rates[event.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+sample_rates = parse_sample_rates(os.environ.get("MESSENGER_LOG_SAMPLE", ""))
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking or raising when full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # The listener's handlers run in this process with their own formatters,
+        # and uvicorn's access formatter reads record.args, so the record is
+        # passed on as is instead of being pre-formatted into a plain message
+        return record
+
+# uvicorn attaches its own handlers to these and does not propagate to root
+QUEUED_LOGGERS = ("", "uvicorn", "uvicorn.error", "uvicorn.access")
+
+_queued = []  # [(logger, queue handler, listener)]
+
+def setup():
+    """Move the handlers of the root and uvicorn loggers behind queues drained
+    by background threads.
+
+    Safe to call more than once and in any order with the modules'
+    `logging.basicConfig()` calls: whatever handlers a logger has are handed
+    over to its writer thread.
+    """
+    if _queued:
+        return
+    logging.basicConfig(level=LOG_LEVEL)
+    logging.getLogger().setLevel(LOG_LEVEL)
+    for name in QUEUED_LOGGERS:
+        log = logging.getLogger(name)
+        handlers = list(log.handlers)
+        if not handlers:
+            continue
+        for handler in handlers:
+            log.removeHandler(handler)
+        queue_handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+        log.addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        _queued.append((log, queue_handler, listener))
+
+def shutdown():
+    """Flush the queues, stop the writer threads and give the loggers their
+    handlers back."""
+    dropped = sum(queue_handler.dropped for _, queue_handler, _ in _queued)
+    if dropped:
+        logger.warning(f"Dropped {dropped} log records on a full queue")
+    while _queued:
+        log, queue_handler, listener = _queued.pop()
+        listener.stop()
+        log.removeHandler(queue_handler)
+        for handler in listener.handlers:
+            log.addHandler(handler)
+
+atexit.register(shutdown)
+
+def enabled(log: logging.Logger, event: str, level: int = logging.DEBUG) -> bool:
+    """Whether a hot-path event should be logged: its level is enabled and it
+    falls inside the event's sample rate (MESSENGER_LOG_SAMPLE)."""
+    if not log.isEnabledFor(level):
+        return False
+    rate = sample_rates.get(event)
+    return rate is None or random.random() < rate
+
+def redact(value) -> str:
+    """Message text, keys and recovery shares as they may appear in logs."""
+    if LOG_CONTENT:
+        return str(value)
+    if value is None:
+        return "None"
+    return f"<redacted {len(str(value))} chars>"
@@ -1,10 +1,12 @@
+import asyncio
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from server.routes import auth, messages, chats, users, groups
-from server.websocket import router as websocket_router
-from starlette.responses import JSONResponse
+from server.routes import auth, messages, chats, users, groups, inbox, admin
+from server.websocket import router as websocket_router, manager
+from starlette.responses import JSONResponse, Response
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from fastapi.staticfiles import StaticFiles
+from server import logs, metrics, slow_queries, storage, uploads, voice
 
 app = FastAPI()
 
@@ -30,6 +32,8 @@ app.include_router(websocket_router, prefix="")
 app.include_router(chats.router, prefix="/chats", tags=["chats"])
 app.include_router(users.router, prefix="/users", tags=["users"])
 app.include_router(groups.router, prefix="/groups", tags=["groups"])
+app.include_router(inbox.router, prefix="/inbox", tags=["inbox"])
+app.include_router(admin.router, prefix="/admin", tags=["admin"])
 app.add_middleware(TrustedHostMiddleware, allowed_hosts=["*"])
 app.add_middleware(
     CORSMiddleware,
@@ -38,7 +42,28 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(slow_queries.RouteContextMiddleware)
+# Outermost, so the latency covers the other middleware too
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.register_collector(manager.socket_gauges)
+
+@app.on_event("startup")
+async def start_background_jobs():
+    logs.setup()
+    await storage.repos.start()
+    app.state.upload_expirer = asyncio.create_task(uploads.run_expirer())
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    app.state.upload_expirer.cancel()
+    await storage.repos.stop()
+    voice.shutdown()
+    logs.shutdown()
 
 @app.get("/")
 def root():
     return {"Server is running"}
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
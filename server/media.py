@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+import uuid
+from pathlib import Path
+from server import archive, history_cache, shards, storage
+from server.database import get_connection
+from server.message_store import bump_chat_versions
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Uploaded files are stored two directory levels below their kind, named by
+# the first four hex digits of the SHA-256 of the stored name:
+#
+#   static/uploads/3f/a2/<uuid>_<file name>    file messages
+#   static/vm/...                              voice messages
+#   static/avatars/...                         avatars
+#
+# so no directory grows past a few thousand entries. Files stored before
+# this sit directly in the kind's directory (and avatars uploaded through
+# /auth/me/avatar in one directory per username); LayoutMigration moves them
+# while the server runs:
+#
+#   POST /admin/media/migrate    on a running server, which also updates its history cache
+#   python -m server.media       with the server stopped
+#
+# Each batch links the files into the new layout, rewrites their URLs in one
+# transaction and bumps the history versions. Messages already moved to the
+# archive keep their old URLs, and several messages can share a file, so the
+# old names are only removed at the end of the run, for the files no hot or
+# archived message points at any more. The others stay as a second hard link
+# until the orphaned file collector (server/media_gc.py) finds them unused.
+
+STATIC_DIR = Path("static")
+KINDS = ("uploads", "vm", "avatars")
+DEFAULT_AVATAR = "/static/avatars/default.jpg"
+MIGRATE_BATCH_SIZE = 200
+MIGRATE_PAUSE_SECONDS = 0.05
+
+FANNED_OUT_URL = re.compile(r"/static/(uploads|vm|avatars)/[0-9a-f]{2}/[0-9a-f]{2}/[^/]+")
+
+def stored_name(filename: str) -> str:
+    """A unique name for an uploaded file that keeps its original name readable."""
+    return f"{uuid.uuid4()}_{Path(filename).name}"
+
+def relative_path(kind: str, name: str) -> str:
+    digest = hashlib.sha256(name.encode()).hexdigest()
+    return f"{kind}/{digest[:2]}/{digest[2:4]}/{name}"
+
+def url_of(relative: str) -> str:
+    return f"/static/{relative}"
+
+def path_of(url: str) -> Path:
+    """The file behind a /static URL."""
+    return STATIC_DIR / url.removeprefix("/static/")
+
+def destination(kind: str, filename: str) -> tuple[Path, str]:
+    """Path to store a new upload at, with its parent directories created, and its URL."""
+    relative = relative_path(kind, stored_name(filename))
+    path = STATIC_DIR / relative
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path, url_of(relative)
+
+def save(kind: str, filename: str, content: bytes) -> tuple[Path, str]:
+    path, url = destination(kind, filename)
+    with path.open("wb") as buffer:
+        buffer.write(content)
+    return path, url
+
+def relocated_url(url: str | None) -> str | None:
+    """The URL a file stored in the old flat layout gets in the new one, or
+    None if it is not a stored upload or already fanned out."""
+    if not url or url == DEFAULT_AVATAR or FANNED_OUT_URL.fullmatch(url):
+        return None
+    kind, _, rest = url.removeprefix("/static/").partition("/")
+    if kind not in KINDS or not rest or ".." in rest.split("/"):
+        return None
+    # Per-username avatar directories flatten into the name: avatars/alice/me.png -> alice_me.png
+    return url_of(relative_path(kind, rest.replace("/", "_")))
+
+def link(old_url: str, new_url: str) -> bool:
+    """Make the file at old_url also reachable at new_url. False if it is gone."""
+    source, target = path_of(old_url), path_of(new_url)
+    if target.exists():
+        return True
+    if not source.exists():
+        return False
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+    return True
+
+def urls_in_use(urls: set[str]) -> set[str]:
+    """Those of `urls` that a hot or archived message on any shard points at."""
+    in_use = set()
+    for shard in shards.all_shards():
+        conn = shards.connect_shard(shard)
+        try:
+            in_use.update(row["file_url"] for row in conn.execute("SELECT file_url FROM messages WHERE type = 'file'")
+                          if row["file_url"] in urls)
+            # Listed after reading the hot table: a message archived since is in one of these
+            months = conn.execute("""
+                SELECT DISTINCT a.month, COALESCE(f.sealed, 0) AS sealed
+                FROM archived_chunks a LEFT JOIN archive_files f ON f.month = a.month
+            """).fetchall()
+        finally:
+            conn.close()
+        for month in months:
+            in_use.update(row["file_url"] for row in archive.file_urls(shard, month["month"], bool(month["sealed"]))
+                          if row["file_url"] in urls)
+    return in_use
+
+def remove_unused(urls: set[str]) -> int:
+    """Remove the old names of moved files that no message points at any more.
+    Returns the number kept."""
+    in_use = urls_in_use(urls)
+    for url in urls - in_use:
+        unlink(url)
+    return len(in_use)
+
+def unlink(url: str):
+    path = path_of(url)
+    path.unlink(missing_ok=True)
+    # Per-username avatar directories are left empty by the last move
+    if path.parent.parent == STATIC_DIR / "avatars":
+        try:
+            path.parent.rmdir()
+        except OSError:
+            pass
+
+def migrate_messages_batch(shard: int, after_id: int) -> tuple[int | None, list[int], list[str]]:
+    """Move the files of the next batch of a shard's file messages with id > after_id.
+
+    Returns the id to continue after (None when the shard is done), the chats
+    whose messages changed and the old URLs of the messages moved. The old
+    names are left in place; see remove_unused.
+    """
+    conn = shards.connect_shard(shard)
+    try:
+        rows = conn.execute("""
+            SELECT id, chat_id, file_url FROM messages WHERE id > ? AND type = 'file' ORDER BY id LIMIT ?
+        """, (after_id, MIGRATE_BATCH_SIZE)).fetchall()
+        if not rows:
+            return None, [], []
+        moves = []
+        for row in rows:
+            new_url = relocated_url(row["file_url"])
+            if new_url is not None and link(row["file_url"], new_url):
+                moves.append((row, new_url))
+
+        done = []
+        cursor = conn.cursor()
+        try:
+            for row, new_url in moves:
+                # Skips messages edited into text, deleted or archived since they were
+                # read; their new name may be shared with other messages, so it stays
+                cursor.execute("UPDATE messages SET file_url = ? WHERE id = ? AND file_url = ?",
+                               (new_url, row["id"], row["file_url"]))
+                if cursor.rowcount:
+                    done.append(row)
+            chat_ids = sorted({row["chat_id"] for row in done})
+            bump_chat_versions(cursor, chat_ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return rows[-1]["id"], chat_ids, [row["file_url"] for row in done]
+    finally:
+        conn.close()
+
+def avatars_after(after_id: int) -> list[dict]:
+    conn = get_connection()
+    try:
+        rows = conn.execute("""
+            SELECT id, avatar_url FROM users WHERE id > ? AND avatar_url IS NOT NULL ORDER BY id LIMIT ?
+        """, (after_id, MIGRATE_BATCH_SIZE)).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+class LayoutMigration:
+    def __init__(self):
+        self.running = False
+        self.moved = {"files": 0, "avatars": 0}
+        self.error = None
+        self.task = None
+
+    def start(self) -> bool:
+        """Run in the background unless a run is in progress. Returns whether it started."""
+        if self.running:
+            return False
+        # Marked before the task first runs, so a second request cannot start another
+        self.running = True
+        self.task = asyncio.create_task(self.run())
+        return True
+
+    def status(self) -> dict:
+        return {"running": self.running, "moved": dict(self.moved), "error": self.error}
+
+    async def run(self):
+        """Move every stored upload into the fanned-out layout, batch by batch.
+
+        Safe to run again: files already moved are skipped, so an
+        interrupted run simply starts over.
+        """
+        self.running = True
+        self.moved = {"files": 0, "avatars": 0}
+        self.error = None
+        try:
+            moved_from = set()
+            for shard in shards.all_shards():
+                after_id = 0
+                while after_id is not None:
+                    after_id, chat_ids, old_urls = await asyncio.to_thread(migrate_messages_batch, shard, after_id)
+                    for chat_id in chat_ids:
+                        history_cache.cache.drop_chat(chat_id)
+                    moved_from.update(old_urls)
+                    self.moved["files"] += len(old_urls)
+                    await asyncio.sleep(MIGRATE_PAUSE_SECONDS)
+            kept = await asyncio.to_thread(remove_unused, moved_from)
+            if kept:
+                logger.info(f"Kept the old names of {kept} moved files that messages still point at")
+
+            after_id = 0
+            while users := await asyncio.to_thread(avatars_after, after_id):
+                for user in users:
+                    new_url = relocated_url(user["avatar_url"])
+                    if new_url is None or not await asyncio.to_thread(link, user["avatar_url"], new_url):
+                        continue
+                    if await storage.repos.users.replace_avatar_url(user["id"], user["avatar_url"], new_url):
+                        history_cache.cache.set_avatar(user["id"], new_url)
+                        await asyncio.to_thread(unlink, user["avatar_url"])
+                        self.moved["avatars"] += 1
+                    else:
+                        await asyncio.to_thread(unlink, new_url)
+                after_id = users[-1]["id"]
+                await asyncio.sleep(MIGRATE_PAUSE_SECONDS)
+            logger.info(f"Moved {self.moved['files']} files and {self.moved['avatars']} avatars to the new layout")
+        except Exception as e:
+            self.error = str(e)
+            logger.error(f"Error while moving files to the new layout: {e}")
+        finally:
+            self.running = False
+
+layout_migration = LayoutMigration()
+
+if __name__ == "__main__":
+    from server import migrations
+    migrations.migrate()
+    asyncio.run(layout_migration.run())
+    shards.shutdown()
+    print(layout_migration.status())
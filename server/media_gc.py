@@ -0,0 +1,314 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from server import archive, media, metrics, shards
+from server.database import get_connection
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Collector for stored files nothing refers to any more. Deleting a message,
+# a chat or a group, or replacing an avatar, only removes rows; the files
+# stay in static/uploads, static/vm and static/avatars. A pass:
+#
+#   1. marks every file URL still in use: the messages of each shard, then
+#      the archive files (only the chats that still have chunks there), then
+#      users.avatar_url. A flat-layout URL also marks where LayoutMigration
+#      moves it, so a migration running meanwhile cannot orphan a live file.
+#   2. sweeps the three directories in path order and deletes the unmarked
+#      files older than the grace period. Each batch is first checked against
+#      the messages stored since their shard was marked, because a WebSocket
+#      file frame can point a new message at an existing file.
+#
+# Marks and the position of the pass are saved after every batch, so a pass
+# interrupted by a restart carries on where it stopped.
+#
+#   MESSENGER_MEDIA_GC_DB         checkpoint database (default server/media_gc.db)
+#   MESSENGER_MEDIA_GC_GRACE      seconds a new file is kept, referenced or not (default 86400)
+#   MESSENGER_MEDIA_GC_INTERVAL   seconds from the end of one pass to the next (default 86400, 0 only on request)
+
+GC_DB_PATH = os.environ.get("MESSENGER_MEDIA_GC_DB", "server/media_gc.db")
+GC_GRACE_SECONDS = float(os.environ.get("MESSENGER_MEDIA_GC_GRACE", "86400"))
+GC_INTERVAL_SECONDS = float(os.environ.get("MESSENGER_MEDIA_GC_INTERVAL", "86400"))
+GC_MARK_BATCH_SIZE = 5000
+GC_SWEEP_BATCH_SIZE = 500
+GC_PAUSE_SECONDS = 0.2
+GC_IDLE_SECONDS = 600
+GC_LOCK_TIMEOUT_SECONDS = 60
+
+DELETED = metrics.Counter("media_gc_deleted_files_total", "Stored files deleted because nothing referred to them.")
+RECLAIMED = metrics.Counter("media_gc_reclaimed_bytes_total", "Bytes freed by deleting unreferenced stored files.")
+
+_wake = asyncio.Event()
+
+def connect():
+    conn = sqlite3.connect(GC_DB_PATH, timeout=GC_LOCK_TIMEOUT_SECONDS)
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE IF NOT EXISTS marks (url TEXT PRIMARY KEY) WITHOUT ROWID")
+    conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    conn.commit()
+    return conn
+
+def _get(conn, key: str) -> dict | None:
+    row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return json.loads(row["value"]) if row else None
+
+def _put(conn, key: str, value: dict):
+    conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+def notify():
+    _wake.set()
+
+def _legacy_messages_pending() -> bool:
+    """Messages still in the metadata database after raising SHARD_COUNT, which no pass would mark."""
+    if shards.SHARD_COUNT == 1:
+        return False
+    conn = get_connection()
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages'").fetchone():
+            return False
+        return conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is not None
+    finally:
+        conn.close()
+
+def _start(conn) -> bool:
+    if _get(conn, "checkpoint") is not None:
+        return False
+    if _legacy_messages_pending():
+        logger.warning("Not collecting orphaned files: run `python -m server.shards` to move the legacy messages first")
+        return False
+    conn.execute("DELETE FROM marks")
+    _put(conn, "checkpoint", {
+        "phase": "messages", "shard": 0, "after": 0, "marked_to": {},
+        "started_at": time.time(), "deleted_files": 0, "reclaimed_bytes": 0
+    })
+    return True
+
+def _in_transaction(fn):
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        result = fn(conn)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def start_pass() -> bool:
+    """Start a pass unless one is in progress. Returns whether it started."""
+    return _in_transaction(_start)
+
+def pass_due() -> bool:
+    """Whether a pass is in progress, starting one if the last finished an interval ago."""
+    def due(conn):
+        if _get(conn, "checkpoint") is not None:
+            return True
+        last = _get(conn, "last_pass")
+        if GC_INTERVAL_SECONDS <= 0 or (last and time.time() < last["finished_at"] + GC_INTERVAL_SECONDS):
+            return False
+        return _start(conn)
+    return _in_transaction(due)
+
+def _mark(conn, urls):
+    conn.executemany("INSERT OR IGNORE INTO marks (url) VALUES (?)",
+                     [(marked,) for url in urls if url for marked in (url, media.relocated_url(url)) if marked])
+
+def _advance(checkpoint: dict, next_phase: str, start):
+    """Move on to the next shard of the phase, or to the first shard of the next phase."""
+    if checkpoint["phase"] != "avatars" and checkpoint["shard"] + 1 < shards.SHARD_COUNT:
+        checkpoint["shard"] += 1
+        checkpoint["after"] = 0 if checkpoint["phase"] == "messages" else ""
+    else:
+        checkpoint.update(phase=next_phase, shard=0, after=start)
+
+def _mark_messages(conn, checkpoint: dict):
+    shard = checkpoint["shard"]
+    source = shards.connect_shard(shard)
+    try:
+        # Bounded by id rather than by file rows, so each batch reads at most GC_MARK_BATCH_SIZE rows
+        rows = source.execute("SELECT id, file_url FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+                              (checkpoint["after"], GC_MARK_BATCH_SIZE)).fetchall()
+    finally:
+        source.close()
+    if rows:
+        _mark(conn, [row["file_url"] for row in rows])
+        checkpoint["after"] = rows[-1]["id"]
+        return
+    # Messages stored after this are checked again before the sweep deletes anything
+    checkpoint["marked_to"][str(shard)] = checkpoint["after"]
+    _advance(checkpoint, "archive", "")
+
+def _mark_archive(conn, checkpoint: dict):
+    shard = checkpoint["shard"]
+    source = shards.connect_shard(shard)
+    try:
+        chunks = source.execute("""
+            SELECT a.month, a.chat_id, COALESCE(f.sealed, 0) AS sealed
+            FROM archived_chunks a LEFT JOIN archive_files f ON f.month = a.month
+            WHERE a.month = (SELECT MIN(month) FROM archived_chunks WHERE month > ?)
+        """, (checkpoint["after"],)).fetchall()
+    finally:
+        source.close()
+    if chunks:
+        month = chunks[0]["month"]
+        # Sealed archive files keep the messages of purged chats, whose chunks are gone
+        chat_ids = {chunk["chat_id"] for chunk in chunks}
+        rows = archive.file_urls(shard, month, bool(chunks[0]["sealed"]))
+        _mark(conn, [row["file_url"] for row in rows if row["chat_id"] in chat_ids])
+        checkpoint["after"] = month
+        return
+    _advance(checkpoint, "avatars", 0)
+
+def _mark_avatars(conn, checkpoint: dict):
+    source = get_connection()
+    try:
+        rows = source.execute("SELECT id, avatar_url FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                              (checkpoint["after"], GC_MARK_BATCH_SIZE)).fetchall()
+    finally:
+        source.close()
+    if rows:
+        _mark(conn, [row["avatar_url"] for row in rows])
+        checkpoint["after"] = rows[-1]["id"]
+        return
+    _advance(checkpoint, "sweep", [])
+
+def _walk(directory: Path, parts: tuple, after: tuple):
+    # Skip subtrees that sort entirely before `after`
+    if parts < after[:len(parts)]:
+        return
+    try:
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        entry_parts = parts + (entry.name,)
+        if entry.is_dir(follow_symlinks=False):
+            yield from _walk(Path(entry.path), entry_parts, after)
+        elif entry.is_file(follow_symlinks=False) and entry_parts > after:
+            yield entry_parts
+
+def stored_files(after: tuple = ()):
+    """Paths under STATIC_DIR of the stored files after `after`, as tuples of parts, in path order."""
+    for kind in sorted(media.KINDS):
+        yield from _walk(media.STATIC_DIR / kind, (kind,), after)
+
+def _referenced_since_mark(marked_to: dict, urls: list[str]) -> set[str]:
+    found = set()
+    for shard, after_id in marked_to.items():
+        source = shards.connect_shard(int(shard))
+        try:
+            rows = source.execute(f"SELECT file_url FROM messages WHERE id > ? AND file_url IN ({', '.join('?' * len(urls))})",
+                                  (after_id, *urls)).fetchall()
+            found.update(row["file_url"] for row in rows)
+        finally:
+            source.close()
+    return found
+
+def _sweep(conn, checkpoint: dict) -> bool:
+    """Delete the unreferenced files of the next batch. Returns True when the sweep is done."""
+    batch = list(itertools.islice(stored_files(tuple(checkpoint["after"])), GC_SWEEP_BATCH_SIZE))
+    if not batch:
+        return True
+    cutoff = time.time() - GC_GRACE_SECONDS
+    candidates = {}
+    for parts in batch:
+        url = media.url_of("/".join(parts))
+        if url == media.DEFAULT_AVATAR:
+            continue
+        try:
+            stat = media.path_of(url).stat()
+        except FileNotFoundError:
+            continue
+        if stat.st_mtime < cutoff:
+            candidates[url] = stat.st_size
+    if candidates:
+        urls = list(candidates)
+        marked = conn.execute(f"SELECT url FROM marks WHERE url IN ({', '.join('?' * len(urls))})", urls).fetchall()
+        for url in {row["url"] for row in marked} | _referenced_since_mark(checkpoint["marked_to"], urls):
+            candidates.pop(url, None)
+        for url in candidates:
+            media.unlink(url)
+        reclaimed = sum(candidates.values())
+        checkpoint["deleted_files"] += len(candidates)
+        checkpoint["reclaimed_bytes"] += reclaimed
+        DELETED.inc(amount=len(candidates))
+        RECLAIMED.inc(amount=reclaimed)
+    checkpoint["after"] = list(batch[-1])
+    return False
+
+MARK_PHASES = {"messages": _mark_messages, "archive": _mark_archive, "avatars": _mark_avatars}
+
+def step() -> bool:
+    """Run one batch of the pass in progress. Returns True once there is none left."""
+    def run(conn):
+        checkpoint = _get(conn, "checkpoint")
+        if checkpoint is None:
+            return True
+        if checkpoint["phase"] in MARK_PHASES:
+            MARK_PHASES[checkpoint["phase"]](conn, checkpoint)
+        elif _sweep(conn, checkpoint):
+            last = {key: checkpoint[key] for key in ("started_at", "deleted_files", "reclaimed_bytes")}
+            _put(conn, "last_pass", {**last, "finished_at": time.time()})
+            conn.execute("DELETE FROM state WHERE key = 'checkpoint'")
+            conn.execute("DELETE FROM marks")
+            logger.info(f"Deleted {last['deleted_files']} orphaned files, reclaiming {last['reclaimed_bytes']} bytes")
+            return True
+        _put(conn, "checkpoint", checkpoint)
+        return False
+    return _in_transaction(run)
+
+def _timestamp(value: float | None) -> str | None:
+    return datetime.fromtimestamp(value, timezone.utc).isoformat() if value is not None else None
+
+def status() -> dict:
+    conn = connect()
+    try:
+        checkpoint, last = _get(conn, "checkpoint"), _get(conn, "last_pass")
+    finally:
+        conn.close()
+    current = None
+    if checkpoint is not None:
+        current = {
+            "phase": checkpoint["phase"], "shard": checkpoint["shard"], "started_at": _timestamp(checkpoint["started_at"]),
+            "deleted_files": checkpoint["deleted_files"], "reclaimed_bytes": checkpoint["reclaimed_bytes"]
+        }
+    if last is not None:
+        last = {**last, "started_at": _timestamp(last["started_at"]), "finished_at": _timestamp(last["finished_at"])}
+    return {"running": checkpoint is not None, "current": current, "last": last}
+
+async def run_pass():
+    while not await asyncio.to_thread(step):
+        await asyncio.sleep(GC_PAUSE_SECONDS)
+
+async def run_collector():
+    """Background task: resume an interrupted pass, then run one every MESSENGER_MEDIA_GC_INTERVAL."""
+    while True:
+        _wake.clear()
+        try:
+            if await asyncio.to_thread(pass_due):
+                await run_pass()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error while collecting orphaned files: {e}")
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=GC_IDLE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+if __name__ == "__main__":
+    from server import migrations
+    migrations.migrate()
+    start_pass()
+    while not step():
+        pass
+    print(status())
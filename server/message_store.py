@@ -0,0 +1,169 @@
+import json
+from datetime import datetime
+from server import archive, inbox, shards
+from server.repositories.base import DuplicateMessageError, MessageStoreError, QuotaExceededError
+
+# Message writes. Every function takes a cursor on the chat's shard and is
+# meant to be run through `shards.write(chat_id, fn, ...)`, which commits the
+# message row and its inbox summary updates in one transaction.
+
+def insert_message(cursor, chat_id: int, sender_id: int, sender_name: str, content: str,
+                   reply_to: int | None = None, attachment: dict | None = None, timestamp: str | None = None,
+                   client_msg_id: str | None = None, user_quota: int | None = None,
+                   chat_quota: int | None = None) -> int:
+    """Insert a text message, or a file message if `attachment` ({file_url,
+    file_name, file_type, file_size}, plus duration_ms and waveform for voice
+    messages) is given; `content` is then the file name.
+    `timestamp` defaults to CURRENT_TIMESTAMP. A `client_msg_id` the sender
+    already used in the chat raises DuplicateMessageError with the stored id;
+    a file taking the sender past `user_quota` or the chat past `chat_quota`
+    bytes raises QuotaExceededError."""
+    attachment = attachment or {}
+    message_type = "file" if attachment else "message"
+    cursor.execute(f"""
+        INSERT INTO messages (id, chat_id, sender_id, sender_name, content, timestamp, reply_to,
+                              type, file_url, file_name, file_type, file_size, duration_ms, waveform, client_msg_id)
+        VALUES ({shards.next_message_id_sql(shards.shard_for(chat_id))}, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP),
+                ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (chat_id, sender_id, client_msg_id) WHERE client_msg_id IS NOT NULL DO NOTHING
+    """, (chat_id, sender_id, sender_name, content, timestamp, reply_to, message_type, attachment.get("file_url"),
+          attachment.get("file_name"), attachment.get("file_type"), attachment.get("file_size"),
+          attachment.get("duration_ms"), attachment.get("waveform"), client_msg_id))
+    if not cursor.rowcount:
+        cursor.execute("SELECT id FROM messages WHERE chat_id = ? AND sender_id = ? AND client_msg_id = ?",
+                       (chat_id, sender_id, client_msg_id))
+        raise DuplicateMessageError(cursor.fetchone()["id"])
+    message_id = cursor.lastrowid
+    if attachment:
+        add_usage(cursor, chat_id, sender_id, attachment.get("file_size"))
+        check_quotas(cursor, chat_id, sender_id, attachment.get("file_size"), user_quota, chat_quota)
+    bump_chat_versions(cursor, [chat_id])
+    inbox.record_message(cursor, chat_id, sender_id, sender_name, message_id, content, message_type, attachment.get("file_type"))
+    return message_id
+
+def bump_chat_versions(cursor, chat_ids: list[int]):
+    """Invalidate the history ETags of the chats; call in the transaction that changed them."""
+    cursor.executemany("""
+        INSERT INTO chat_versions (chat_id, version) VALUES (?, 1)
+        ON CONFLICT (chat_id) DO UPDATE SET version = version + 1
+    """, [(chat_id,) for chat_id in chat_ids])
+
+def add_usage(cursor, chat_id: int, sender_id: int, file_size, sign: int = 1):
+    """Count a file message against its sender's and its chat's storage; sign=-1 releases it."""
+    for table, key, owner_id in (("user_storage", "user_id", sender_id), ("chat_storage", "chat_id", chat_id)):
+        cursor.execute(f"""
+            INSERT INTO {table} ({key}, bytes, files) VALUES (?, ? * COALESCE(CAST(? AS INTEGER), 0), ?)
+            ON CONFLICT ({key}) DO UPDATE SET bytes = bytes + excluded.bytes, files = files + excluded.files
+        """, (owner_id, sign, file_size, sign))
+
+def check_quotas(cursor, chat_id: int, sender_id: int, file_size, user_quota: int | None, chat_quota: int | None):
+    """Raise QuotaExceededError if the file just counted by add_usage took its
+    sender or its chat past a quota. The counters were written first, so this
+    transaction holds the shard's write lock and concurrent uploads to the
+    shard are checked one after the other."""
+    file_size = int(file_size or 0)
+    if user_quota is not None:
+        cursor.execute("SELECT bytes FROM user_storage WHERE user_id = ?", (sender_id,))
+        used = cursor.fetchone()["bytes"] + _user_bytes_elsewhere(shards.shard_for(chat_id), sender_id)
+        if used > user_quota:
+            raise QuotaExceededError("user", used - file_size, user_quota)
+    if chat_quota is not None:
+        cursor.execute("SELECT bytes FROM chat_storage WHERE chat_id = ?", (chat_id,))
+        used = cursor.fetchone()["bytes"]
+        if used > chat_quota:
+            raise QuotaExceededError("chat", used - file_size, chat_quota)
+
+def _user_bytes_elsewhere(shard: int, user_id: int) -> int:
+    # Committed usage only: files going into other shards at this moment are not seen
+    total = 0
+    for other in shards.all_shards():
+        if other == shard:
+            continue
+        conn = shards.connect_shard(other)
+        try:
+            row = conn.execute("SELECT bytes FROM user_storage WHERE user_id = ?", (user_id,)).fetchone()
+        finally:
+            conn.close()
+        total += row["bytes"] if row else 0
+    return total
+
+def _not_found(cursor, chat_id: int, message_id: int, error: str) -> MessageStoreError:
+    # Archived messages are read-only
+    if archive.holds(cursor, chat_id, message_id):
+        return MessageStoreError("Message is archived and can no longer be changed")
+    return MessageStoreError(error)
+
+def _authored_message(cursor, chat_id: int, message_id: int, user_id: int):
+    cursor.execute("SELECT sender_id, type, file_size, read_by FROM messages WHERE id = ? AND chat_id = ?",
+                   (message_id, chat_id))
+    message = cursor.fetchone()
+    if not message:
+        raise _not_found(cursor, chat_id, message_id, "You are not the author of this message")
+    if message["sender_id"] != user_id:
+        raise MessageStoreError("You are not the author of this message")
+    return message
+
+def edit_message(cursor, chat_id: int, message_id: int, user_id: int, content: str):
+    message = _authored_message(cursor, chat_id, message_id, user_id)
+    if message["type"] == "file":
+        add_usage(cursor, chat_id, user_id, message["file_size"], -1)
+    # Editing a file message replaces it with text, as it always has
+    cursor.execute("""
+        UPDATE messages SET content = ?, edited_at = CURRENT_TIMESTAMP,
+            type = 'message', file_url = NULL, file_name = NULL, file_type = NULL, file_size = NULL,
+            duration_ms = NULL, waveform = NULL
+        WHERE id = ?
+    """, (content, message_id))
+    bump_chat_versions(cursor, [chat_id])
+    inbox.record_edit(cursor, chat_id, message_id, content)
+
+def delete_message(cursor, chat_id: int, message_id: int, user_id: int):
+    message = _authored_message(cursor, chat_id, message_id, user_id)
+    if message["type"] == "file":
+        add_usage(cursor, chat_id, user_id, message["file_size"], -1)
+    cursor.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+    bump_chat_versions(cursor, [chat_id])
+    inbox.record_delete(cursor, chat_id, message_id, message["sender_id"], message["read_by"])
+
+def _reactions(cursor, chat_id: int, message_id: int) -> list:
+    cursor.execute("SELECT reactions FROM messages WHERE id = ? AND chat_id = ?", (message_id, chat_id))
+    result = cursor.fetchone()
+    if not result:
+        raise _not_found(cursor, chat_id, message_id, "Message not found")
+    return json.loads(result["reactions"]) if result["reactions"] else []
+
+def add_reaction(cursor, chat_id: int, message_id: int, user_id: int, reaction: str):
+    reactions = _reactions(cursor, chat_id, message_id)
+    if any(r["user_id"] == user_id and r["reaction"] == reaction for r in reactions):
+        raise MessageStoreError("You already reacted with this reaction")
+    reactions.append({"user_id": user_id, "reaction": reaction})
+    cursor.execute("UPDATE messages SET reactions = ? WHERE id = ?", (json.dumps(reactions), message_id))
+    bump_chat_versions(cursor, [chat_id])
+
+def remove_reaction(cursor, chat_id: int, message_id: int, user_id: int, reaction: str):
+    reactions = _reactions(cursor, chat_id, message_id)
+    if not any(r["user_id"] == user_id and r["reaction"] == reaction for r in reactions):
+        raise MessageStoreError("You cannot remove this reaction")
+    new_reactions = [r for r in reactions if not (r["user_id"] == user_id and r["reaction"] == reaction)]
+    cursor.execute("UPDATE messages SET reactions = ? WHERE id = ?", (json.dumps(new_reactions), message_id))
+    bump_chat_versions(cursor, [chat_id])
+
+def mark_read(cursor, chat_id: int, message_id: int, user_id: int) -> str | None:
+    """Record a read receipt. Returns its read_at, or None if the user had already read the message."""
+    cursor.execute("SELECT sender_id, read_by FROM messages WHERE id = ? AND chat_id = ?", (message_id, chat_id))
+    message = cursor.fetchone()
+    if not message:
+        raise _not_found(cursor, chat_id, message_id, "Message not found")
+    if message["sender_id"] == user_id:
+        raise MessageStoreError("Cannot mark own message as read")
+
+    read_by = json.loads(message["read_by"]) if message["read_by"] else []
+    if any(r["user_id"] == user_id for r in read_by):
+        return None
+
+    read_at = datetime.utcnow().isoformat()
+    read_by.append({"user_id": user_id, "read_at": read_at})
+    cursor.execute("UPDATE messages SET read_by = ? WHERE id = ?", (json.dumps(read_by), message_id))
+    bump_chat_versions(cursor, [chat_id])
+    inbox.record_read(cursor, chat_id, user_id)
+    return read_at
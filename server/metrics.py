@@ -0,0 +1,192 @@
+import inspect
+import time
+from bisect import bisect_left
+
+# Minimal Prometheus instrumentation: counters and histograms updated in
+# place (an observation is one bisect and two additions), gauges computed by
+# collectors at scrape time, and the text exposition format for /metrics.
+# Updates happen on the event loop, so no locking is needed.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 512 * 1024, 1024 ** 2, 5 * 1024 ** 2, 10 * 1024 ** 2, 50 * 1024 ** 2)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+_metrics = []
+_collectors = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # { labels: [per-bucket counts..., +Inf count, sum] }
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), series):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(series[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+def register_collector(collector):
+    """Add a function called at scrape time that returns gauge samples:
+    [(name, documentation, [(labels dict, value), ...]), ...]"""
+    _collectors.append(collector)
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        for name, documentation, samples in collector():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels.keys(), labels.values())} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template.", ["method", "route", "status"]
+)
+WS_BROADCAST_DURATION = Histogram(
+    "ws_broadcast_duration_seconds", "Time to encode and send one broadcast to every socket of a chat."
+)
+WS_BROADCAST_RECIPIENTS = Histogram(
+    "ws_broadcast_recipients", "Sockets reached by one broadcast.", buckets=COUNT_BUCKETS
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Storage call latency, thread hand-off included.", ["repo", "method"]
+)
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "Storage calls that raised.", ["repo", "method"])
+UPLOAD_SIZE = Histogram("upload_size_bytes", "Size of uploaded files.", ["kind"], buckets=SIZE_BUCKETS)
+AUTH_FAILURES = Counter("auth_failures_total", "Rejected logins and tokens.", ["reason"])
+
+def instrument_repository(repo_name: str):
+    """Class decorator timing every public async method into DB_QUERY_DURATION."""
+    def decorate(cls):
+        for attr, fn in list(vars(cls).items()):
+            if attr.startswith("_") or not inspect.iscoroutinefunction(fn):
+                continue
+            setattr(cls, attr, _timed(fn, repo_name, attr))
+        return cls
+    return decorate
+
+def _timed(fn, repo_name: str, method: str):
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            DB_QUERY_ERRORS.inc(repo_name, method)
+            raise
+        finally:
+            DB_QUERY_DURATION.observe(time.perf_counter() - start, repo_name, method)
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+
+class MetricsMiddleware:
+    """Plain ASGI middleware recording HTTP_REQUEST_DURATION.
+
+    Requests are labelled with the matched route template, not the raw path,
+    so the number of series stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - start, scope["method"], route_template(scope), str(status)
+            )
+
+def route_template(scope) -> str:
+    """`/messages/history/{chat_id}` for `/messages/history/42`; "other" for
+    static files and unmatched paths."""
+    route = scope.get("route")
+    if route is None:
+        return "other"
+    # Depending on the FastAPI version the route carries the router prefix or
+    # not; the prefix segments are taken from the request path either way.
+    template = [part for part in route.path.split("/") if part]
+    segments = [part for part in scope["path"].split("/") if part]
+    return "/" + "/".join(segments[:max(len(segments) - len(template), 0)] + template)
@@ -0,0 +1,345 @@
+import logging
+import os
+import time
+from server import archive, shards
+from server.database import (
+    ATTACHMENT_COLUMNS, DB_PATH, add_columns, backfill_chat_summaries, backfill_storage_usage, get_connection,
+    migrate_attachments
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Versioned schema migrations, applied from the startup hook (see
+# SQLiteRepositories.start) or by hand with `python -m server.migrations`.
+#
+# Every database file records the last migration applied to it in
+# PRAGMA user_version. A step has a metadata part (users, chats, ...) and a
+# message store part (messages and the per-chat tables next to them); the
+# metadata database runs the first, every shard the second, and with one
+# shard DB_PATH runs both. Pending steps run once, inside a BEGIN IMMEDIATE
+# transaction, so workers starting together wait for the first one instead of
+# migrating twice. An up-to-date file costs one PRAGMA read and no write.
+#
+# Append new steps to MIGRATIONS; never change one that has shipped.
+
+# How long a worker waits for another one that is migrating the same file
+MIGRATION_LOCK_TIMEOUT_SECONDS = float(os.environ.get("MESSENGER_MIGRATION_LOCK_TIMEOUT", "600"))
+
+def metadata_v1(cursor):
+    """Bring an install from before versioned migrations (user_version 0) up to date."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            avatar_url TEXT,
+            bio TEXT,
+            encrypted_cloud_part TEXT,
+            salt BLOB,
+            verification_ciphertext TEXT
+        )
+    """)
+    add_columns(cursor, "users", [
+        ("avatar_url", "TEXT"),
+        ("bio", "TEXT"),
+        ("encrypted_cloud_part", "TEXT"),
+        ("salt", "BLOB"),
+        ("verification_ciphertext", "TEXT")
+    ])
+
+    # Direct chats have user1_id/user2_id, groups leave them NULL
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL DEFAULT 'one-on-one',
+            user1_id INTEGER,
+            user2_id INTEGER,
+            deleted_at DATETIME DEFAULT NULL,
+            FOREIGN KEY (user1_id) REFERENCES users (id),
+            FOREIGN KEY (user2_id) REFERENCES users (id)
+        )
+    """)
+    add_columns(cursor, "chats", [
+        ("type", "TEXT NOT NULL DEFAULT 'one-on-one'"),
+        # Tombstone for chats whose rows are purged in the background
+        ("deleted_at", "DATETIME DEFAULT NULL")
+    ])
+    cursor.execute("PRAGMA table_info(chats)")
+    if any(col["name"] in ("user1_id", "user2_id") and col["notnull"] for col in cursor.fetchall()):
+        # SQLite cannot drop NOT NULL in place, so the oldest layout is rebuilt
+        cursor.execute("""
+            CREATE TABLE chats_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                type TEXT NOT NULL DEFAULT 'one-on-one',
+                user1_id INTEGER,
+                user2_id INTEGER,
+                deleted_at DATETIME DEFAULT NULL,
+                FOREIGN KEY (user1_id) REFERENCES users (id),
+                FOREIGN KEY (user2_id) REFERENCES users (id)
+            )
+        """)
+        cursor.execute("""
+            INSERT INTO chats_new (id, name, type, user1_id, user2_id, deleted_at)
+            SELECT id, name, COALESCE(type, 'one-on-one'), user1_id, user2_id, deleted_at
+            FROM chats
+        """)
+        cursor.execute("DROP TABLE chats")
+        cursor.execute("ALTER TABLE chats_new RENAME TO chats")
+    cursor.execute("UPDATE chats SET type = 'one-on-one' WHERE type IS NULL")
+
+    # Groups table for group chat metadata
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            admin_id INTEGER NOT NULL,
+            FOREIGN KEY (chat_id) REFERENCES chats (id),
+            FOREIGN KEY (admin_id) REFERENCES users (id)
+        )
+    """)
+
+    # Participants table for chat memberships
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS participants (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id),
+            FOREIGN KEY (chat_id) REFERENCES chats (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    """)
+
+    # Indexes used by per-user lookups and batched purges
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_participants_user ON participants (user_id)")
+
+    # Pending background deletions, resumed after a restart
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS purge_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            target_id INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (kind, target_id)
+        )
+    """)
+
+    # Bumped whenever a user's chat or group list changes; drives the ETags of /chats/list and /groups/list
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS list_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    """)
+
+def message_store_v1(cursor, shard: int):
+    """Message tables of a store from before versioned migrations.
+
+    The inbox summaries are backfilled from the shard's participants when
+    the summary table is new.
+    """
+    # Messages table with sender_name, reactions, and read_by
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            sender_name TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            edited_at DATETIME DEFAULT NULL,
+            reply_to INTEGER DEFAULT NULL,
+            reactions TEXT DEFAULT '[]',
+            read_by TEXT DEFAULT '[]',
+            type TEXT NOT NULL DEFAULT 'message',
+            file_url TEXT DEFAULT NULL,
+            file_name TEXT DEFAULT NULL,
+            file_type TEXT DEFAULT NULL,
+            file_size INTEGER DEFAULT NULL,
+            FOREIGN KEY (chat_id) REFERENCES chats (id),
+            FOREIGN KEY (reply_to) REFERENCES messages (id)
+        )
+    """)
+    add_columns(cursor, "messages", [
+        ("edited_at", "DATETIME DEFAULT NULL"),
+        ("sender_name", "TEXT NOT NULL"),
+        ("reactions", "TEXT DEFAULT '[]'"),
+        ("read_by", "TEXT DEFAULT '[]'")
+    ])
+    if add_columns(cursor, "messages", ATTACHMENT_COLUMNS):
+        migrate_attachments(cursor)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, id)")
+    # "All files in this chat"
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_files ON messages (chat_id, id) WHERE type = 'file'")
+
+    # Which monthly archive files hold messages of which chat (see server/archive.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS archived_chunks (
+            chat_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, month)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS archive_files (
+            month TEXT PRIMARY KEY,
+            sealed INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+    # Bumped by every write to a chat's messages; drives the ETag of /messages/history
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_versions (
+            chat_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    """)
+
+    # Per-(chat, user) inbox summary, maintained alongside message writes
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chat_summaries'")
+    summaries_exist = cursor.fetchone() is not None
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            last_message_id INTEGER,
+            last_message_preview TEXT,
+            last_sender TEXT,
+            last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id),
+            FOREIGN KEY (chat_id) REFERENCES chats (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chat_summaries_inbox
+        ON chat_summaries (user_id, last_activity DESC, chat_id DESC)
+    """)
+    if not summaries_exist:
+        backfill_chat_summaries(cursor, shards.participants_source(shard))
+
+def message_store_v2(cursor, shard: int):
+    # Resent frames carry the same client_msg_id; the index makes the second insert a no-op
+    cursor.execute("ALTER TABLE messages ADD COLUMN client_msg_id TEXT DEFAULT NULL")
+    cursor.execute("""
+        CREATE UNIQUE INDEX idx_messages_client_msg ON messages (chat_id, sender_id, client_msg_id)
+        WHERE client_msg_id IS NOT NULL
+    """)
+
+def message_store_v3(cursor, shard: int):
+    # Parsed from the upload in server/voice.py; NULL for other messages and voice notes sent before
+    cursor.execute("ALTER TABLE messages ADD COLUMN duration_ms INTEGER DEFAULT NULL")
+    cursor.execute("ALTER TABLE messages ADD COLUMN waveform TEXT DEFAULT NULL")
+
+def message_store_v4(cursor, shard: int):
+    """Storage counters per sender and per chat, backfilled from the file
+    messages in the shard and in its archive files."""
+    for table, key in (("user_storage", "user_id"), ("chat_storage", "chat_id")):
+        cursor.execute(f"""
+            CREATE TABLE {table} (
+                {key} INTEGER PRIMARY KEY,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                files INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+    backfill_storage_usage(cursor)
+
+    # Archive files also hold the messages of purged chats, which no longer have chunks
+    cursor.execute("""
+        SELECT a.month, a.chat_id, COALESCE(f.sealed, 0) AS sealed
+        FROM archived_chunks a LEFT JOIN archive_files f ON f.month = a.month
+    """)
+    months = {}
+    for chunk in cursor.fetchall():
+        months.setdefault((chunk["month"], bool(chunk["sealed"])), set()).add(chunk["chat_id"])
+    for (month, sealed), chat_ids in months.items():
+        rows = [row for row in archive.file_usage(shard, month, sealed) if row["chat_id"] in chat_ids]
+        for table, key, owner in (("user_storage", "user_id", "sender_id"), ("chat_storage", "chat_id", "chat_id")):
+            cursor.executemany(f"""
+                INSERT INTO {table} ({key}, bytes, files) VALUES (?, ?, ?)
+                ON CONFLICT ({key}) DO UPDATE SET bytes = bytes + excluded.bytes, files = files + excluded.files
+            """, [(row[owner], row["bytes"], row["files"]) for row in rows])
+
+# (version, description, metadata step, message store step); either step may be None
+MIGRATIONS = [
+    (1, "baseline schema", metadata_v1, message_store_v1),
+    (2, "client message ids", None, message_store_v2),
+    (3, "voice message metadata", None, message_store_v3),
+    (4, "storage usage counters", None, message_store_v4),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_file(conn, name: str, metadata: bool = False, message_store: bool = False, shard: int = 0) -> int:
+    """Apply the pending migrations to one database file; returns how many ran."""
+    if schema_version(conn) >= LATEST_VERSION:
+        return 0
+    conn.execute(f"PRAGMA busy_timeout = {int(MIGRATION_LOCK_TIMEOUT_SECONDS * 1000)}")
+    # Takes the write lock up front; a worker that waited here finds the work done
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = schema_version(conn)
+        cursor = conn.cursor()
+        applied = 0
+        for step_version, description, metadata_step, message_store_step in MIGRATIONS:
+            if step_version <= version:
+                continue
+            start = time.perf_counter()
+            if metadata and metadata_step:
+                metadata_step(cursor)
+            if message_store and message_store_step:
+                message_store_step(cursor, shard)
+            applied += 1
+            logger.info(f"Applied migration {step_version} ({description}) to {name} "
+                        f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+        if applied:
+            cursor.execute(f"PRAGMA user_version = {LATEST_VERSION}")
+        conn.commit()
+        return applied
+    except Exception:
+        conn.rollback()
+        raise
+
+def check_version(conn, name: str):
+    version = schema_version(conn)
+    if version > LATEST_VERSION:
+        # Rolled back to an older release; it can run as long as later steps only added things
+        logger.warning(f"{name} is at schema version {version}, newer than this release ({LATEST_VERSION})")
+
+def migrate() -> int:
+    """Migrate the metadata database, then every shard. Returns the steps applied."""
+    applied = 0
+    conn = get_connection()
+    try:
+        check_version(conn, DB_PATH)
+        applied += migrate_file(conn, DB_PATH, metadata=True, message_store=shards.SHARD_COUNT == 1)
+    finally:
+        conn.close()
+    if shards.SHARD_COUNT == 1:
+        return applied
+
+    shards.SHARD_DIR.mkdir(parents=True, exist_ok=True)
+    for shard in shards.all_shards():
+        conn = shards.connect_shard(shard)
+        try:
+            check_version(conn, shards.shard_path(shard))
+            if schema_version(conn) >= LATEST_VERSION:
+                continue
+            # Summaries are backfilled from the metadata database's participants
+            conn.execute("ATTACH DATABASE ? AS meta", (DB_PATH,))
+            applied += migrate_file(conn, shards.shard_path(shard), message_store=True, shard=shard)
+        finally:
+            conn.close()
+    return applied
+
+if __name__ == "__main__":
+    applied = migrate()
+    print(f"Applied {applied} migration steps, schema version {LATEST_VERSION}")
@@ -0,0 +1,238 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from server import metrics
+
+# Events broadcast to a chat while a user who recently had it open has no
+# socket in it, kept so that reconnecting delivers them in one "outbox"
+# frame instead of the client re-reading history. A chat is tracked for a
+# user from the moment their last socket in it closes. A socket opened in any
+# chat, including the notification chat 0, also gets the events queued for
+# the user's other tracked chats, which stay tracked with nothing pending:
+#
+#   MESSENGER_OUTBOX_EVENTS   pending events per user (default 200)
+#   MESSENGER_OUTBOX_KB       pending bytes per user (default 64)
+#   MESSENGER_OUTBOX_MB       pending bytes over all users (default 32, 0 disables the outbox)
+#   MESSENGER_OUTBOX_TTL      seconds a chat stays tracked after the socket closed (default 3600)
+#
+# The frame is only sent when it holds everything the user missed. A user who
+# overflows their bounds or is evicted stops being tracked for the chat and
+# gets no frame, which tells the client to reload history as before. Like the
+# sockets themselves the outbox is per process.
+
+OUTBOX_EVENTS = int(os.environ.get("MESSENGER_OUTBOX_EVENTS", "200"))
+OUTBOX_BYTES = int(float(os.environ.get("MESSENGER_OUTBOX_KB", "64")) * 1024)
+OUTBOX_TOTAL_BYTES = int(float(os.environ.get("MESSENGER_OUTBOX_MB", "32")) * 1024 * 1024)
+OUTBOX_TTL_SECONDS = float(os.environ.get("MESSENGER_OUTBOX_TTL", "3600"))
+
+DROPPED = metrics.Counter(
+    "outbox_dropped_total", "Chats no longer tracked for a user, by reason (overflow, budget, expired).", ["reason"]
+)
+
+OPPOSITE_REACTIONS = {"reaction_add": "reaction_remove", "reaction_remove": "reaction_add"}
+
+def message_id_of(event: dict) -> int | None:
+    if "message_id" in event:
+        return event["message_id"]
+    data = event.get("data")
+    return data.get("message_id") if isinstance(data, dict) else None
+
+def collapse(events: list, event: dict) -> tuple[list, bool]:
+    """Apply the collapsing rules for a new event to a chat's pending events.
+
+    Returns the entries to keep and whether the new event still has to be
+    appended: only the latest edit of a message is kept, a delete replaces
+    everything pending for its message, and a reaction added and removed
+    again cancels out.
+    """
+    kind = event.get("type")
+    message_id = message_id_of(event)
+    if kind == "edit":
+        return [entry for entry in events
+                if not (entry[1].get("type") == "edit" and message_id_of(entry[1]) == message_id)], True
+    if kind == "delete":
+        return [entry for entry in events if message_id_of(entry[1]) != message_id], True
+    if kind in OPPOSITE_REACTIONS:
+        for i, entry in enumerate(events):
+            pending = entry[1]
+            if (pending.get("type") == OPPOSITE_REACTIONS[kind] and pending.get("message_id") == message_id
+                    and pending.get("user_id") == event.get("user_id")
+                    and pending.get("reaction") == event.get("reaction")):
+                return events[:i] + events[i + 1:], False
+    return events, True
+
+class TrackedChat:
+    __slots__ = ("since", "events")
+
+    def __init__(self):
+        self.since = time.monotonic()
+        self.events = []  # [(seq, event, size)], oldest first
+
+class UserOutbox:
+    __slots__ = ("chats", "count", "size", "last_seen")
+
+    def __init__(self):
+        self.chats = {}  # { chat_id: TrackedChat }
+        self.count = 0
+        self.size = 0
+        self.last_seen = time.monotonic()
+
+class Outbox:
+    def __init__(self, max_events: int = OUTBOX_EVENTS, max_bytes: int = OUTBOX_BYTES,
+                 total_bytes: int = OUTBOX_TOTAL_BYTES, ttl_seconds: float = OUTBOX_TTL_SECONDS):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.total_bytes = total_bytes
+        self.ttl_seconds = ttl_seconds
+        self.users = OrderedDict()  # { user_id: UserOutbox }, least recently disconnected first
+        self.chat_users = {}  # { chat_id: {user_ids tracking it} }
+        self.size = 0
+        self.seq = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_events > 0 and self.max_bytes > 0 and self.total_bytes > 0
+
+    def tracks(self, chat_id: int) -> bool:
+        return chat_id in self.chat_users
+
+    def track(self, chat_id: int, user_id: int):
+        """Start collecting a chat's events for a user whose last socket in it closed."""
+        if not self.enabled:
+            return
+        box = self.users.get(user_id)
+        if box is None:
+            box = self.users[user_id] = UserOutbox()
+        else:
+            self.users.move_to_end(user_id)
+        box.last_seen = time.monotonic()
+        if chat_id not in box.chats:
+            box.chats[chat_id] = TrackedChat()
+            self.chat_users.setdefault(chat_id, set()).add(user_id)
+        self._expire()
+
+    def take(self, chat_id: int, user_id: int) -> list[dict] | None:
+        """Everything the user missed in the chat, oldest first, or None if that is not known."""
+        box = self.users.get(user_id)
+        if box is None or chat_id not in box.chats:
+            return None
+        tracked = self._untrack(user_id, box, chat_id)
+        if time.monotonic() - tracked.since > self.ttl_seconds:
+            DROPPED.inc("expired")
+            return None
+        return [event for _, event, _ in tracked.events]
+
+    def take_others(self, chat_id: int, user_id: int) -> dict[int, list[dict]]:
+        """Events queued for the user in their tracked chats other than
+        `chat_id`, by chat; those chats stay tracked from now on."""
+        box = self.users.get(user_id)
+        if box is None:
+            return {}
+        now = time.monotonic()
+        taken = {}
+        for other, tracked in list(box.chats.items()):
+            if other == chat_id:
+                continue
+            if now - tracked.since > self.ttl_seconds:
+                self._untrack(user_id, box, other)
+                DROPPED.inc("expired")
+                continue
+            if tracked.events:
+                size = sum(entry[2] for entry in tracked.events)
+                box.count -= len(tracked.events)
+                box.size -= size
+                self.size -= size
+                taken[other] = [event for _, event, _ in tracked.events]
+                tracked.events = []
+            tracked.since = now
+        if user_id in self.users:
+            box.last_seen = now
+            self.users.move_to_end(user_id)
+        return taken
+
+    def add(self, chat_id: int, event: dict, online_user_ids: set, user_ids: set | None = None):
+        """Queue an event broadcast to a chat for the tracking users not in
+        `online_user_ids`, and in `user_ids` if the event was only sent to those."""
+        offline = self.chat_users.get(chat_id, set()) - online_user_ids
+        if user_ids is not None:
+            offline &= user_ids
+        if not offline:
+            return
+        size = len(json.dumps(event, ensure_ascii=False))
+        self.seq += 1
+        for user_id in offline:
+            box = self.users[user_id]
+            tracked = box.chats[chat_id]
+            kept, append = collapse(tracked.events, event)
+            if len(kept) != len(tracked.events):
+                removed = sum(entry[2] for entry in tracked.events) - sum(entry[2] for entry in kept)
+                box.count -= len(tracked.events) - len(kept)
+                box.size -= removed
+                self.size -= removed
+                tracked.events = kept
+            if append:
+                tracked.events.append((self.seq, event, size))
+                box.count += 1
+                box.size += size
+                self.size += size
+            while box.count > self.max_events or box.size > self.max_bytes:
+                # Give up on the chat holding the oldest event; the user reloads its history
+                oldest = min((other for other, chat in box.chats.items() if chat.events),
+                             key=lambda other: box.chats[other].events[0][0])
+                self._untrack(user_id, box, oldest)
+                DROPPED.inc("overflow")
+        while self.size > self.total_bytes and self.users:
+            user_id = next(iter(self.users))
+            DROPPED.inc("budget", amount=len(self.users[user_id].chats))
+            self.forget_user(user_id)
+
+    def _untrack(self, user_id: int, box: UserOutbox, chat_id: int) -> TrackedChat:
+        tracked = box.chats.pop(chat_id)
+        size = sum(entry[2] for entry in tracked.events)
+        box.count -= len(tracked.events)
+        box.size -= size
+        self.size -= size
+        users = self.chat_users[chat_id]
+        users.discard(user_id)
+        if not users:
+            del self.chat_users[chat_id]
+        if not box.chats:
+            del self.users[user_id]
+        return tracked
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.users:
+            user_id, box = next(iter(self.users.items()))
+            if now - box.last_seen <= self.ttl_seconds:
+                break
+            DROPPED.inc("expired", amount=len(box.chats))
+            self.forget_user(user_id)
+
+    def forget(self, chat_id: int, user_ids: set[int]):
+        """Stop tracking a chat for users who left it."""
+        for user_id in user_ids:
+            box = self.users.get(user_id)
+            if box is not None and chat_id in box.chats:
+                self._untrack(user_id, box, chat_id)
+
+    def drop_chat(self, chat_id: int):
+        self.forget(chat_id, set(self.chat_users.get(chat_id, ())))
+
+    def forget_user(self, user_id: int):
+        box = self.users.get(user_id)
+        if box is not None:
+            for chat_id in list(box.chats):
+                self._untrack(user_id, box, chat_id)
+
+    def gauges(self):
+        return [
+            ("outbox_users", "Users with chats tracked by the offline outbox.", [({}, len(self.users))]),
+            ("outbox_events", "Events waiting in offline outboxes.",
+             [({}, sum(box.count for box in self.users.values()))]),
+            ("outbox_bytes", "Approximate size of the events waiting in offline outboxes.", [({}, self.size)]),
+        ]
+
+pending = Outbox()
+metrics.register_collector(pending.gauges)
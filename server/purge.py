@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from server.database import get_connection
+from server import archive, shards
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Rows deleted per transaction and the pause between transactions. Small
+# batches keep each hold on the SQLite write lock short so senders in other
+# chats are not blocked while a big chat is being purged.
+PURGE_BATCH_SIZE = 500
+PURGE_PAUSE_SECONDS = 0.05
+PURGE_IDLE_SECONDS = 30
+
+_wake = asyncio.Event()
+
+# Per job kind: the (store, table, owner column) triples emptied batch by
+# batch, then the metadata statements that remove the remaining single rows.
+# "shard" is the shard of the purged chat, "shards" is every shard and
+# "archive" the unsealed archive files of the purged chat's shard. Sealed
+# archive files are read-only; their rows stay, unreachable (and ignored by
+# the orphaned file collector) once the chat's archived_chunks rows are gone.
+PURGE_PLANS = {
+    "chat": (
+        [("shard", "messages", "chat_id"), ("archive", "messages", "chat_id"),
+         ("shard", "archived_chunks", "chat_id"),
+         ("shard", "chat_summaries", "chat_id"), ("shard", "chat_storage", "chat_id"),
+         ("meta", "participants", "chat_id")],
+        ["DELETE FROM groups WHERE chat_id = ?", "DELETE FROM chats WHERE id = ?"],
+    ),
+    "user": (
+        [("shards", "chat_summaries", "user_id"), ("shards", "user_storage", "user_id"),
+         ("meta", "participants", "user_id")],
+        [],
+    ),
+}
+
+def enqueue(cursor, kind: str, target_id: int):
+    """Record a purge job; call inside the transaction that tombstones the target."""
+    cursor.execute("INSERT OR IGNORE INTO purge_jobs (kind, target_id) VALUES (?, ?)", (kind, target_id))
+
+def notify():
+    _wake.set()
+
+# Every sender with counted files already has a user_storage row on the shard,
+# so a missing row means the sender's account was purged and there is nothing
+# left to release (an upsert would leave a negative row behind for good).
+RELEASE_USER_STORAGE = "UPDATE user_storage SET bytes = bytes - ?, files = files - ? WHERE user_id = ?"
+
+def _release_storage(conn, shard: int, table: str, rowids: list[int]):
+    """Take the files of the rows about to be deleted off their senders' storage counters."""
+    placeholders = ", ".join("?" * len(rowids))
+    if table in ("messages", "arch.messages"):
+        rows = conn.execute(f"""
+            SELECT sender_id, COALESCE(SUM(CAST(file_size AS INTEGER)), 0), COUNT(*)
+            FROM {table} WHERE rowid IN ({placeholders}) AND type = 'file' GROUP BY sender_id
+        """, rowids).fetchall()
+    elif table == "archived_chunks":
+        chunks = conn.execute(f"""
+            SELECT a.chat_id, a.month, COALESCE(f.sealed, 0) AS sealed
+            FROM archived_chunks a LEFT JOIN archive_files f ON f.month = a.month
+            WHERE a.rowid IN ({placeholders})
+        """, rowids).fetchall()
+        rows = [(row["sender_id"], row["bytes"], row["files"])
+                for chunk in chunks
+                for row in archive.file_usage(shard, chunk["month"], bool(chunk["sealed"]), chunk["chat_id"])]
+    else:
+        return
+    conn.executemany(RELEASE_USER_STORAGE, [(size, files, sender_id) for sender_id, size, files in rows])
+
+def _delete_batch(conn, shard: int | None, table: str, column: str, target_id: int) -> bool:
+    # The rows are picked inside the write transaction, so two purgers racing
+    # on one job cannot both release the same files
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rowids = [row[0] for row in conn.execute(f"SELECT rowid FROM {table} WHERE {column} = ? LIMIT ?",
+                                                 (target_id, PURGE_BATCH_SIZE))]
+        if rowids:
+            if shard is not None:
+                _release_storage(conn, shard, table, rowids)
+            conn.execute(f"DELETE FROM {table} WHERE rowid IN ({', '.join('?' * len(rowids))})", rowids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return bool(rowids)
+
+def _delete_archived_batch(conn, shard: int, table: str, column: str, target_id: int) -> bool:
+    # Chunks of months already emptied stay until the archived_chunks step, so
+    # a file is skipped once it has no rows left
+    months = conn.execute(f"""
+        SELECT DISTINCT a.month FROM archived_chunks a LEFT JOIN archive_files f ON f.month = a.month
+        WHERE a.{column} = ? AND COALESCE(f.sealed, 0) = 0 ORDER BY a.month
+    """, (target_id,)).fetchall()
+    for row in months:
+        path = archive.archive_path(shard, row["month"])
+        if not path.exists():
+            continue
+        conn.execute("ATTACH DATABASE ? AS arch", (str(path),))
+        try:
+            if _delete_batch(conn, shard, f"arch.{table}", column, target_id):
+                return True
+        finally:
+            conn.execute("DETACH DATABASE arch")
+    return False
+
+def purge_batch(kind: str, target_id: int) -> bool:
+    """Delete one batch of rows for a job. Returns True once the job is finished."""
+    tables, finalizers = PURGE_PLANS[kind]
+    for store, table, column in tables:
+        if store == "meta":
+            targets = [None]
+        elif store in ("shard", "archive"):
+            targets = [shards.shard_for(target_id)]
+        else:
+            targets = list(shards.all_shards())
+        delete_batch = _delete_archived_batch if store == "archive" else _delete_batch
+        for shard in targets:
+            conn = get_connection() if shard is None else shards.connect_shard(shard)
+            try:
+                if delete_batch(conn, shard, table, column, target_id):
+                    return False
+            finally:
+                conn.close()
+
+    conn = get_connection()
+    try:
+        for statement in finalizers:
+            conn.execute(statement, (target_id,))
+        conn.execute("DELETE FROM purge_jobs WHERE kind = ? AND target_id = ?", (kind, target_id))
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+def pending_jobs() -> list[tuple[str, int]]:
+    conn = get_connection()
+    try:
+        rows = conn.execute("SELECT kind, target_id FROM purge_jobs ORDER BY id").fetchall()
+        return [(row["kind"], row["target_id"]) for row in rows]
+    finally:
+        conn.close()
+
+async def run_purger():
+    """Background task: drain purge_jobs batch by batch, resuming after restarts."""
+    while True:
+        _wake.clear()
+        try:
+            jobs = await asyncio.to_thread(pending_jobs)
+            for kind, target_id in jobs:
+                batches = 0
+                while not await asyncio.to_thread(purge_batch, kind, target_id):
+                    batches += 1
+                    await asyncio.sleep(PURGE_PAUSE_SECONDS)
+                logger.info(f"Purged {kind} {target_id} in {batches + 1} batches")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error while purging: {e}")
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=PURGE_IDLE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
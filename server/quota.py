@@ -0,0 +1,54 @@
+import os
+from server import metrics, storage, uploads
+from server.repositories.base import QuotaExceededError
+
+# Storage quotas, checked against the per-user and per-chat counters that
+# every file message write keeps in the same transaction (see
+# message_store.add_usage). Archived file messages stay counted.
+#
+#   MESSENGER_USER_QUOTA_MB   bytes a user may have stored across all chats (default 0, unlimited)
+#   MESSENGER_CHAT_QUOTA_MB   bytes a chat may hold (default 0, unlimited)
+#
+# The declared sizes of the user's open resumable uploads count as used too.
+# Uploads are checked three times: against their declared size before the
+# body is read, against the stored file before it is saved, and in the
+# transaction that counts it (see message_store.check_quotas), which is what
+# keeps uploads running at the same time from going over together. Only a
+# user uploading into chats on different shards at the same moment can still
+# go over, by the files in flight.
+
+USER_QUOTA_BYTES = int(float(os.environ.get("MESSENGER_USER_QUOTA_MB", "0")) * 1024 * 1024)
+CHAT_QUOTA_BYTES = int(float(os.environ.get("MESSENGER_CHAT_QUOTA_MB", "0")) * 1024 * 1024)
+
+REJECTIONS = metrics.Counter(
+    "upload_quota_rejections_total", "Uploads refused because they would exceed a storage quota, by quota.",
+    ["scope"]
+)
+
+def limit_of(quota_bytes: int) -> int | None:
+    return quota_bytes if quota_bytes > 0 else None
+
+def limits() -> dict:
+    """Keyword arguments for MessageRepo.insert that enforce the quotas."""
+    return {"user_quota": limit_of(USER_QUOTA_BYTES), "chat_quota": limit_of(CHAT_QUOTA_BYTES)}
+
+async def check(user_id: int, chat_id: int | None, file_size: int, upload_id: str | None = None):
+    """Raise QuotaExceededError if storing `file_size` more bytes would take the
+    user or, given one, the chat past its quota. `upload_id` is the resumable
+    upload being checked, so it is not counted twice."""
+    if USER_QUOTA_BYTES > 0:
+        used = (await storage.repos.messages.user_usage(user_id))["bytes"]
+        used += uploads.open_uploads(user_id, upload_id)[1]
+        if used + file_size > USER_QUOTA_BYTES:
+            raise QuotaExceededError("user", used, USER_QUOTA_BYTES)
+    if CHAT_QUOTA_BYTES > 0 and chat_id is not None:
+        used = (await storage.repos.messages.chat_usage(chat_id))["bytes"]
+        if used + file_size > CHAT_QUOTA_BYTES:
+            raise QuotaExceededError("chat", used, CHAT_QUOTA_BYTES)
+
+async def usage(user_id: int, chat_id: int | None = None) -> dict:
+    """{user: {bytes, files, quota}} and, given a chat, the same for the chat; quota is None when unlimited."""
+    result = {"user": {**await storage.repos.messages.user_usage(user_id), "quota": limit_of(USER_QUOTA_BYTES)}}
+    if chat_id is not None:
+        result["chat"] = {**await storage.repos.messages.chat_usage(chat_id), "quota": limit_of(CHAT_QUOTA_BYTES)}
+    return result
@@ -0,0 +1,229 @@
+from abc import ABC, abstractmethod
+
+# Storage interface used by the routes and the WebSocket handler. Every
+# method is async and returns plain dicts, so backends are interchangeable.
+
+class MessageStoreError(Exception):
+    """A message write was rejected; the text is safe to show to the client."""
+
+class DuplicateMessageError(MessageStoreError):
+    """The sender already stored a message with this client_msg_id in the chat."""
+
+    def __init__(self, message_id: int):
+        super().__init__("Duplicate message")
+        self.message_id = message_id
+
+class QuotaExceededError(MessageStoreError):
+    """Storing a file would take its sender ("user") or its chat ("chat") past a storage quota."""
+
+    def __init__(self, scope: str, used: int, quota: int):
+        label = "Storage quota" if scope == "user" else "Chat storage quota"
+        super().__init__(f"{label} exceeded: {used} of {quota} bytes used")
+        self.scope = scope
+
+class UserRepo(ABC):
+    @abstractmethod
+    async def get_by_id(self, user_id: int) -> dict | None:
+        """{id, username, avatar_url, bio} or None."""
+
+    @abstractmethod
+    async def get_by_username(self, username: str) -> dict | None:
+        """{id, username, avatar_url, bio} or None."""
+
+    @abstractmethod
+    async def get_credentials(self, username: str) -> dict | None:
+        """{id, password} or None."""
+
+    @abstractmethod
+    async def get_recovery_data(self, username: str) -> dict | None:
+        """{id, encrypted_cloud_part, salt, verification_ciphertext} or None."""
+
+    @abstractmethod
+    async def get_cloud_part(self, username: str) -> dict | None:
+        """{encrypted_cloud_part} for a case-insensitive username, or None."""
+
+    @abstractmethod
+    async def create(self, username: str, password: str, bio: str, encrypted_cloud_part: str,
+                     salt: bytes, verification_ciphertext: str) -> int | None:
+        """Id of the new user, or None if the username is taken."""
+
+    @abstractmethod
+    async def update_profile(self, user_id: int, avatar_url: str | None = None, bio: str | None = None) -> bool:
+        """Set the given fields. Returns False if the user does not exist."""
+
+    @abstractmethod
+    async def replace_avatar_url(self, user_id: int, old_url: str, new_url: str) -> bool:
+        """Point the avatar at `new_url` if it is still `old_url`, for files
+        that moved. Returns whether it was changed."""
+
+    @abstractmethod
+    async def set_password(self, user_id: int, password: str):
+        ...
+
+    @abstractmethod
+    async def delete(self, user_id: int):
+        """Remove the account; memberships may be cleaned up in the background."""
+
+    @abstractmethod
+    async def search(self, query: str, limit: int = 20) -> list[dict]:
+        """[{id, username, avatar_url}] whose username contains `query`."""
+
+    @abstractmethod
+    async def resolve_usernames(self, usernames: list[str]) -> dict[str, int]:
+        """{username: id} for the usernames that exist."""
+
+    @abstractmethod
+    async def avatars(self, user_ids: list[int]) -> dict[int, str | None]:
+        ...
+
+class ChatRepo(ABC):
+    @abstractmethod
+    async def get_chat(self, chat_id: int) -> dict | None:
+        """{id, name, type, user1_id, user2_id} of a chat that is not deleted."""
+
+    @abstractmethod
+    async def is_member(self, chat_id: int, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def find_direct_chat(self, user1_id: int, user2_id: int) -> int | None:
+        ...
+
+    @abstractmethod
+    async def create_direct_chat(self, name: str, user1_id: int, user2_id: int) -> int:
+        ...
+
+    @abstractmethod
+    async def list_direct_chats(self, user_id: int) -> list[dict]:
+        """[{id, name, user1_id, user2_id, user1_username, user1_avatar_url,
+        user2_username, user2_avatar_url}]"""
+
+    @abstractmethod
+    async def delete_chat(self, chat_id: int):
+        """Hide the chat at once; its rows may be purged in the background."""
+
+    @abstractmethod
+    async def create_group(self, name: str, admin_id: int, member_ids: list[int]) -> int:
+        ...
+
+    @abstractmethod
+    async def get_group(self, chat_id: int) -> dict | None:
+        """{admin_id, name} of a group that is not deleted."""
+
+    @abstractmethod
+    async def list_groups(self, user_id: int) -> list[dict]:
+        """[{id, name, type}]"""
+
+    @abstractmethod
+    async def member_ids_among(self, chat_id: int, user_ids: list[int]) -> set[int]:
+        ...
+
+    @abstractmethod
+    async def add_members(self, chat_id: int, user_ids: list[int]):
+        ...
+
+    @abstractmethod
+    async def remove_members(self, chat_id: int, user_ids: list[int]):
+        ...
+
+    @abstractmethod
+    async def list_version(self, user_id: int) -> int:
+        """Changes whenever the user's chat or group list does."""
+
+    @abstractmethod
+    async def list_members(self, chat_id: int, after_id: int, limit: int) -> list[dict]:
+        """[{id, username, avatar_url}] with id > after_id, ordered by id."""
+
+    @abstractmethod
+    async def inbox(self, user_id: int, limit: int, before_activity: str | None = None,
+                    before_chat_id: int | None = None) -> list[dict]:
+        """Up to `limit` summaries, most recent first:
+        [{chat_id, last_message_id, last_message_preview, last_sender,
+        last_activity, unread_count}]"""
+
+    @abstractmethod
+    async def chats_by_id(self, chat_ids: list[int], viewer_id: int) -> dict[int, dict]:
+        """{chat_id: {id, name, type, interlocutor_name, interlocutor_avatar_url}}
+        for chats that are not deleted; the interlocutor is seen from `viewer_id`."""
+
+class MessageRepo(ABC):
+    @abstractmethod
+    async def insert(self, chat_id: int, sender_id: int, sender_name: str, content: str,
+                     reply_to: int | None = None, attachment: dict | None = None, timestamp: str | None = None,
+                     client_msg_id: str | None = None, user_quota: int | None = None,
+                     chat_quota: int | None = None) -> int:
+        """A file message if `attachment` ({file_url, file_name, file_type,
+        file_size}, plus duration_ms and waveform for voice messages) is
+        given; `content` is then the file name. `timestamp`
+        ("YYYY-MM-DD HH:MM:SS", UTC) defaults to now. Raises
+        DuplicateMessageError, without writing, if the sender already stored
+        `client_msg_id` in the chat, and QuotaExceededError if the file would
+        take the sender past `user_quota` or the chat past `chat_quota` bytes."""
+
+    @abstractmethod
+    async def edit(self, chat_id: int, message_id: int, user_id: int, content: str):
+        """Raises MessageStoreError if the user is not the author."""
+
+    @abstractmethod
+    async def delete(self, chat_id: int, message_id: int, user_id: int):
+        """Raises MessageStoreError if the user is not the author."""
+
+    @abstractmethod
+    async def add_reaction(self, chat_id: int, message_id: int, user_id: int, reaction: str):
+        ...
+
+    @abstractmethod
+    async def remove_reaction(self, chat_id: int, message_id: int, user_id: int, reaction: str):
+        ...
+
+    @abstractmethod
+    async def mark_read(self, chat_id: int, message_id: int, user_id: int) -> str | None:
+        """The receipt's read_at, or None if the user had already read the message."""
+
+    @abstractmethod
+    async def version(self, chat_id: int) -> int:
+        """Changes whenever the chat's history does: any message write, or an
+        avatar change of a member."""
+
+    @abstractmethod
+    async def history(self, chat_id: int, before_id: int | None = None, limit: int | None = None) -> list[dict]:
+        """Messages with id < before_id, newest first:
+        [{id, content, timestamp, sender_name, sender_id, reply_to, reactions, read_by,
+        type, file_url, file_name, file_type, file_size, duration_ms, waveform}]"""
+
+    @abstractmethod
+    async def files(self, chat_id: int, file_type: str | None = None, before_id: int | None = None,
+                    limit: int = 50) -> list[dict]:
+        """File messages (optionally of one file_type) with id < before_id, newest first:
+        [{id, sender_id, sender_name, timestamp, file_url, file_name, file_type, file_size,
+        duration_ms, waveform}]"""
+
+    @abstractmethod
+    async def export_page(self, chat_id: int, after_id: int = 0, limit: int = 1000,
+                          since: str | None = None, until: str | None = None) -> list[dict]:
+        """Up to `limit` messages with id > after_id, oldest first, optionally
+        restricted to since <= timestamp < until ("YYYY-MM-DD HH:MM:SS"):
+        [{id, chat_id, sender_id, sender_name, content, timestamp, edited_at,
+        reply_to, reactions, read_by, type, file_url, file_name, file_type, file_size,
+        duration_ms, waveform}]"""
+
+    @abstractmethod
+    async def user_usage(self, user_id: int) -> dict:
+        """{bytes, files} of the file messages the user has sent, archived ones included."""
+
+    @abstractmethod
+    async def chat_usage(self, chat_id: int) -> dict:
+        """{bytes, files} of the file messages in the chat, archived ones included."""
+
+class Repositories:
+    def __init__(self, users: UserRepo, chats: ChatRepo, messages: MessageRepo, backend: str):
+        self.users = users
+        self.chats = chats
+        self.messages = messages
+        self.backend = backend
+
+    async def start(self):
+        """Start background maintenance jobs of the backend, if any."""
+
+    async def stop(self):
+        ...
@@ -0,0 +1,452 @@
+import itertools
+import json
+from datetime import datetime
+from server.inbox import message_preview
+from server.repositories.base import (
+    ChatRepo, DuplicateMessageError, MessageRepo, MessageStoreError, QuotaExceededError, Repositories, UserRepo
+)
+
+# Process-local backend for tests and benchmarks. Nothing awaits inside a
+# method, so every method is atomic with respect to the event loop.
+
+ATTACHMENT_KEYS = ("file_url", "file_name", "file_type", "file_size", "duration_ms", "waveform")
+
+def now() -> str:
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+class MemoryStore:
+    def __init__(self):
+        self.users = {}  # { user_id: row }
+        self.chats = {}  # { chat_id: row }
+        self.group_admins = {}  # { chat_id: admin_id }
+        self.participants = {}  # { chat_id: set(user_ids) }
+        self.messages = {}  # { chat_id: { message_id: row } } in id order
+        self.client_msg_ids = {}  # { chat_id: { (sender_id, client_msg_id): message_id } }
+        self.summaries = {}  # { (chat_id, user_id): row }
+        self.chat_versions = {}  # { chat_id: version }
+        self.list_versions = {}  # { user_id: version }
+        self.user_storage = {}  # { user_id: {bytes, files} }
+        self.chat_storage = {}  # { chat_id: {bytes, files} }
+        self.user_ids = itertools.count(1)
+        self.chat_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def public_user(self, user: dict) -> dict:
+        return {key: user[key] for key in ("id", "username", "avatar_url", "bio")}
+
+    def live_chat(self, chat_id: int) -> dict | None:
+        return self.chats.get(chat_id)
+
+    def add_summaries(self, chat_id: int, user_ids):
+        for user_id in user_ids:
+            self.summaries.setdefault((chat_id, user_id), {
+                "chat_id": chat_id, "user_id": user_id, "last_message_id": None,
+                "last_message_preview": None, "last_sender": None,
+                "last_activity": now(), "unread_count": 0
+            })
+
+    def bump_chats(self, chat_ids):
+        for chat_id in chat_ids:
+            self.chat_versions[chat_id] = self.chat_versions.get(chat_id, 0) + 1
+
+    def bump_lists(self, user_ids):
+        for user_id in set(user_ids):
+            self.list_versions[user_id] = self.list_versions.get(user_id, 0) + 1
+
+    def bump_seen_by(self, user_id: int):
+        """After an avatar change: the user's chats and their direct chat partners' lists."""
+        self.bump_chats([chat_id for chat_id, members in self.participants.items() if user_id in members])
+        self.bump_lists([chat["user2_id"] if chat["user1_id"] == user_id else chat["user1_id"]
+                         for chat in self.chats.values()
+                         if chat["type"] == "one-on-one" and user_id in (chat["user1_id"], chat["user2_id"])])
+
+    def add_usage(self, message: dict, sign: int = 1):
+        # A release leaves out a sender whose counters were dropped with their account
+        user_usage = (self.user_storage.setdefault(message["sender_id"], {"bytes": 0, "files": 0}) if sign > 0
+                      else self.user_storage.get(message["sender_id"]))
+        for usage in (user_usage, self.chat_storage.setdefault(message["chat_id"], {"bytes": 0, "files": 0})):
+            if usage is None:
+                continue
+            usage["bytes"] += sign * int(message["file_size"] or 0)
+            usage["files"] += sign
+
+    def check_quotas(self, sender_id: int, chat_id: int, file_size, user_quota: int | None, chat_quota: int | None):
+        for scope, usage, quota in (("user", self.user_storage.get(sender_id), user_quota),
+                                    ("chat", self.chat_storage.get(chat_id), chat_quota)):
+            used = usage["bytes"] if usage else 0
+            if quota is not None and used + int(file_size or 0) > quota:
+                raise QuotaExceededError(scope, used, quota)
+
+    def chat_summaries(self, chat_id: int):
+        return [row for (summary_chat_id, _), row in self.summaries.items() if summary_chat_id == chat_id]
+
+class MemoryUserRepo(UserRepo):
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    def _find(self, username: str) -> dict | None:
+        return next((user for user in self.store.users.values() if user["username"] == username), None)
+
+    async def get_by_id(self, user_id):
+        user = self.store.users.get(int(user_id))
+        return self.store.public_user(user) if user else None
+
+    async def get_by_username(self, username):
+        user = self._find(username)
+        return self.store.public_user(user) if user else None
+
+    async def get_credentials(self, username):
+        user = self._find(username)
+        return {"id": user["id"], "password": user["password"]} if user else None
+
+    async def get_recovery_data(self, username):
+        user = self._find(username)
+        if not user:
+            return None
+        return {key: user[key] for key in ("id", "encrypted_cloud_part", "salt", "verification_ciphertext")}
+
+    async def get_cloud_part(self, username):
+        user = next((user for user in self.store.users.values()
+                     if user["username"].lower() == username.lower()), None)
+        return {"encrypted_cloud_part": user["encrypted_cloud_part"]} if user else None
+
+    async def create(self, username, password, bio, encrypted_cloud_part, salt, verification_ciphertext):
+        if self._find(username):
+            return None
+        user_id = next(self.store.user_ids)
+        self.store.users[user_id] = {
+            "id": user_id, "username": username, "password": password, "avatar_url": None, "bio": bio,
+            "encrypted_cloud_part": encrypted_cloud_part, "salt": salt,
+            "verification_ciphertext": verification_ciphertext
+        }
+        return user_id
+
+    async def update_profile(self, user_id, avatar_url=None, bio=None):
+        user = self.store.users.get(user_id)
+        if not user:
+            return False
+        if avatar_url is not None:
+            user["avatar_url"] = avatar_url
+            self.store.bump_seen_by(user_id)
+        if bio is not None:
+            user["bio"] = bio
+        return True
+
+    async def replace_avatar_url(self, user_id, old_url, new_url):
+        user = self.store.users.get(user_id)
+        if not user or user["avatar_url"] != old_url:
+            return False
+        user["avatar_url"] = new_url
+        self.store.bump_seen_by(user_id)
+        return True
+
+    async def set_password(self, user_id, password):
+        if user_id in self.store.users:
+            self.store.users[user_id]["password"] = password
+
+    async def delete(self, user_id):
+        self.store.bump_seen_by(user_id)
+        self.store.users.pop(user_id, None)
+        for members in self.store.participants.values():
+            members.discard(user_id)
+        for key in [key for key in self.store.summaries if key[1] == user_id]:
+            del self.store.summaries[key]
+        self.store.user_storage.pop(user_id, None)
+
+    async def search(self, query, limit=20):
+        matches = [user for user in self.store.users.values() if query.lower() in user["username"].lower()]
+        return [{"id": user["id"], "username": user["username"], "avatar_url": user["avatar_url"]}
+                for user in matches[:limit]]
+
+    async def resolve_usernames(self, usernames):
+        wanted = set(usernames)
+        return {user["username"]: user["id"] for user in self.store.users.values() if user["username"] in wanted}
+
+    async def avatars(self, user_ids):
+        return {user_id: self.store.users[user_id]["avatar_url"] for user_id in user_ids if user_id in self.store.users}
+
+class MemoryChatRepo(ChatRepo):
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    async def get_chat(self, chat_id):
+        chat = self.store.live_chat(chat_id)
+        return dict(chat) if chat else None
+
+    async def is_member(self, chat_id, user_id):
+        return self.store.live_chat(chat_id) is not None and user_id in self.store.participants.get(chat_id, set())
+
+    async def find_direct_chat(self, user1_id, user2_id):
+        pair = {user1_id, user2_id}
+        for chat in self.store.chats.values():
+            if chat["type"] == "one-on-one" and {chat["user1_id"], chat["user2_id"]} == pair:
+                return chat["id"]
+        return None
+
+    def _create(self, name: str, chat_type: str, member_ids, user1_id=None, user2_id=None) -> int:
+        chat_id = next(self.store.chat_ids)
+        self.store.chats[chat_id] = {"id": chat_id, "name": name, "type": chat_type,
+                                     "user1_id": user1_id, "user2_id": user2_id}
+        self.store.participants[chat_id] = set(member_ids)
+        self.store.messages[chat_id] = {}
+        self.store.add_summaries(chat_id, member_ids)
+        self.store.bump_lists(member_ids)
+        return chat_id
+
+    async def create_direct_chat(self, name, user1_id, user2_id):
+        return self._create(name, "one-on-one", [user1_id, user2_id], user1_id, user2_id)
+
+    async def list_direct_chats(self, user_id):
+        users = self.store.users
+        chats = []
+        for chat in self.store.chats.values():
+            if chat["type"] != "one-on-one" or user_id not in self.store.participants.get(chat["id"], set()):
+                continue
+            user1 = users.get(chat["user1_id"], {})
+            user2 = users.get(chat["user2_id"], {})
+            chats.append({
+                "id": chat["id"], "name": chat["name"], "user1_id": chat["user1_id"], "user2_id": chat["user2_id"],
+                "user1_username": user1.get("username"), "user1_avatar_url": user1.get("avatar_url"),
+                "user2_username": user2.get("username"), "user2_avatar_url": user2.get("avatar_url")
+            })
+        return chats
+
+    async def delete_chat(self, chat_id):
+        self.store.bump_lists(self.store.participants.get(chat_id, set()))
+        self.store.chats.pop(chat_id, None)
+        self.store.group_admins.pop(chat_id, None)
+        self.store.participants.pop(chat_id, None)
+        for message in self.store.messages.pop(chat_id, {}).values():
+            if message["type"] == "file":
+                self.store.add_usage(message, -1)
+        self.store.chat_storage.pop(chat_id, None)
+        self.store.client_msg_ids.pop(chat_id, None)
+        for key in [key for key in self.store.summaries if key[0] == chat_id]:
+            del self.store.summaries[key]
+
+    async def create_group(self, name, admin_id, member_ids):
+        chat_id = self._create(name, "group", member_ids)
+        self.store.group_admins[chat_id] = admin_id
+        return chat_id
+
+    async def get_group(self, chat_id):
+        chat = self.store.live_chat(chat_id)
+        if not chat or chat["type"] != "group":
+            return None
+        return {"admin_id": self.store.group_admins[chat_id], "name": chat["name"]}
+
+    async def list_groups(self, user_id):
+        return [{"id": chat["id"], "name": chat["name"], "type": chat["type"]}
+                for chat in self.store.chats.values()
+                if chat["type"] == "group" and user_id in self.store.participants.get(chat["id"], set())]
+
+    async def member_ids_among(self, chat_id, user_ids):
+        return self.store.participants.get(chat_id, set()) & set(user_ids)
+
+    async def add_members(self, chat_id, user_ids):
+        self.store.participants.setdefault(chat_id, set()).update(user_ids)
+        self.store.add_summaries(chat_id, user_ids)
+        self.store.bump_lists(user_ids)
+
+    async def remove_members(self, chat_id, user_ids):
+        self.store.participants.get(chat_id, set()).difference_update(user_ids)
+        self.store.bump_lists(user_ids)
+        for user_id in user_ids:
+            self.store.summaries.pop((chat_id, user_id), None)
+
+    async def list_version(self, user_id):
+        return self.store.list_versions.get(user_id, 0)
+
+    async def list_members(self, chat_id, after_id, limit):
+        member_ids = sorted(user_id for user_id in self.store.participants.get(chat_id, set())
+                            if user_id > after_id and user_id in self.store.users)
+        return [{key: self.store.users[user_id][key] for key in ("id", "username", "avatar_url")}
+                for user_id in member_ids[:limit]]
+
+    async def inbox(self, user_id, limit, before_activity=None, before_chat_id=None):
+        rows = [row for (_, summary_user_id), row in self.store.summaries.items() if summary_user_id == user_id]
+        if before_activity is not None:
+            rows = [row for row in rows if (row["last_activity"], row["chat_id"]) < (before_activity, before_chat_id)]
+        rows.sort(key=lambda row: (row["last_activity"], row["chat_id"]), reverse=True)
+        return [{key: value for key, value in row.items() if key != "user_id"} for row in rows[:limit]]
+
+    async def chats_by_id(self, chat_ids, viewer_id):
+        chats = {}
+        for chat_id in chat_ids:
+            chat = self.store.live_chat(chat_id)
+            if not chat:
+                continue
+            interlocutor = None
+            if chat["type"] == "one-on-one":
+                other_id = chat["user2_id"] if chat["user1_id"] == viewer_id else chat["user1_id"]
+                interlocutor = self.store.users.get(other_id)
+            chats[chat_id] = {
+                "id": chat_id, "name": chat["name"], "type": chat["type"],
+                "interlocutor_name": interlocutor["username"] if interlocutor else None,
+                "interlocutor_avatar_url": interlocutor["avatar_url"] if interlocutor else None
+            }
+        return chats
+
+class MemoryMessageRepo(MessageRepo):
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    def _message(self, chat_id: int, message_id: int) -> dict:
+        message = self.store.messages.get(chat_id, {}).get(message_id)
+        if not message:
+            raise MessageStoreError("Message not found")
+        return message
+
+    def _authored(self, chat_id: int, message_id: int, user_id: int) -> dict:
+        message = self.store.messages.get(chat_id, {}).get(message_id)
+        if not message or message["sender_id"] != user_id:
+            raise MessageStoreError("You are not the author of this message")
+        return message
+
+    async def insert(self, chat_id, sender_id, sender_name, content, reply_to=None, attachment=None, timestamp=None,
+                     client_msg_id=None, user_quota=None, chat_quota=None):
+        if client_msg_id is not None:
+            original = self.store.client_msg_ids.get(chat_id, {}).get((sender_id, client_msg_id))
+            if original is not None:
+                raise DuplicateMessageError(original)
+        if attachment:
+            self.store.check_quotas(sender_id, chat_id, attachment.get("file_size"), user_quota, chat_quota)
+        message_id = next(self.store.message_ids)
+        if client_msg_id is not None:
+            self.store.client_msg_ids.setdefault(chat_id, {})[(sender_id, client_msg_id)] = message_id
+        timestamp = timestamp or now()
+        attachment = attachment or {}
+        message = {
+            "id": message_id, "chat_id": chat_id, "sender_id": sender_id, "sender_name": sender_name,
+            "content": content, "timestamp": timestamp, "edited_at": None, "reply_to": reply_to,
+            "reactions": "[]", "read_by": "[]", "type": "file" if attachment else "message",
+            **{key: attachment.get(key) for key in ATTACHMENT_KEYS}
+        }
+        self.store.messages.setdefault(chat_id, {})[message_id] = message
+        if attachment:
+            self.store.add_usage(message)
+        self.store.bump_chats([chat_id])
+        preview = message_preview(content, message["type"], message["file_type"])
+        for summary in self.store.chat_summaries(chat_id):
+            summary.update(last_message_id=message_id, last_message_preview=preview,
+                           last_sender=sender_name, last_activity=timestamp)
+            if summary["user_id"] != sender_id:
+                summary["unread_count"] += 1
+        return message_id
+
+    async def edit(self, chat_id, message_id, user_id, content):
+        message = self._authored(chat_id, message_id, user_id)
+        if message["type"] == "file":
+            self.store.add_usage(message, -1)
+        message.update(content=content, edited_at=now(), type="message", **dict.fromkeys(ATTACHMENT_KEYS))
+        self.store.bump_chats([chat_id])
+        for summary in self.store.chat_summaries(chat_id):
+            if summary["last_message_id"] == message_id:
+                summary["last_message_preview"] = message_preview(content)
+
+    async def delete(self, chat_id, message_id, user_id):
+        message = self._authored(chat_id, message_id, user_id)
+        if message["type"] == "file":
+            self.store.add_usage(message, -1)
+        messages = self.store.messages[chat_id]
+        del messages[message_id]
+        self.store.bump_chats([chat_id])
+        previous = messages[next(reversed(messages))] if messages else None
+        readers = {r["user_id"] for r in json.loads(message["read_by"])}
+        for summary in self.store.chat_summaries(chat_id):
+            if summary["user_id"] != message["sender_id"] and summary["user_id"] not in readers:
+                summary["unread_count"] = max(summary["unread_count"] - 1, 0)
+            if summary["last_message_id"] == message_id:
+                summary.update(
+                    last_message_id=previous["id"] if previous else None,
+                    last_message_preview=message_preview(previous["content"], previous["type"], previous["file_type"])
+                    if previous else None,
+                    last_sender=previous["sender_name"] if previous else None
+                )
+
+    async def add_reaction(self, chat_id, message_id, user_id, reaction):
+        message = self._message(chat_id, message_id)
+        reactions = json.loads(message["reactions"])
+        if any(r["user_id"] == user_id and r["reaction"] == reaction for r in reactions):
+            raise MessageStoreError("You already reacted with this reaction")
+        reactions.append({"user_id": user_id, "reaction": reaction})
+        message["reactions"] = json.dumps(reactions)
+        self.store.bump_chats([chat_id])
+
+    async def remove_reaction(self, chat_id, message_id, user_id, reaction):
+        message = self._message(chat_id, message_id)
+        reactions = json.loads(message["reactions"])
+        if not any(r["user_id"] == user_id and r["reaction"] == reaction for r in reactions):
+            raise MessageStoreError("You cannot remove this reaction")
+        message["reactions"] = json.dumps([r for r in reactions if not (r["user_id"] == user_id and r["reaction"] == reaction)])
+        self.store.bump_chats([chat_id])
+
+    async def mark_read(self, chat_id, message_id, user_id):
+        message = self._message(chat_id, message_id)
+        if message["sender_id"] == user_id:
+            raise MessageStoreError("Cannot mark own message as read")
+        read_by = json.loads(message["read_by"])
+        if any(r["user_id"] == user_id for r in read_by):
+            return None
+        read_at = datetime.utcnow().isoformat()
+        read_by.append({"user_id": user_id, "read_at": read_at})
+        message["read_by"] = json.dumps(read_by)
+        self.store.bump_chats([chat_id])
+        summary = self.store.summaries.get((chat_id, user_id))
+        if summary:
+            summary["unread_count"] = max(summary["unread_count"] - 1, 0)
+        return read_at
+
+    async def version(self, chat_id):
+        return self.store.chat_versions.get(chat_id, 0)
+
+    async def history(self, chat_id, before_id=None, limit=None):
+        columns = ("id", "content", "timestamp", "sender_name", "sender_id", "reply_to", "reactions", "read_by",
+                   "type", *ATTACHMENT_KEYS)
+        history = []
+        for message in reversed(self.store.messages.get(chat_id, {}).values()):
+            if before_id is not None and message["id"] >= before_id:
+                continue
+            if limit is not None and len(history) == limit:
+                break
+            history.append({key: message[key] for key in columns})
+        return history
+
+    async def files(self, chat_id, file_type=None, before_id=None, limit=50):
+        columns = ("id", "sender_id", "sender_name", "timestamp", *ATTACHMENT_KEYS)
+        files = []
+        for message in reversed(self.store.messages.get(chat_id, {}).values()):
+            if len(files) == limit:
+                break
+            if message["type"] != "file" or (before_id is not None and message["id"] >= before_id):
+                continue
+            if file_type is not None and message["file_type"] != file_type:
+                continue
+            files.append({key: message[key] for key in columns})
+        return files
+
+    async def export_page(self, chat_id, after_id=0, limit=1000, since=None, until=None):
+        columns = ("id", "chat_id", "sender_id", "sender_name", "content", "timestamp", "edited_at",
+                   "reply_to", "reactions", "read_by", "type", *ATTACHMENT_KEYS)
+        page = []
+        for message in self.store.messages.get(chat_id, {}).values():
+            if len(page) == limit:
+                break
+            if message["id"] <= after_id:
+                continue
+            if (since is not None and message["timestamp"] < since) or (until is not None and message["timestamp"] >= until):
+                continue
+            page.append({key: message[key] for key in columns})
+        return page
+
+    async def user_usage(self, user_id):
+        return dict(self.store.user_storage.get(user_id, {"bytes": 0, "files": 0}))
+
+    async def chat_usage(self, chat_id):
+        return dict(self.store.chat_storage.get(chat_id, {"bytes": 0, "files": 0}))
+
+class MemoryRepositories(Repositories):
+    def __init__(self):
+        self.store = MemoryStore()
+        super().__init__(MemoryUserRepo(self.store), MemoryChatRepo(self.store),
+                         MemoryMessageRepo(self.store), "memory")
@@ -0,0 +1,490 @@
+import asyncio
+import sqlite3
+import threading
+from server.database import get_connection
+from server import archive, inbox, media_gc, message_store, metrics, migrations, purge, shards
+from server.repositories.base import ChatRepo, MessageRepo, Repositories, UserRepo
+
+# Metadata queries run on the default thread pool, each thread keeping its own
+# connection; message writes go through the shard writer threads. Every repo
+# method is timed into db_query_duration_seconds.
+
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER on old SQLite builds
+SQL_CHUNK_SIZE = 500
+
+_local = threading.local()
+
+def chunked(items: list, size: int = SQL_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _meta_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = get_connection()
+    return conn
+
+def _run_meta(fn, args):
+    conn = _meta_connection()
+    try:
+        result = fn(conn.cursor(), *args)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+
+async def meta(fn, *args):
+    """Run `fn(cursor, *args)` in one transaction on the metadata database."""
+    return await asyncio.to_thread(_run_meta, fn, args)
+
+def _run_shard_read(shard: int, fn, args):
+    connections = getattr(_local, "shards", None)
+    if connections is None:
+        connections = _local.shards = {}
+    if shard not in connections:
+        connections[shard] = shards.connect_shard(shard)
+    conn = connections[shard]
+    try:
+        return fn(conn.cursor(), *args)
+    finally:
+        conn.rollback()  # Ends the read transaction so the WAL can be checkpointed
+
+async def read_shard(shard: int, fn, *args):
+    """Run `fn(cursor, *args)` in one read transaction on a shard."""
+    return await asyncio.to_thread(_run_shard_read, shard, fn, args)
+
+async def shard_read(chat_id: int, fn, *args):
+    """Run `fn(cursor, *args)` in one read transaction on the shard holding a chat."""
+    return await read_shard(shards.shard_for(chat_id), fn, *args)
+
+def _one(cursor, query: str, params) -> dict | None:
+    cursor.execute(query, params)
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+def _all(cursor, query: str, params) -> list[dict]:
+    cursor.execute(query, params)
+    return [dict(row) for row in cursor.fetchall()]
+
+def _bump_lists(cursor, user_ids):
+    """Invalidate the chat and group list ETags of the users."""
+    cursor.executemany("""
+        INSERT INTO list_versions (user_id, version) VALUES (?, 1)
+        ON CONFLICT (user_id) DO UPDATE SET version = version + 1
+    """, [(user_id,) for user_id in set(user_ids)])
+
+def _seen_by(cursor, user_id: int) -> tuple[list[int], list[int]]:
+    """Chats whose history shows the user's avatar (the ones they are a member
+    of) and users whose chat list shows it (their direct chat partners)."""
+    cursor.execute("SELECT chat_id FROM participants WHERE user_id = ?", (user_id,))
+    chat_ids = [row["chat_id"] for row in cursor.fetchall()]
+    cursor.execute("""
+        SELECT CASE WHEN user1_id = ? THEN user2_id ELSE user1_id END AS other_id FROM chats
+        WHERE type = 'one-on-one' AND deleted_at IS NULL AND (user1_id = ? OR user2_id = ?)
+    """, (user_id, user_id, user_id))
+    return chat_ids, [row["other_id"] for row in cursor.fetchall() if row["other_id"] is not None]
+
+async def _bump_chats(chat_ids: list[int]):
+    by_shard = {}
+    for chat_id in chat_ids:
+        by_shard.setdefault(shards.shard_for(chat_id), []).append(chat_id)
+    for shard_chat_ids in by_shard.values():
+        await shards.write(shard_chat_ids[0], message_store.bump_chat_versions, shard_chat_ids)
+
+@metrics.instrument_repository("users")
+class SQLiteUserRepo(UserRepo):
+    async def get_by_id(self, user_id):
+        return await meta(_one, "SELECT id, username, avatar_url, bio FROM users WHERE id = ?", (user_id,))
+
+    async def get_by_username(self, username):
+        return await meta(_one, "SELECT id, username, avatar_url, bio FROM users WHERE username = ?", (username,))
+
+    async def get_credentials(self, username):
+        return await meta(_one, "SELECT id, password FROM users WHERE username = ?", (username,))
+
+    async def get_recovery_data(self, username):
+        return await meta(_one, """
+            SELECT id, encrypted_cloud_part, salt, verification_ciphertext FROM users WHERE username = ?
+        """, (username,))
+
+    async def get_cloud_part(self, username):
+        return await meta(_one, "SELECT encrypted_cloud_part FROM users WHERE LOWER(username) = LOWER(?)", (username,))
+
+    async def create(self, username, password, bio, encrypted_cloud_part, salt, verification_ciphertext):
+        def insert(cursor):
+            cursor.execute(
+                "INSERT INTO users (username, password, bio, encrypted_cloud_part, salt, verification_ciphertext) VALUES (?, ?, ?, ?, ?, ?)",
+                (username, password, bio, encrypted_cloud_part, salt, verification_ciphertext)
+            )
+            return cursor.lastrowid
+        try:
+            return await meta(insert)
+        except sqlite3.IntegrityError:
+            return None
+
+    async def update_profile(self, user_id, avatar_url=None, bio=None):
+        updates = []
+        values = []
+        if avatar_url is not None:
+            updates.append("avatar_url = ?")
+            values.append(avatar_url)
+        if bio is not None:
+            updates.append("bio = ?")
+            values.append(bio)
+        if not updates:
+            return await self.get_by_id(user_id) is not None
+
+        def update(cursor):
+            cursor.execute(f"UPDATE users SET {', '.join(updates)} WHERE id = ?", [*values, user_id])
+            if cursor.rowcount == 0:
+                return False, []
+            if avatar_url is None:
+                return True, []
+            chat_ids, partner_ids = _seen_by(cursor, user_id)
+            _bump_lists(cursor, partner_ids)
+            return True, chat_ids
+        updated, chat_ids = await meta(update)
+        await _bump_chats(chat_ids)
+        return updated
+
+    async def replace_avatar_url(self, user_id, old_url, new_url):
+        def update(cursor):
+            cursor.execute("UPDATE users SET avatar_url = ? WHERE id = ? AND avatar_url = ?", (new_url, user_id, old_url))
+            if cursor.rowcount == 0:
+                return False, []
+            chat_ids, partner_ids = _seen_by(cursor, user_id)
+            _bump_lists(cursor, partner_ids)
+            return True, chat_ids
+        replaced, chat_ids = await meta(update)
+        await _bump_chats(chat_ids)
+        return replaced
+
+    async def set_password(self, user_id, password):
+        await meta(lambda cursor: cursor.execute("UPDATE users SET password = ? WHERE id = ?", (password, user_id)))
+
+    async def delete(self, user_id):
+        def delete(cursor):
+            chat_ids, partner_ids = _seen_by(cursor, user_id)
+            _bump_lists(cursor, partner_ids)
+            # Memberships and inbox rows are purged in the background
+            cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
+            purge.enqueue(cursor, "user", user_id)
+            return chat_ids
+        chat_ids = await meta(delete)
+        purge.notify()
+        await _bump_chats(chat_ids)
+
+    async def search(self, query, limit=20):
+        return await meta(_all, "SELECT id, username, avatar_url FROM users WHERE username LIKE ? LIMIT ?",
+                          (f"%{query}%", limit))
+
+    async def resolve_usernames(self, usernames):
+        def resolve(cursor):
+            resolved = {}
+            for chunk in chunked(list(dict.fromkeys(usernames))):
+                placeholders = ", ".join("?" * len(chunk))
+                cursor.execute(f"SELECT id, username FROM users WHERE username IN ({placeholders})", chunk)
+                resolved.update({row["username"]: row["id"] for row in cursor.fetchall()})
+            return resolved
+        return await meta(resolve)
+
+    async def avatars(self, user_ids):
+        def lookup(cursor):
+            avatars = {}
+            for chunk in chunked(list(dict.fromkeys(user_ids))):
+                cursor.execute(f"SELECT id, avatar_url FROM users WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+                avatars.update({row["id"]: row["avatar_url"] for row in cursor.fetchall()})
+            return avatars
+        return await meta(lookup)
+
+@metrics.instrument_repository("chats")
+class SQLiteChatRepo(ChatRepo):
+    async def get_chat(self, chat_id):
+        return await meta(_one, """
+            SELECT id, name, type, user1_id, user2_id FROM chats WHERE id = ? AND deleted_at IS NULL
+        """, (chat_id,))
+
+    async def is_member(self, chat_id, user_id):
+        return await meta(_one, """
+            SELECT 1 FROM participants p JOIN chats c ON c.id = p.chat_id
+            WHERE p.chat_id = ? AND p.user_id = ? AND c.deleted_at IS NULL
+        """, (chat_id, user_id)) is not None
+
+    async def find_direct_chat(self, user1_id, user2_id):
+        row = await meta(_one, """
+            SELECT id FROM chats
+            WHERE type = 'one-on-one' AND deleted_at IS NULL AND (
+                (user1_id = ? AND user2_id = ?) OR
+                (user1_id = ? AND user2_id = ?)
+            )
+        """, (user1_id, user2_id, user2_id, user1_id))
+        return row["id"] if row else None
+
+    async def create_direct_chat(self, name, user1_id, user2_id):
+        def create(cursor):
+            cursor.execute("""
+                INSERT INTO chats (name, type, user1_id, user2_id)
+                VALUES (?, 'one-on-one', ?, ?)
+            """, (name, user1_id, user2_id))
+            chat_id = cursor.lastrowid
+            cursor.executemany("INSERT INTO participants (chat_id, user_id) VALUES (?, ?)",
+                               [(chat_id, user1_id), (chat_id, user2_id)])
+            _bump_lists(cursor, [user1_id, user2_id])
+            return chat_id
+        chat_id = await meta(create)
+        await shards.write(chat_id, inbox.add_members, chat_id, [user1_id, user2_id])
+        return chat_id
+
+    async def list_direct_chats(self, user_id):
+        return await meta(_all, """
+            SELECT c.id, c.name, c.user1_id, c.user2_id,
+                   u1.username AS user1_username, u1.avatar_url AS user1_avatar_url,
+                   u2.username AS user2_username, u2.avatar_url AS user2_avatar_url
+            FROM chats c
+            JOIN participants p ON c.id = p.chat_id
+            LEFT JOIN users u1 ON c.user1_id = u1.id
+            LEFT JOIN users u2 ON c.user2_id = u2.id
+            WHERE p.user_id = ? AND c.type = 'one-on-one' AND c.deleted_at IS NULL
+        """, (user_id,))
+
+    async def delete_chat(self, chat_id):
+        def tombstone(cursor):
+            # Hide the chat now, purge its rows in the background
+            cursor.execute("UPDATE chats SET deleted_at = CURRENT_TIMESTAMP WHERE id = ?", (chat_id,))
+            cursor.execute("SELECT user_id FROM participants WHERE chat_id = ?", (chat_id,))
+            _bump_lists(cursor, [row["user_id"] for row in cursor.fetchall()])
+            purge.enqueue(cursor, "chat", chat_id)
+        await meta(tombstone)
+        purge.notify()
+
+    async def create_group(self, name, admin_id, member_ids):
+        def create(cursor):
+            cursor.execute("INSERT INTO chats (name, type) VALUES (?, 'group')", (name,))
+            chat_id = cursor.lastrowid
+            cursor.execute("INSERT INTO groups (chat_id, admin_id) VALUES (?, ?)", (chat_id, admin_id))
+            cursor.executemany("INSERT INTO participants (chat_id, user_id) VALUES (?, ?)",
+                               [(chat_id, user_id) for user_id in member_ids])
+            _bump_lists(cursor, member_ids)
+            return chat_id
+        chat_id = await meta(create)
+        await shards.write(chat_id, inbox.add_members, chat_id, member_ids)
+        return chat_id
+
+    async def get_group(self, chat_id):
+        return await meta(_one, """
+            SELECT g.admin_id, c.name
+            FROM groups g
+            JOIN chats c ON g.chat_id = c.id
+            WHERE g.chat_id = ? AND c.type = 'group' AND c.deleted_at IS NULL
+        """, (chat_id,))
+
+    async def list_groups(self, user_id):
+        return await meta(_all, """
+            SELECT c.id, c.name, c.type
+            FROM chats c
+            JOIN participants p ON c.id = p.chat_id
+            WHERE p.user_id = ? AND c.type = 'group' AND c.deleted_at IS NULL
+        """, (user_id,))
+
+    async def member_ids_among(self, chat_id, user_ids):
+        def lookup(cursor):
+            existing = set()
+            for chunk in chunked(user_ids):
+                placeholders = ", ".join("?" * len(chunk))
+                cursor.execute(f"SELECT user_id FROM participants WHERE chat_id = ? AND user_id IN ({placeholders})",
+                               [chat_id, *chunk])
+                existing.update(row["user_id"] for row in cursor.fetchall())
+            return existing
+        return await meta(lookup)
+
+    async def add_members(self, chat_id, user_ids):
+        def add(cursor):
+            cursor.executemany("INSERT OR IGNORE INTO participants (chat_id, user_id) VALUES (?, ?)",
+                               [(chat_id, user_id) for user_id in user_ids])
+            _bump_lists(cursor, user_ids)
+        await meta(add)
+        await shards.write(chat_id, inbox.add_members, chat_id, user_ids)
+
+    async def remove_members(self, chat_id, user_ids):
+        def remove(cursor):
+            cursor.executemany("DELETE FROM participants WHERE chat_id = ? AND user_id = ?",
+                               [(chat_id, user_id) for user_id in user_ids])
+            _bump_lists(cursor, user_ids)
+        await meta(remove)
+        await shards.write(chat_id, inbox.remove_members, chat_id, user_ids)
+
+    async def list_version(self, user_id):
+        row = await meta(_one, "SELECT version FROM list_versions WHERE user_id = ?", (user_id,))
+        return row["version"] if row else 0
+
+    async def list_members(self, chat_id, after_id, limit):
+        return await meta(_all, """
+            SELECT u.id, u.username, u.avatar_url
+            FROM participants p
+            JOIN users u ON u.id = p.user_id
+            WHERE p.chat_id = ? AND p.user_id > ?
+            ORDER BY p.user_id
+            LIMIT ?
+        """, (chat_id, after_id, limit))
+
+    async def inbox(self, user_id, limit, before_activity=None, before_chat_id=None):
+        # Summaries live next to the messages of each chat, so every shard is
+        # asked for its newest page and the pages are merged here.
+        params = [user_id]
+        keyset = ""
+        if before_activity is not None:
+            keyset = "AND (last_activity, chat_id) < (?, ?)"
+            params += [before_activity, before_chat_id]
+        params.append(limit)
+        query = f"""
+            SELECT chat_id, last_message_id, last_message_preview, last_sender,
+                   last_activity, unread_count
+            FROM chat_summaries
+            WHERE user_id = ? {keyset}
+            ORDER BY last_activity DESC, chat_id DESC
+            LIMIT ?
+        """
+        pages = await asyncio.gather(*(read_shard(shard, _all, query, params) for shard in shards.all_shards()))
+        summaries = [row for page in pages for row in page]
+        summaries.sort(key=lambda row: (row["last_activity"], row["chat_id"]), reverse=True)
+        return summaries[:limit]
+
+    async def chats_by_id(self, chat_ids, viewer_id):
+        def lookup(cursor):
+            chats = {}
+            for chunk in chunked(chat_ids):
+                cursor.execute(f"""
+                    SELECT c.id, c.name, c.type, u.username AS interlocutor_name,
+                           u.avatar_url AS interlocutor_avatar_url
+                    FROM chats c
+                    LEFT JOIN users u ON c.type = 'one-on-one'
+                        AND u.id = CASE WHEN c.user1_id = ? THEN c.user2_id ELSE c.user1_id END
+                    WHERE c.id IN ({", ".join("?" * len(chunk))}) AND c.deleted_at IS NULL
+                """, [viewer_id, *chunk])
+                chats.update({row["id"]: dict(row) for row in cursor.fetchall()})
+            return chats
+        return await meta(lookup)
+
+def _history(cursor, chat_id: int, before_id: int | None, limit: int | None) -> list[dict]:
+    query = """
+        SELECT id, content, timestamp, sender_name, sender_id, reply_to, reactions, read_by,
+               type, file_url, file_name, file_type, file_size, duration_ms, waveform
+        FROM messages
+        WHERE chat_id = ?
+    """
+    params = [chat_id]
+    if before_id is not None:
+        query += " AND id < ?"
+        params.append(before_id)
+    query += " ORDER BY id DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    cursor.execute(query, params)
+    messages = cursor.fetchall()
+
+    # Archived messages are read transparently after the hot table runs out
+    if limit is None or len(messages) < limit:
+        oldest_hot_id = messages[-1]["id"] if messages else before_id
+        messages += archive.read_history(
+            cursor, chat_id, oldest_hot_id, None if limit is None else limit - len(messages)
+        )
+    return [dict(msg) for msg in messages]
+
+def _files(cursor, chat_id: int, file_type: str | None, before_id: int | None, limit: int) -> list[dict]:
+    # The partial index on file messages keeps this off the text messages
+    query = """
+        SELECT id, sender_id, sender_name, timestamp, file_url, file_name, file_type, file_size, duration_ms, waveform
+        FROM messages
+        WHERE chat_id = ? AND type = 'file'
+    """
+    params = [chat_id]
+    if file_type is not None:
+        query += " AND file_type = ?"
+        params.append(file_type)
+    if before_id is not None:
+        query += " AND id < ?"
+        params.append(before_id)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    cursor.execute(query, params)
+    files = cursor.fetchall()
+
+    if len(files) < limit:
+        files += archive.read_files(cursor, chat_id, file_type, files[-1]["id"] if files else before_id,
+                                    limit - len(files))
+    return [dict(row) for row in files]
+
+def _export_page(cursor, chat_id: int, after_id: int, limit: int, since: str | None, until: str | None) -> list[dict]:
+    # Archived messages are older than the hot ones, so they come first
+    rows = archive.read_after(cursor, chat_id, after_id, limit, since, until)
+    if len(rows) < limit:
+        query, params = archive.range_query(chat_id, rows[-1]["id"] if rows else after_id, since, until, limit - len(rows))
+        cursor.execute(query, params)
+        rows.extend(cursor.fetchall())
+    return [dict(row) for row in rows]
+
+@metrics.instrument_repository("messages")
+class SQLiteMessageRepo(MessageRepo):
+    async def insert(self, chat_id, sender_id, sender_name, content, reply_to=None, attachment=None, timestamp=None,
+                     client_msg_id=None, user_quota=None, chat_quota=None):
+        return await shards.write(chat_id, message_store.insert_message, chat_id, sender_id, sender_name, content,
+                                  reply_to, attachment, timestamp, client_msg_id, user_quota, chat_quota)
+
+    async def edit(self, chat_id, message_id, user_id, content):
+        await shards.write(chat_id, message_store.edit_message, chat_id, message_id, user_id, content)
+
+    async def delete(self, chat_id, message_id, user_id):
+        await shards.write(chat_id, message_store.delete_message, chat_id, message_id, user_id)
+
+    async def add_reaction(self, chat_id, message_id, user_id, reaction):
+        await shards.write(chat_id, message_store.add_reaction, chat_id, message_id, user_id, reaction)
+
+    async def remove_reaction(self, chat_id, message_id, user_id, reaction):
+        await shards.write(chat_id, message_store.remove_reaction, chat_id, message_id, user_id, reaction)
+
+    async def mark_read(self, chat_id, message_id, user_id):
+        return await shards.write(chat_id, message_store.mark_read, chat_id, message_id, user_id)
+
+    async def version(self, chat_id):
+        row = await shard_read(chat_id, _one, "SELECT version FROM chat_versions WHERE chat_id = ?", (chat_id,))
+        return row["version"] if row else 0
+
+    async def history(self, chat_id, before_id=None, limit=None):
+        return await shard_read(chat_id, _history, chat_id, before_id, limit)
+
+    async def files(self, chat_id, file_type=None, before_id=None, limit=50):
+        return await shard_read(chat_id, _files, chat_id, file_type, before_id, limit)
+
+    async def export_page(self, chat_id, after_id=0, limit=1000, since=None, until=None):
+        return await shard_read(chat_id, _export_page, chat_id, after_id, limit, since, until)
+
+    async def user_usage(self, user_id):
+        # A user's files are counted in the shard of each chat they were sent to
+        rows = await asyncio.gather(*(
+            read_shard(shard, _one, "SELECT bytes, files FROM user_storage WHERE user_id = ?", (user_id,))
+            for shard in shards.all_shards()
+        ))
+        return {"bytes": sum(row["bytes"] for row in rows if row), "files": sum(row["files"] for row in rows if row)}
+
+    async def chat_usage(self, chat_id):
+        row = await shard_read(chat_id, _one, "SELECT bytes, files FROM chat_storage WHERE chat_id = ?", (chat_id,))
+        return row or {"bytes": 0, "files": 0}
+
+class SQLiteRepositories(Repositories):
+    def __init__(self):
+        super().__init__(SQLiteUserRepo(), SQLiteChatRepo(), SQLiteMessageRepo(), "sqlite")
+        self.tasks = []
+
+    async def start(self):
+        # Before anything reads the schema; a no-op read when the files are current
+        await asyncio.to_thread(migrations.migrate)
+        self.tasks = [asyncio.create_task(purge.run_purger()), asyncio.create_task(archive.run_archiver()),
+                      asyncio.create_task(media_gc.run_collector())]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        # Writes queued by requests that finished during shutdown still land
+        await asyncio.to_thread(shards.shutdown)
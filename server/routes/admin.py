@@ -0,0 +1,106 @@
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from server import media, media_gc, slow_queries, storage
+from server.routes.auth import get_current_user
+from server.routes.messages import NDJSON, export_lines
+from datetime import datetime
+from typing import Optional
+import json
+import logging
+import os
+
+router = APIRouter()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Comma-separated usernames allowed to use /admin; empty means nobody
+ADMIN_USERS = {name.strip() for name in os.environ.get("MESSENGER_ADMIN_USERS", "").split(",") if name.strip()}
+
+async def get_admin_user(current_user: dict = Depends(get_current_user)):
+    if current_user["username"] not in ADMIN_USERS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
+@router.get("/slow-queries")
+async def get_slow_queries(
+    limit: int = Query(50, ge=1, le=slow_queries.SLOW_QUERY_LOG_SIZE),
+    admin: dict = Depends(get_admin_user)
+):
+    """Recent statements slower than MESSENGER_SLOW_QUERY_MS, newest first."""
+    recent = list(slow_queries.records)[-limit:]
+    recent.reverse()
+    return {
+        "threshold_ms": slow_queries.SLOW_QUERY_MS,
+        "recorded": len(slow_queries.records),
+        "queries": recent
+    }
+
+@router.delete("/slow-queries")
+async def clear_slow_queries(admin: dict = Depends(get_admin_user)):
+    slow_queries.records.clear()
+    logger.info(f"Slow query log cleared by {admin['username']}")
+    return {"message": "Slow query log cleared"}
+
+@router.post("/media/migrate")
+async def start_media_migration(admin: dict = Depends(get_admin_user)):
+    """Move stored uploads and avatars into the fanned-out directory layout in the background."""
+    if storage.repos.backend != "sqlite":
+        raise HTTPException(status_code=400, detail="Only the sqlite backend has stored files to move")
+    if media.layout_migration.start():
+        logger.info(f"File layout migration started by {admin['username']}")
+    return media.layout_migration.status()
+
+@router.get("/media/migrate")
+async def get_media_migration(admin: dict = Depends(get_admin_user)):
+    return media.layout_migration.status()
+
+@router.post("/media/gc")
+async def start_media_gc(admin: dict = Depends(get_admin_user)):
+    """Start a pass deleting stored files nothing refers to, unless one is in progress."""
+    if storage.repos.backend != "sqlite":
+        raise HTTPException(status_code=400, detail="Only the sqlite backend has stored files to collect")
+    if await asyncio.to_thread(media_gc.start_pass):
+        logger.info(f"Orphaned file collection started by {admin['username']}")
+    media_gc.notify()
+    return await asyncio.to_thread(media_gc.status)
+
+@router.get("/media/gc")
+async def get_media_gc(admin: dict = Depends(get_admin_user)):
+    """Progress of the pass in progress and what the last one reclaimed."""
+    return await asyncio.to_thread(media_gc.status)
+
+async def account_lines(user: dict, from_chat_id: int, after_id: int,
+                        since: Optional[datetime], until: Optional[datetime]):
+    yield json.dumps({"type": "account", **user}, ensure_ascii=False) + "\n"
+    chats = await storage.repos.chats.list_direct_chats(user["id"])
+    chats += await storage.repos.chats.list_groups(user["id"])
+    for chat in sorted(chats, key=lambda chat: chat["id"]):
+        if chat["id"] < from_chat_id:
+            continue
+        chat_type = chat.get("type", "one-on-one")
+        yield json.dumps({"type": "chat", "chat_id": chat["id"], "name": chat["name"], "chat_type": chat_type},
+                         ensure_ascii=False) + "\n"
+        async for line in export_lines(chat["id"], after_id if chat["id"] == from_chat_id else 0, since, until):
+            yield line
+
+@router.get("/export/{user_id}")
+async def export_account(
+    user_id: int,
+    from_chat_id: int = Query(0, ge=0),
+    after_id: int = Query(0, ge=0),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    admin: dict = Depends(get_admin_user)
+):
+    """Stream every chat of an account as NDJSON, chat by chat in id order.
+
+    Each chat starts with a {"type": "chat"} line and ends with the end line
+    of /messages/export; resume with `from_chat_id` and that chat's `after_id`.
+    """
+    user = await storage.repos.users.get_by_id(user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    logger.info(f"Account export of user {user_id} started by {admin['username']}")
+    return StreamingResponse(account_lines(user, from_chat_id, after_id, since, until), media_type=NDJSON)
@@ -1,4 +1,4 @@
-import sqlite3
+import asyncio
 from fastapi import APIRouter, HTTPException, Depends, status, File, UploadFile
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
@@ -6,8 +6,7 @@ from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional
 import secrets
-from server.database import get_connection
-from pathlib import Path
+from server import history_cache, logs, media, metrics, storage
 import subprocess
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
@@ -104,24 +103,17 @@ def create_recovery_token(user_id: int):
     token = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
     return token
 
-def verify_token(token: str):
+async def verify_token(token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("sub")
         if user_id is None:
             return None
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, username, avatar_url, bio FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        if user:
-            return {"id": user[0], "username": user[1], "avatar_url": user[2], "bio": user[3]}
-        return None
+        return await storage.repos.users.get_by_id(int(user_id))
     except JWTError:
         return None    
 
-def verify_recovery_token(token: str):
+async def verify_recovery_token(token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         if payload.get("type") != "recovery":
@@ -129,36 +121,27 @@ def verify_recovery_token(token: str):
         user_id = payload.get("sub")
         if user_id is None:
             return None
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, username FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
-        conn.close()
+        user = await storage.repos.users.get_by_id(int(user_id))
         if user:
-            return {"id": user[0], "username": user[1]}
+            return {"id": user["id"], "username": user["username"]}
         return None
     except JWTError:
         return None
 
-def get_user_by_id(user_id: int):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, username, avatar_url, bio FROM users WHERE id = ?", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        return {"id": row[0], "username": row[1], "avatar_url": row[2], "bio": row[3]}
-    return None
+async def get_user_by_id(user_id: int):
+    return await storage.repos.users.get_by_id(user_id)
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = int(payload.get("sub"))
-        user = get_user_by_id(user_id)
+        user = await get_user_by_id(user_id)
         if not user:
+            metrics.AUTH_FAILURES.inc("unknown_user")
             raise HTTPException(status_code=401, detail="Invalid token")
         return user
     except JWTError:
+        metrics.AUTH_FAILURES.inc("invalid_token")
         raise HTTPException(status_code=401, detail="Invalid token")
 
 def split_master_key(master_key_hex: str, shares: int = 3, threshold: int = 2):
@@ -176,13 +159,13 @@ def split_master_key(master_key_hex: str, shares: int = 3, threshold: int = 2):
 
 def combine_master_key(shares: list[str]):
     try:
-        logger.info(f"Combining shares: {shares}")
+        logger.info(f"Combining shares: {logs.redact(shares)}")
         shares_input = '\n'.join(shares) + '\n'
         result = subprocess.run(
             ['ssss-combine', '-t', '2'],
             input=shares_input, text=True, capture_output=True
         )
-        logger.info(f"ssss-combine stdout: {result.stdout}")
+        logger.info(f"ssss-combine stdout: {logs.redact(result.stdout)}")
         logger.info(f"ssss-combine stderr: {result.stderr}")
         if result.returncode != 0:
             raise Exception(f"ssss-combine failed: {result.stderr}")
@@ -190,7 +173,7 @@ def combine_master_key(shares: list[str]):
         for line in output.splitlines():
             if "Resulting secret: " in line:
                 master_key_hex = line.split("Resulting secret: ")[1].strip()
-                logger.info(f"Recovered master_key_hex: {master_key_hex}")
+                logger.info(f"Recovered master_key_hex: {logs.redact(master_key_hex)}")
                 return master_key_hex
         raise Exception("Could not find master key in ssss-combine output")
     except Exception as e:
@@ -198,14 +181,12 @@ def combine_master_key(shares: list[str]):
         raise Exception(f"Error combining master key: {e}")
 
 @router.post("/register", response_model=Token)
-def register(user: User):
-    conn = get_connection()
-    cursor = conn.cursor()
+async def register(user: User):
     try:
         master_key = secrets.token_bytes(32)
         master_key_hex = master_key.hex()
-        shares = split_master_key(master_key_hex)
-        logger.info(f"Generated shares: {shares}")
+        shares = await asyncio.to_thread(split_master_key, master_key_hex)
+        logger.info(f"Generated shares: {logs.redact(shares)}")
         device_part = shares[0]
         cloud_part = shares[1]
         qr_part = shares[2]
@@ -218,21 +199,14 @@ def register(user: User):
         encryptor = cipher.encryptor()
         ciphertext = encryptor.update(padded_data) + encryptor.finalize()
         verification_ciphertext = base64.b64encode(iv + ciphertext).decode()
-        password_field = hash_password_with_salt(user.password)
-        cursor.execute(
-            "INSERT INTO users (username, password, bio, encrypted_cloud_part, salt, verification_ciphertext) VALUES (?, ?, ?, ?, ?, ?)",
-            (user.username, password_field, user.bio or "", cloud_part_plain, salt, verification_ciphertext)
+        password_field = await asyncio.to_thread(hash_password_with_salt, user.password)
+        user_id = await storage.repos.users.create(
+            user.username, password_field, user.bio or "", cloud_part_plain, salt, verification_ciphertext
         )
-        conn.commit()
-        user_id = cursor.lastrowid
-    except sqlite3.IntegrityError:
-        conn.close()
-        raise HTTPException(status_code=400, detail="User already exists")
     except Exception as e:
-        conn.close()
         raise HTTPException(status_code=500, detail=f"Error during registration: {str(e)}")
-    finally:
-        conn.close()
+    if user_id is None:
+        raise HTTPException(status_code=400, detail="User already exists")
     token = create_access_token(user_id)
     return {
         "access_token": token,
@@ -242,16 +216,12 @@ def register(user: User):
     }
 
 @router.post("/login", response_model=Token)
-def login(user: User):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, password FROM users WHERE username = ?", (user.username,))
-    db_user = cursor.fetchone()
-    if not db_user or not verify_password(db_user[1], user.password):
-        conn.close()
+async def login(user: User):
+    db_user = await storage.repos.users.get_credentials(user.username)
+    if not db_user or not await asyncio.to_thread(verify_password, db_user["password"], user.password):
+        metrics.AUTH_FAILURES.inc("bad_credentials")
         raise HTTPException(status_code=401, detail="Incorrect username or password")
-    conn.close()
-    token = create_access_token(db_user[0])
+    token = create_access_token(db_user["id"])
     return {"access_token": token, "token_type": "bearer"}
 
 @router.get("/me")
@@ -265,106 +235,67 @@ async def get_me(current_user: dict = Depends(get_current_user)):
 
 @router.put("/me")
 async def update_user_profile(update: UserUpdate = None, current_user: dict = Depends(get_current_user)):
-    conn = get_connection()
-    cursor = conn.cursor()
-    updates = []
-    values = []
-    if update:
-        if update.avatar_url is not None:
-            updates.append("avatar_url = ?")
-            values.append(update.avatar_url)
-        if update.bio is not None:
-            updates.append("bio = ?")
-            values.append(update.bio)
+    updates = bool(update) and (update.avatar_url is not None or update.bio is not None)
     if updates:
-        query = f"UPDATE users SET {', '.join(updates)} WHERE id = ?"
-        values.append(current_user["id"])
-        cursor.execute(query, values)
-        conn.commit()
-    conn.close()
+        await storage.repos.users.update_profile(current_user["id"], avatar_url=update.avatar_url, bio=update.bio)
+        if update.avatar_url is not None:
+            history_cache.cache.set_avatar(current_user["id"], update.avatar_url)
     return {"message": "Profile updated" if updates else "No updates provided"}
 
 @router.post("/me/avatar")
 async def upload_avatar(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
-    username = current_user["username"]
-    upload_dir = Path(f"static/avatars/{username}")
-    upload_dir.mkdir(parents=True, exist_ok=True)
-    file_path = upload_dir / file.filename
-    with file_path.open("wb") as buffer:
-        buffer.write(await file.read())
-    avatar_url = f"/static/avatars/{username}/{file.filename}"
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET avatar_url = ? WHERE id = ?", (avatar_url, current_user["id"]))
-    conn.commit()
-    conn.close()
+    _, avatar_url = media.save("avatars", file.filename, await file.read())
+    await storage.repos.users.update_profile(current_user["id"], avatar_url=avatar_url)
+    history_cache.cache.set_avatar(current_user["id"], avatar_url)
     return {"avatar_url": avatar_url}
 
 @router.post("/me/bio")
 async def update_user_bio(bio_data: UserUpdate, current_user: dict = Depends(get_current_user)):
-    conn = get_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("UPDATE users SET bio = ? WHERE id = ?", (bio_data.bio, current_user["id"]))
-        if cursor.rowcount == 0:
+        if not await storage.repos.users.update_profile(current_user["id"], bio=bio_data.bio):
             raise HTTPException(status_code=404, detail="User not found")
-        conn.commit()
         return {"message": "Bio updated"}
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"Error updating bio: {str(e)}")
-    finally:
-        conn.close()
 
 @router.get("/users/{username}")
 async def get_user_avatar(username: str):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT avatar_url, bio FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    conn.close()
-    if not user or not user[0]:
-        return {"avatar_url": "/static/avatars/default.jpg", "bio": user[1] if user else ""}
-    return {"avatar_url": user[0], "bio": user[1] or ""}
+    user = await storage.repos.users.get_by_username(username)
+    if not user or not user["avatar_url"]:
+        return {"avatar_url": "/static/avatars/default.jpg", "bio": user["bio"] if user else ""}
+    return {"avatar_url": user["avatar_url"], "bio": user["bio"] or ""}
 
 @router.delete("/me")
 async def delete_account(current_user: dict = Depends(get_current_user)):
-    conn = get_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("DELETE FROM participants WHERE user_id = ?", (current_user["id"],))
-        cursor.execute("DELETE FROM users WHERE id = ?", (current_user["id"],))
-        conn.commit()
+        await storage.repos.users.delete(current_user["id"])
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"Error deleting account: {str(e)}")
-    finally:
-        conn.close()
+    history_cache.cache.set_avatar(current_user["id"], None)
+    from server.websocket import manager  # server.websocket imports this module
+    await manager.close_user(current_user["id"])
     return {"message": "Account deleted"}
 
 @router.post("/recover")
-def recover_password(recovery: RecoveryRequest):
+async def recover_password(recovery: RecoveryRequest):
     logger.info(f"Recovery request for username: {recovery.username}")
-    logger.info(f"Provided part1: {recovery.part1}")
-    logger.info(f"Provided part2: {recovery.part2}")
-    conn = get_connection()
-    cursor = conn.cursor()
+    logger.info(f"Provided part1: {logs.redact(recovery.part1)}")
+    logger.info(f"Provided part2: {logs.redact(recovery.part2)}")
     try:
-        cursor.execute("SELECT id, encrypted_cloud_part, salt, verification_ciphertext FROM users WHERE username = ?", (recovery.username,))
-        user = cursor.fetchone()
+        user = await storage.repos.users.get_recovery_data(recovery.username)
         if not user:
             logger.warning(f"User not found: {recovery.username}")
             raise HTTPException(status_code=404, detail="User not found")
         shares = [recovery.part1, recovery.part2]
         try:
-            master_key_hex = combine_master_key(shares)
-            logger.info(f"Successfully combined master key: {master_key_hex}")
+            master_key_hex = await asyncio.to_thread(combine_master_key, shares)
+            logger.info(f"Successfully combined master key: {logs.redact(master_key_hex)}")
             master_key = bytes.fromhex(master_key_hex)
         except Exception as e:
             logger.error(f"Failed to combine shares: {str(e)}")
             raise HTTPException(status_code=400, detail="Invalid parts provided")
         try:
-            verification_data = base64.b64decode(user[3])
+            verification_data = base64.b64decode(user["verification_ciphertext"])
             iv = verification_data[:16]
             ciphertext = verification_data[16:]
             cipher = Cipher(algorithms.AES(master_key), modes.CBC(iv), backend=default_backend())
@@ -380,48 +311,37 @@ def recover_password(recovery: RecoveryRequest):
         if decrypted_username != recovery.username:
             logger.warning(f"Decrypted username mismatch: expected {recovery.username}, got {decrypted_username}")
             raise HTTPException(status_code=400, detail="Invalid parts provided")
-        recovery_token = create_recovery_token(user[0])
-        logger.info(f"Recovery token generated for user ID {user[0]}")
+        recovery_token = create_recovery_token(user["id"])
+        logger.info(f"Recovery token generated for user ID {user['id']}")
         return {"message": "Password recovery successful.", "recovery_token": recovery_token}
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Unexpected error during recovery: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error during password recovery: {str(e)}")
-    finally:
-        conn.close()
 
 @router.post("/reset-password")
-def reset_password(request: ResetPasswordRequest):
-    conn = get_connection()
-    cursor = conn.cursor()
+async def reset_password(request: ResetPasswordRequest):
     try:
-        user = verify_recovery_token(request.recovery_token)
+        user = await verify_recovery_token(request.recovery_token)
         if not user:
+            metrics.AUTH_FAILURES.inc("recovery_token")
             raise HTTPException(status_code=401, detail="Invalid or expired recovery token")
-        password_field = hash_password_with_salt(request.new_password)
-        cursor.execute("UPDATE users SET password = ? WHERE id = ?", (password_field, user["id"]))
-        conn.commit()
+        password_field = await asyncio.to_thread(hash_password_with_salt, request.new_password)
+        await storage.repos.users.set_password(user["id"], password_field)
         return {"message": "Password reset successful."}
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"Error resetting password: {str(e)}")
-    finally:
-        conn.close()
 
 @router.get("/get-cloud-part")
 async def get_cloud_part(username: str):
-    conn = get_connection()
-    cursor = conn.cursor()
     logger.info(f"Fetching cloud part for username: {username}")
-    cursor.execute("SELECT encrypted_cloud_part FROM users WHERE LOWER(username) = LOWER(?)", (username,))
-    row = cursor.fetchone()
-    conn.close()
+    row = await storage.repos.users.get_cloud_part(username)
     if not row:
         logger.warning(f"No user found with username: {username}")
         raise HTTPException(status_code=404, detail="User not found")
-    if not row[0]:
+    if not row["encrypted_cloud_part"]:
         logger.warning(f"User found but encrypted_cloud_part is missing for username: {username}")
         raise HTTPException(status_code=404, detail="Cloud part not found")
     logger.info(f"Successfully retrieved encrypted_cloud_part for username: {username}")
-    return {"encrypted_cloud_part": row[0]}
\ No newline at end of file
+    return {"encrypted_cloud_part": row["encrypted_cloud_part"]}
\ No newline at end of file
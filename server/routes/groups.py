@@ -1,6 +1,6 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from pydantic import BaseModel
-from server.database import get_connection
+from server import etags, history_cache, storage
 from server.routes.auth import get_current_user
 from server.websocket import manager
 import logging
@@ -14,22 +14,33 @@ class GroupCreate(BaseModel):
     name: str
     participants: list[str]
 
+class GroupMembers(BaseModel):
+    usernames: list[str]
+
+async def resolve_usernames(usernames: list[str]) -> dict[str, int]:
+    """Map usernames to user ids in one batch; raises 404 on unknown names."""
+    unique = list(dict.fromkeys(usernames))
+    resolved = await storage.repos.users.resolve_usernames(unique)
+    missing = [username for username in unique if username not in resolved]
+    if missing:
+        if len(missing) == 1:
+            raise HTTPException(status_code=404, detail=f"User {missing[0]} not found")
+        raise HTTPException(status_code=404, detail=f"Users not found: {', '.join(missing[:20])}")
+    return {username: resolved[username] for username in unique}
+
+async def get_group(chat_id: int) -> dict:
+    group = await storage.repos.chats.get_group(chat_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return group
+
 @router.post("/create")
 async def create_group(group: GroupCreate, current_user: dict = Depends(get_current_user)):
-    conn = get_connection()
-    cursor = conn.cursor()
-
     try:
         # Validate participants
-        participant_ids = []
-        participant_usernames = []
-        for username in group.participants:
-            cursor.execute("SELECT id, username FROM users WHERE username = ?", (username,))
-            user = cursor.fetchone()
-            if not user:
-                raise HTTPException(status_code=404, detail=f"User {username} not found")
-            participant_ids.append(user["id"])
-            participant_usernames.append(user["username"])
+        resolved = await resolve_usernames(group.participants)
+        participant_ids = list(resolved.values())
+        participant_usernames = list(resolved.keys())
 
         # Include the creator if not already in participants
         creator_id = current_user["id"]
@@ -38,24 +49,7 @@ async def create_group(group: GroupCreate, current_user: dict = Depends(get_curr
             participant_ids.append(creator_id)
             participant_usernames.append(creator_username)
 
-        # Create chat entry
-        cursor.execute("""
-            INSERT INTO chats (name, type)
-            VALUES (?, 'group')
-        """, (group.name,))
-        chat_id = cursor.lastrowid
-
-        # Create group entry
-        cursor.execute("""
-            INSERT INTO groups (chat_id, admin_id)
-            VALUES (?, ?)
-        """, (chat_id, creator_id))
-
-        # Add participants
-        for user_id in set(participant_ids):  # Avoid duplicates
-            cursor.execute("INSERT INTO participants (chat_id, user_id) VALUES (?, ?)", (chat_id, user_id))
-
-        conn.commit()
+        chat_id = await storage.repos.chats.create_group(group.name, creator_id, participant_ids)
 
         # Notify via WebSocket
         message = {
@@ -63,7 +57,7 @@ async def create_group(group: GroupCreate, current_user: dict = Depends(get_curr
             "group": {
                 "chat_id": chat_id,
                 "name": group.name,
-                "participants": list(set(participant_usernames))
+                "participants": participant_usernames
             }
         }
         await manager.broadcast(0, message)  # Broadcast to chat_id=0 for chat list updates
@@ -73,29 +67,22 @@ async def create_group(group: GroupCreate, current_user: dict = Depends(get_curr
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         logger.error(f"Error creating group: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error creating group: {str(e)}")
-    finally:
-        conn.close()
 
 @router.get("/list/{username}")
-async def list_groups(username: str, current_user: dict = Depends(get_current_user)):
+async def list_groups(username: str, request: Request, response: Response,
+                      current_user: dict = Depends(get_current_user)):
     if current_user["username"] != username:
         raise HTTPException(status_code=403, detail="You can only view your own groups")
 
-    conn = get_connection()
-    cursor = conn.cursor()
-
     try:
-        cursor.execute("""
-            SELECT c.id, c.name, c.type
-            FROM chats c
-            JOIN participants p ON c.id = p.chat_id
-            JOIN users u ON p.user_id = u.id
-            WHERE u.username = ? AND c.type = 'group'
-        """, (username,))
-        groups = cursor.fetchall()
+        tag = etags.etag("g", current_user["id"], await storage.repos.chats.list_version(current_user["id"]))
+        if etags.matches(request, tag):
+            return etags.not_modified(tag)
+        etags.set_headers(response, tag)
+
+        groups = await storage.repos.chats.list_groups(current_user["id"])
 
         return {
             "groups": [
@@ -106,47 +93,131 @@ async def list_groups(username: str, current_user: dict = Depends(get_current_us
     except Exception as e:
         logger.error(f"Error fetching groups: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching groups: {str(e)}")
-    finally:
-        conn.close()
+
+@router.post("/{chat_id}/members")
+async def add_members(chat_id: int, members: GroupMembers, current_user: dict = Depends(get_current_user)):
+    try:
+        group = await get_group(chat_id)
+        if group["admin_id"] != current_user["id"]:
+            raise HTTPException(status_code=403, detail="Only the group admin can add members")
+
+        resolved = await resolve_usernames(members.usernames)
+        existing = await storage.repos.chats.member_ids_among(chat_id, list(resolved.values()))
+        added = {username: user_id for username, user_id in resolved.items() if user_id not in existing}
+
+        if added:
+            await storage.repos.chats.add_members(chat_id, list(added.values()))
+
+            # One aggregated notification for the whole batch
+            message = {
+                "type": "group_members_added",
+                "chat_id": chat_id,
+                "name": group["name"],
+                "usernames": list(added.keys())
+            }
+            # Only the added users' chat lists change; members see it in the group itself
+            await manager.broadcast(0, message, set(added.values()))
+            await manager.broadcast(chat_id, message)
+            logger.info(f"Added {len(added)} members to group chat_id={chat_id}")
+
+        return {"added": list(added.keys()), "already_members": len(resolved) - len(added)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error adding group members: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error adding group members: {str(e)}")
+
+@router.post("/{chat_id}/members/remove")
+async def remove_members(chat_id: int, members: GroupMembers, current_user: dict = Depends(get_current_user)):
+    try:
+        group = await get_group(chat_id)
+        is_admin = group["admin_id"] == current_user["id"]
+        if not is_admin and members.usernames != [current_user["username"]]:
+            raise HTTPException(status_code=403, detail="Only the group admin can remove other members")
+
+        resolved = await resolve_usernames(members.usernames)
+        if group["admin_id"] in resolved.values():
+            raise HTTPException(status_code=400, detail="The group admin cannot be removed")
+
+        existing = await storage.repos.chats.member_ids_among(chat_id, list(resolved.values()))
+        removed = {username: user_id for username, user_id in resolved.items() if user_id in existing}
+
+        if removed:
+            await storage.repos.chats.remove_members(chat_id, list(removed.values()))
+
+            message = {
+                "type": "group_members_removed",
+                "chat_id": chat_id,
+                "name": group["name"],
+                "usernames": list(removed.keys())
+            }
+            await manager.broadcast(0, message, set(removed.values()))
+            await manager.broadcast(chat_id, message)
+            await manager.close_users(chat_id, set(removed.values()))
+            logger.info(f"Removed {len(removed)} members from group chat_id={chat_id}")
+
+        return {"removed": list(removed.keys())}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error removing group members: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error removing group members: {str(e)}")
+
+@router.get("/{chat_id}/members")
+async def list_members(
+    chat_id: int,
+    after_id: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: dict = Depends(get_current_user)
+):
+    """Members ordered by user id; pass `next_after_id` back as `after_id` for the next page."""
+    try:
+        group = await get_group(chat_id)
+        if not await storage.repos.chats.is_member(chat_id, current_user["id"]):
+            raise HTTPException(status_code=403, detail="You are not a member of this group")
+
+        rows = await storage.repos.chats.list_members(chat_id, after_id, limit + 1)
+
+        members = [
+            {
+                "id": row["id"],
+                "username": row["username"],
+                "avatar_url": row["avatar_url"] or "/static/avatars/default.jpg",
+                "is_admin": row["id"] == group["admin_id"]
+            }
+            for row in rows[:limit]
+        ]
+        return {
+            "members": members,
+            "next_after_id": rows[limit - 1]["id"] if len(rows) > limit else None
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching group members: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error fetching group members: {str(e)}")
 
 @router.delete("/delete/{chat_id}")
 async def delete_group(chat_id: int, current_user: dict = Depends(get_current_user)):
-    conn = get_connection()
-    cursor = conn.cursor()
-
     try:
         # Check if chat exists and user is admin
-        cursor.execute("""
-            SELECT g.admin_id
-            FROM groups g
-            JOIN chats c ON g.chat_id = c.id
-            WHERE g.chat_id = ? AND c.type = 'group'
-        """, (chat_id,))
-        group = cursor.fetchone()
-        if not group:
-            raise HTTPException(status_code=404, detail="Group not found")
+        group = await get_group(chat_id)
         if group["admin_id"] != current_user["id"]:
             raise HTTPException(status_code=403, detail="Only the group admin can delete the group")
 
-        # Delete related data
-        cursor.execute("DELETE FROM participants WHERE chat_id = ?", (chat_id,))
-        cursor.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
-        cursor.execute("DELETE FROM groups WHERE chat_id = ?", (chat_id,))
-        cursor.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
-
-        conn.commit()
+        await storage.repos.chats.delete_chat(chat_id)
+        history_cache.cache.drop_chat(chat_id)
 
         # Notify via WebSocket
         message = {"type": "chat_deleted", "chat_id": chat_id}
         await manager.broadcast(0, message)  # Broadcast to chat_id=0 for chat list updates
+        await manager.broadcast(chat_id, message)
+        await manager.close_chat(chat_id)
         logger.info(f"Sent chat_deleted notification for chat_id={chat_id} to chat_id=0")
 
         return {"message": "Group deleted successfully"}
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         logger.error(f"Error deleting group: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error deleting group: {str(e)}")
-    finally:
-        conn.close()
\ No newline at end of file
@@ -0,0 +1,65 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import Optional
+from server import storage
+from server.routes.auth import get_current_user
+import logging
+
+router = APIRouter()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_AVATAR = "/static/avatars/default.jpg"
+
+@router.get("")
+async def get_inbox(
+    limit: int = Query(50, ge=1, le=200),
+    before_activity: Optional[str] = None,
+    before_chat_id: Optional[int] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Chats and groups of the current user, most recently active first.
+
+    Pass `next_cursor` from the previous page as `before_activity` and
+    `before_chat_id` to fetch the next one. With SQLite storage this costs one
+    query per shard plus one metadata query, whatever the number of chats.
+    """
+    if (before_activity is None) != (before_chat_id is None):
+        raise HTTPException(status_code=400, detail="before_activity and before_chat_id must be given together")
+
+    try:
+        summaries = await storage.repos.chats.inbox(current_user["id"], limit + 1, before_activity, before_chat_id)
+        chats = {}
+        if summaries:
+            chats = await storage.repos.chats.chats_by_id([row["chat_id"] for row in summaries], current_user["id"])
+
+        items = []
+        for row in summaries[:limit]:
+            chat = chats.get(row["chat_id"])
+            if chat is None:
+                continue  # Deleted, waiting to be purged
+            is_group = chat["type"] == "group"
+            items.append({
+                "chat_id": row["chat_id"],
+                "type": chat["type"],
+                "name": chat["name"] if is_group else (chat["interlocutor_name"] or "Deleted User"),
+                "avatar_url": None if is_group else (chat["interlocutor_avatar_url"] or DEFAULT_AVATAR),
+                "interlocutor_deleted": False if is_group else not chat["interlocutor_name"],
+                "last_message": {
+                    "message_id": row["last_message_id"],
+                    "preview": row["last_message_preview"],
+                    "sender": row["last_sender"]
+                } if row["last_message_id"] else None,
+                "last_activity": row["last_activity"],
+                "unread_count": row["unread_count"]
+            })
+
+        next_cursor = None
+        if len(summaries) > limit:
+            last = summaries[limit - 1]
+            next_cursor = {"before_activity": last["last_activity"], "before_chat_id": last["chat_id"]}
+
+        return {"chats": items, "next_cursor": next_cursor}
+    except Exception as e:
+        logger.error(f"Error fetching inbox: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error fetching inbox: {str(e)}")
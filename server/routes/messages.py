@@ -1,16 +1,22 @@
 import json
-from fastapi import APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, Depends, status, UploadFile, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from server.database import get_connection
+from server import etags, history_cache, logs, media, metrics, quota, storage, uploads, voice
+from server.history_cache import shape_message
+from server.repositories.base import QuotaExceededError
 from server.routes.auth import get_current_user
 from server.websocket import manager
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import Optional
 from pathlib import Path
-import uuid
 import logging
 
 router = APIRouter()
 
+EXPORT_PAGE_SIZE = 1000
+NDJSON = "application/x-ndjson"
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -21,108 +27,247 @@ class Message(BaseModel):
 class MessageEdit(BaseModel):
     content: str    
 
-@router.post("/upload")
-async def upload_file(
-    chat_id: int = Form(...),
-    file: UploadFile = File(...),
-    current_user: dict = Depends(get_current_user)
-):
-    MAX_FILE_SIZE = 10 * 1024 * 1024
-    ALLOWED_FILE_TYPES = {
-        "image": [".jpg", ".jpeg", ".png", ".gif"],
-        "video": [".mp4", ".mov", ".ogg"],
-        "document": [".pdf", ".doc", ".docx", ".txt"],
-        "presention": [".pptx"],
-        "arcive": [".zip"],
-        "audio": [".mp3", ".wav", ".ogg"],
-        "code": [".js", ".ts", ".py", ".java", ".cpp", ".html", ".css"],
-        "none": [""]
+MAX_FILE_SIZE = 10 * 1024 * 1024
+FORM_OVERHEAD_BYTES = 16 * 1024  # Allowance for the other fields and part headers of an upload form
+ALLOWED_FILE_TYPES = {
+    "image": [".jpg", ".jpeg", ".png", ".gif"],
+    "video": [".mp4", ".mov", ".ogg"],
+    "document": [".pdf", ".doc", ".docx", ".txt"],
+    "presention": [".pptx"],
+    "arcive": [".zip"],
+    "audio": [".mp3", ".wav", ".ogg"],
+    "code": [".js", ".ts", ".py", ".java", ".cpp", ".html", ".css"],
+    "none": [""]
+}
+
+def file_type_for(filename: str) -> Optional[str]:
+    file_extension = Path(filename).suffix.lower()
+    for type_, extensions in ALLOWED_FILE_TYPES.items():
+        if file_extension in extensions:
+            return type_
+    return None
+
+def quota_exceeded(e: QuotaExceededError) -> HTTPException:
+    quota.REJECTIONS.inc(e.scope)
+    return HTTPException(status_code=413, detail=str(e))
+
+async def check_quota(user_id: int, chat_id: int | None, file_size: int, upload_id: str | None = None):
+    try:
+        await quota.check(user_id, chat_id, file_size, upload_id)
+    except QuotaExceededError as e:
+        raise quota_exceeded(e)
+
+async def read_upload_form(request: Request, user_id: int) -> tuple[int, UploadFile]:
+    """The chat_id and file fields of a multipart upload. Its declared length
+    is checked against the user's quota first, so an upload that cannot fit
+    is refused before its body is received."""
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit():
+        await check_quota(user_id, None, max(int(length) - FORM_OVERHEAD_BYTES, 0))
+    try:
+        form = await request.form()
+    except Exception:
+        raise HTTPException(status_code=400, detail="There was an error parsing the body")
+    file = form.get("file")
+    if file is None or isinstance(file, str):
+        raise HTTPException(status_code=422, detail="file is required")
+    try:
+        return int(form.get("chat_id")), file
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=422, detail="chat_id must be an integer")
+
+async def send_file_message(chat_id: int, current_user: dict, file_url: str, file_name: str, file_type: str,
+                            file_size: int) -> int:
+    """Store and broadcast a file message for a file already saved under static/uploads.
+    Raises QuotaExceededError, storing nothing, if the file no longer fits the quotas."""
+    attachment = {
+        "file_url": file_url,
+        "file_name": file_name,
+        "file_type": file_type,
+        "file_size": file_size
+    }
+    created_at = history_cache.timestamp()
+    message_id = await storage.repos.messages.insert(
+        chat_id, current_user["id"], current_user["username"], file_name, attachment=attachment,
+        timestamp=created_at, **quota.limits()
+    )
+    history_cache.cache.add_message(chat_id, message_id, current_user["id"], current_user["username"],
+                                    current_user["avatar_url"], file_name, created_at, attachment=attachment)
+    avatar_url = current_user["avatar_url"] or "/static/avatars/default.jpg"
+
+    file_message = {
+        "type": "file",
+        "username": current_user["username"],
+        "avatar_url": avatar_url,
+        "is_deleted": False,
+        "data": {
+            "chat_id": chat_id,
+            "file_url": file_url,
+            "file_name": file_name,
+            "file_type": file_type,
+            "file_size": file_size,
+            "message_id": message_id,
+            "reply_to": None
+        },
+        "timestamp": datetime.utcnow().isoformat()
     }
+    await manager.broadcast(chat_id, file_message)
+    logger.info(f"File uploaded and broadcasted: {file_name} to chat {chat_id}")
+    return message_id
 
+@router.post("/upload")
+async def upload_file(request: Request, current_user: dict = Depends(get_current_user)):
+    """Multipart form with `chat_id` and `file`."""
+    chat_id, file = await read_upload_form(request, current_user["id"])
     file_size = 0
     content = await file.read()
     file_size = len(content)
+    metrics.UPLOAD_SIZE.observe(file_size, "file")
     if file_size > MAX_FILE_SIZE:
         raise HTTPException(status_code=400, detail="File size exceeds 10 MB limit")
 
-    file_extension = Path(file.filename).suffix.lower()
-    logger.info(f"File extension: {file_extension}")
-    file_type = None
-    for type_, extensions in ALLOWED_FILE_TYPES.items():
-        if file_extension in extensions:
-            file_type = type_
-            break
+    file_type = file_type_for(file.filename)
     if not file_type:
         raise HTTPException(status_code=400, detail="Unsupported file type")
 
-    conn = get_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT * FROM participants WHERE chat_id = ? AND user_id = ?", (chat_id, current_user["id"]))
-        if not cursor.fetchone():
+        if not await storage.repos.chats.is_member(chat_id, current_user["id"]):
             raise HTTPException(status_code=403, detail="You are not a member of this chat")
+        await check_quota(current_user["id"], chat_id, file_size)
 
-        upload_dir = Path("static/uploads")
-        upload_dir.mkdir(parents=True, exist_ok=True)
-        unique_filename = f"{uuid.uuid4()}_{file.filename}"
-        file_path = upload_dir / unique_filename
-        with file_path.open("wb") as buffer:
-            buffer.write(content)
-
-        file_url = f"/static/uploads/{unique_filename}"
-        file_name = file.filename
-
-        cursor.execute("""
-            INSERT INTO messages (chat_id, sender_id, sender_name, content, timestamp)
-            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        """, (chat_id, current_user["id"], current_user["username"], json.dumps({
-            "file_url": file_url,
-            "file_name": file_name,
-            "file_type": file_type,
-            "file_size": file_size
-        })))
-        message_id = cursor.lastrowid
-        conn.commit()
-
-        cursor.execute("SELECT avatar_url FROM users WHERE id = ?", (current_user["id"],))
-        user_data = cursor.fetchone()
-        avatar_url = user_data["avatar_url"] if user_data and user_data["avatar_url"] else "/static/avatars/default.jpg"
-
-        file_message = {
-            "type": "file",
-            "username": current_user["username"],
-            "avatar_url": avatar_url,
-            "is_deleted": False,
-            "data": {
-                "chat_id": chat_id,
-                "file_url": file_url,
-                "file_name": file_name,
-                "file_type": file_type,
-                "file_size": file_size,
-                "message_id": message_id,
-                "reply_to": None
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        await manager.broadcast(chat_id, file_message)
-        logger.info(f"File uploaded and broadcasted: {file_name} to chat {chat_id}")
+        _, file_url = media.save("uploads", file.filename, content)
+        try:
+            await send_file_message(chat_id, current_user, file_url, file.filename, file_type, file_size)
+        except QuotaExceededError as e:
+            media.unlink(file_url)
+            raise quota_exceeded(e)
 
         return {"message": "File uploaded successfully", "file_url": file_url}
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         logger.error(f"Error uploading file: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
-    finally:
-        conn.close()
 
-@router.post("/vm")
-async def upload_voice_message(
-    chat_id: int = Form(...),
-    file: UploadFile = File(...),
+class UploadStart(BaseModel):
+    chat_id: int
+    file_name: str
+    file_size: int
+    sha256: Optional[str] = None
+
+def upload_progress(session: uploads.UploadSession) -> dict:
+    return {
+        "upload_id": session.upload_id,
+        "chat_id": session.chat_id,
+        "file_name": session.file_name,
+        "file_size": session.file_size,
+        "offset": session.offset(),
+        "expires_at": datetime.fromtimestamp(session.expires_at(), timezone.utc).isoformat()
+    }
+
+@router.post("/uploads")
+async def start_upload(upload: UploadStart, current_user: dict = Depends(get_current_user)):
+    """Start a resumable upload. Send the bytes with PUT /messages/uploads/{upload_id}?offset=...
+    in as many requests as needed, then POST /messages/uploads/{upload_id}/finalize."""
+    file_type = file_type_for(upload.file_name)
+    if not file_type:
+        raise HTTPException(status_code=400, detail="Unsupported file type")
+    if upload.file_size < 0:
+        raise HTTPException(status_code=400, detail="Invalid file size")
+    try:
+        if not await storage.repos.chats.is_member(upload.chat_id, current_user["id"]):
+            raise HTTPException(status_code=403, detail="You are not a member of this chat")
+        session = uploads.create(current_user["id"], upload.chat_id, upload.file_name, file_type,
+                                 upload.file_size, upload.sha256)
+        # Refused before any byte is sent, counting the user's other open uploads; checked again on finalize
+        try:
+            await check_quota(current_user["id"], upload.chat_id, upload.file_size, session.upload_id)
+        except HTTPException:
+            uploads.discard(session)
+            raise
+        return upload_progress(session)
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error starting upload: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error starting upload: {str(e)}")
+
+@router.put("/uploads/{upload_id}")
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
     current_user: dict = Depends(get_current_user)
 ):
+    """Append the request body at `offset`, which must be the upload's current offset (409 otherwise).
+    After a dropped connection, GET the upload and continue from its offset."""
+    try:
+        session = uploads.load(upload_id, current_user["id"])
+        length = request.headers.get("content-length")
+        if length is not None and not length.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid Content-Length")
+        new_offset = await uploads.write_chunk(session, offset, request.stream(),
+                                               int(length) if length is not None else None)
+        return {"upload_id": upload_id, "offset": new_offset, "file_size": session.file_size}
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error writing to upload {upload_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error writing upload: {str(e)}")
+
+@router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    try:
+        return upload_progress(uploads.load(upload_id, current_user["id"]))
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@router.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    """Turn a complete upload into a file message, as POST /messages/upload does."""
+    try:
+        session = uploads.load(upload_id, current_user["id"])
+        if not await storage.repos.chats.is_member(session.chat_id, current_user["id"]):
+            raise HTTPException(status_code=403, detail="You are not a member of this chat")
+        # Other uploads may have finished meanwhile; the session is kept so the user can free space and retry
+        await check_quota(current_user["id"], session.chat_id, session.file_size, session.upload_id)
+        file_path, file_url = media.destination("uploads", session.file_name)
+        sha256 = await uploads.finish(session, file_path)
+        metrics.UPLOAD_SIZE.observe(session.file_size, "file")
+
+        try:
+            message_id = await send_file_message(session.chat_id, current_user, file_url, session.file_name,
+                                                 session.file_type, session.file_size)
+        except QuotaExceededError as e:
+            uploads.restore(session, file_path)
+            raise quota_exceeded(e)
+        uploads.discard(session)
+        return {"message": "File uploaded successfully", "file_url": file_url, "message_id": message_id,
+                "sha256": sha256}
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error finalizing upload {upload_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error finalizing upload: {str(e)}")
+
+@router.delete("/uploads/{upload_id}")
+async def cancel_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    try:
+        uploads.discard(uploads.load(upload_id, current_user["id"]))
+        return {"message": "Upload cancelled"}
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@router.post("/vm")
+async def upload_voice_message(request: Request, current_user: dict = Depends(get_current_user)):
+    """Multipart form with `chat_id` and an Opus `file`."""
+    chat_id, file = await read_upload_form(request, current_user["id"])
     MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB
     ALLOWED_FILE_TYPES = [".opus"]
 
@@ -132,42 +277,42 @@ async def upload_voice_message(
 
     content = await file.read()
     file_size = len(content)
+    metrics.UPLOAD_SIZE.observe(file_size, "voice")
     if file_size > MAX_FILE_SIZE:
         raise HTTPException(status_code=400, detail="File size exceeds 10 MB limit")
 
-    conn = get_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT * FROM participants WHERE chat_id = ? AND user_id = ?", (chat_id, current_user["id"]))
-        if not cursor.fetchone():
+        if not await storage.repos.chats.is_member(chat_id, current_user["id"]):
             raise HTTPException(status_code=403, detail="You are not a member of this chat")
+        await check_quota(current_user["id"], chat_id, file_size)
 
-        upload_dir = Path("static/vm")
-        upload_dir.mkdir(parents=True, exist_ok=True)
-        unique_filename = f"{uuid.uuid4()}_{file.filename}"
-        file_path = upload_dir / unique_filename
-        with file_path.open("wb") as buffer:
-            buffer.write(content)
-
-        file_url = f"/static/vm/{unique_filename}"
+        file_path, file_url = media.save("vm", file.filename, content)
         file_name = file.filename
         file_type = "voice"
 
-        cursor.execute("""
-            INSERT INTO messages (chat_id, sender_id, sender_name, content, timestamp)
-            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        """, (chat_id, current_user["id"], current_user["username"], json.dumps({
+        # Parsed before the insert so the row, the cache and the broadcast all carry it
+        metadata = await voice.analyze(str(file_path))
+
+        attachment = {
             "file_url": file_url,
             "file_name": file_name,
             "file_type": file_type,
-            "file_size": file_size
-        })))
-        message_id = cursor.lastrowid
-        conn.commit()
-
-        cursor.execute("SELECT avatar_url FROM users WHERE id = ?", (current_user["id"],))
-        user_data = cursor.fetchone()
-        avatar_url = user_data["avatar_url"] if user_data and user_data["avatar_url"] else "/static/avatars/default.jpg"
+            "file_size": file_size,
+            "duration_ms": metadata["duration_ms"],
+            "waveform": metadata["waveform"]
+        }
+        created_at = history_cache.timestamp()
+        try:
+            message_id = await storage.repos.messages.insert(
+                chat_id, current_user["id"], current_user["username"], file_name, attachment=attachment,
+                timestamp=created_at, **quota.limits()
+            )
+        except QuotaExceededError as e:
+            media.unlink(file_url)
+            raise quota_exceeded(e)
+        history_cache.cache.add_message(chat_id, message_id, current_user["id"], current_user["username"],
+                                        current_user["avatar_url"], file_name, created_at, attachment=attachment)
+        avatar_url = current_user["avatar_url"] or "/static/avatars/default.jpg"
 
         voice_message = {
             "type": "file",
@@ -180,6 +325,8 @@ async def upload_voice_message(
                 "file_name": file_name,
                 "file_type": file_type,
                 "file_size": file_size,
+                "duration_ms": metadata["duration_ms"],
+                "waveform": metadata["waveform"],
                 "message_id": message_id,
                 "reply_to": None
             },
@@ -188,79 +335,204 @@ async def upload_voice_message(
         await manager.broadcast(chat_id, voice_message)
         logger.info(f"Voice message uploaded and broadcasted: {file_name} to chat {chat_id}")
 
-        return {"message": "Voice message uploaded successfully", "file_url": file_url}
+        return {"message": "Voice message uploaded successfully", "file_url": file_url, **metadata}
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         logger.error(f"Error uploading voice message: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error uploading voice message: {str(e)}")
-    finally:
-        conn.close()
 
-@router.get("/history/{chat_id}")
-async def get_message_history(chat_id: int, current_user: dict = Depends(get_current_user)):
-    conn = get_connection()
-    cursor = conn.cursor()
+def history_response(history: list[dict], limit: int | None, page_size: int, oldest_id: int | None) -> dict:
+    response = {"history": history}
+    if limit is not None:
+        response["next_before_id"] = oldest_id if page_size == limit else None
+    return response
 
+@router.get("/history/{chat_id}")
+async def get_message_history(
+    chat_id: int,
+    request: Request,
+    response: Response,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    current_user: dict = Depends(get_current_user)
+):
+    """Messages of a chat in ascending order.
+
+    Without `limit` the whole history is returned. With `limit` the newest
+    `limit` messages older than `before_id` are returned together with
+    `next_before_id` for the next (older) page. Archived messages are read
+    transparently after the hot table runs out. Polls with a matching
+    If-None-Match get a 304 without any message being read.
+    """
     try:
-        cursor.execute("SELECT * FROM participants WHERE chat_id = ? AND user_id = ?", (chat_id, current_user["id"]))
-        if not cursor.fetchone():
+        if not await storage.repos.chats.is_member(chat_id, current_user["id"]):
             logger.error(f"User {current_user['id']} is not a member of chat {chat_id}")
             raise HTTPException(status_code=403, detail="You are not a member of this chat")
 
-        cursor.execute("""
-            SELECT messages.id, messages.content, messages.timestamp, messages.sender_name AS sender,
-                   messages.reply_to, messages.reactions, users.avatar_url, messages.read_by
-            FROM messages
-            LEFT JOIN users ON messages.sender_id = users.id
-            WHERE messages.chat_id = ?
-            ORDER BY messages.timestamp ASC
-        """, (chat_id,))
-        messages = cursor.fetchall()
-        logger.info(f"Fetched {len(messages)} messages for chat {chat_id}")
+        # Read before the messages, so the tag can only be older than the body
+        version = await storage.repos.messages.version(chat_id)
+        tag = etags.etag("h", chat_id, version)
+        if etags.matches(request, tag):
+            return etags.not_modified(tag)
+        etags.set_headers(response, tag)
+
+        # The newest page of an active chat usually comes from memory
+        use_cache = before_id is None and history_cache.cache.enabled
+        if use_cache:
+            cached = history_cache.cache.get(chat_id, limit, version)
+            if cached is not None:
+                history_cache.REQUESTS.inc("hit")
+                return history_response(cached, limit, len(cached), cached[0]["id"] if cached else None)
+            history_cache.REQUESTS.inc("miss")
+        else:
+            history_cache.REQUESTS.inc("bypass")
+
+        # A miss reads at least a full cache tail so the next reads are hits
+        read_limit = max(limit, history_cache.cache.tail) if use_cache and limit is not None else limit
+        writes = history_cache.cache.start_fill(chat_id) if use_cache else None
+        rows = avatars = None
+        try:
+            rows = await storage.repos.messages.history(chat_id, before_id, read_limit)
+
+            # Avatars are looked up in one batch for all senders
+            avatars = await storage.repos.users.avatars(list({msg["sender_id"] for msg in rows}))
+        finally:
+            if use_cache:
+                complete = rows is not None and (read_limit is None or len(rows) < read_limit)
+                history_cache.cache.finish_fill(chat_id, writes, rows if avatars is not None else None,
+                                                avatars, complete, version)
+        messages = rows[:limit] if limit is not None else rows
 
         history = []
-        for msg in messages:
+        for msg in reversed(messages):
             try:
-                content = msg["content"]
-                message_type = "message"
-                parsed_content = content
-                if content and content.startswith("{"):
-                    try:
-                        parsed_content = json.loads(content)
-                        if isinstance(parsed_content, dict) and "file_url" in parsed_content:
-                            message_type = "file"
-                    except json.JSONDecodeError as json_err:
-                        logger.error(f"Failed to parse JSON content for message {msg['id']}: {content}, error: {json_err}")
-                        parsed_content = content  # Keep as string if JSON is invalid
-                        message_type = "message"
-
-                history.append({
-                    "id": msg["id"],
-                    "content": parsed_content,
-                    "timestamp": msg["timestamp"],
-                    "sender": msg["sender"],
-                    "avatar_url": msg["avatar_url"] if msg["avatar_url"] else "/static/avatars/default.jpg",
-                    "reply_to": msg["reply_to"],
-                    "reactions": msg["reactions"] or "[]",  # Return JSON string
-                    "read_by": msg["read_by"] or "[]",  # Fixed: Use msg["read_by"] instead of row["read_by"]
-                    "is_deleted": not bool(msg["content"]),
-                    "type": message_type
-                })
+                history.append(shape_message(msg, avatars.get(msg["sender_id"])))
             except Exception as e:
                 logger.error(f"Error processing message {msg['id']} in chat {chat_id}: {str(e)}")
                 continue  # Skip problematic message
 
-        logger.info(f"Returning {len(history)} messages for chat {chat_id}")
-        return {"history": history}
+        if logs.enabled(logger, "history"):
+            logger.debug(f"Returning {len(history)} of {len(messages)} messages for chat {chat_id}")
+        return history_response(history, limit, len(messages), messages[-1]["id"] if messages else None)
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error loading history for chat {chat_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error loading history: {str(e)}")
-    finally:
-        conn.close()    
+
+def export_record(msg: dict) -> dict:
+    """One exported message: the history shape with reactions and receipts as real JSON."""
+    record = shape_message(msg, None)
+    del record["avatar_url"]
+    record.update(
+        chat_id=msg["chat_id"],
+        sender_id=msg["sender_id"],
+        edited_at=msg["edited_at"],
+        reactions=json.loads(msg["reactions"] or "[]"),
+        read_by=json.loads(msg["read_by"] or "[]")
+    )
+    return record
+
+def export_timestamp(value: Optional[datetime]) -> Optional[str]:
+    # Stored timestamps are naive UTC "YYYY-MM-DD HH:MM:SS" strings
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+async def export_lines(chat_id: int, after_id: int = 0, since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """NDJSON lines of a chat's messages, oldest first, read one page at a time.
+
+    The last line is {"type": "end", ...}; a stream cut short ends with
+    {"type": "error", ...} instead. Either way `last_id` is the `after_id`
+    to resume from.
+    """
+    since, until = export_timestamp(since), export_timestamp(until)
+    exported = 0
+    try:
+        while True:
+            page = await storage.repos.messages.export_page(chat_id, after_id, EXPORT_PAGE_SIZE, since, until)
+            if not page:
+                break
+            yield "".join(json.dumps(export_record(msg), ensure_ascii=False) + "\n" for msg in page)
+            exported += len(page)
+            after_id = page[-1]["id"]
+            if len(page) < EXPORT_PAGE_SIZE:
+                break
+    except Exception as e:
+        logger.error(f"Error exporting chat {chat_id} after message {after_id}: {str(e)}")
+        yield json.dumps({"type": "error", "chat_id": chat_id, "detail": "Export interrupted", "last_id": after_id}) + "\n"
+        return
+    yield json.dumps({"type": "end", "chat_id": chat_id, "exported": exported, "last_id": after_id}) + "\n"
+
+@router.get("/files/{chat_id}")
+async def list_files(
+    chat_id: int,
+    file_type: Optional[str] = None,
+    before_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=500),
+    current_user: dict = Depends(get_current_user)
+):
+    """Files sent to a chat, newest first; `file_type` is e.g. image or voice."""
+    try:
+        if not await storage.repos.chats.is_member(chat_id, current_user["id"]):
+            raise HTTPException(status_code=403, detail="You are not a member of this chat")
+        files = await storage.repos.messages.files(chat_id, file_type, before_id, limit)
+        return {
+            "files": [
+                {
+                    "message_id": row["id"],
+                    "sender": row["sender_name"],
+                    "timestamp": row["timestamp"],
+                    "file_url": row["file_url"],
+                    "file_name": row["file_name"],
+                    "file_type": row["file_type"],
+                    "file_size": row["file_size"],
+                    **({"duration_ms": row["duration_ms"], "waveform": row["waveform"]}
+                       if row["file_type"] == "voice" else {})
+                }
+                for row in files
+            ],
+            "next_before_id": files[-1]["id"] if len(files) == limit else None
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error listing files of chat {chat_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error listing files: {str(e)}")
+
+@router.get("/usage")
+async def get_usage(chat_id: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    """Bytes and files the user has stored and their quota; with `chat_id`, the chat's as well."""
+    try:
+        if chat_id is not None and not await storage.repos.chats.is_member(chat_id, current_user["id"]):
+            raise HTTPException(status_code=403, detail="You are not a member of this chat")
+        return await quota.usage(current_user["id"], chat_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error reading storage usage: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error reading storage usage: {str(e)}")
+
+@router.get("/export/{chat_id}")
+async def export_chat(
+    chat_id: int,
+    after_id: int = Query(0, ge=0),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream the chat as newline-delimited JSON, oldest message first.
+
+    `since`/`until` (UTC) restrict the time range; `after_id` resumes an
+    interrupted export from the `last_id` it reported.
+    """
+    if not await storage.repos.chats.is_member(chat_id, current_user["id"]):
+        raise HTTPException(status_code=403, detail="You are not a member of this chat")
+    logger.info(f"User {current_user['id']} exporting chat {chat_id} after message {after_id}")
+    return StreamingResponse(export_lines(chat_id, after_id, since, until), media_type=NDJSON)
 
 # @router.put("/edit/{message_id}")
 # def edit_message(message_id: int, payload: MessageEdit, current_user: dict = Depends(get_current_user)):
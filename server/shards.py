@@ -0,0 +1,179 @@
+import asyncio
+import contextvars
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from server.database import (
+    DB_PATH, MESSAGE_COLUMNS, backfill_chat_summaries, backfill_storage_usage, get_connection, migrate_attachments
+)
+from server.slow_queries import TracedConnection
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Messages (and the per-chat tables that must change in the same transaction
+# as them) are split by chat_id over SHARD_COUNT SQLite files, each with a
+# single dedicated writer thread. Users, chats and participants stay in the
+# metadata database at DB_PATH. With one shard the shard *is* DB_PATH.
+SHARD_COUNT = int(os.environ.get("MESSENGER_SHARD_COUNT", "1"))
+SHARD_DIR = Path(os.environ.get("MESSENGER_SHARD_DIR", "server/shards"))
+
+_executors: dict[int, ThreadPoolExecutor] = {}
+_writer_local = threading.local()
+
+def shard_for(chat_id: int) -> int:
+    return chat_id % SHARD_COUNT
+
+def all_shards() -> range:
+    return range(SHARD_COUNT)
+
+def shard_path(shard: int) -> str:
+    if SHARD_COUNT == 1:
+        return DB_PATH
+    return str(SHARD_DIR / f"messages_{shard}.db")
+
+def connect_shard(shard: int):
+    conn = sqlite3.connect(shard_path(shard), check_same_thread=False, factory=TracedConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+def get_shard_connection(chat_id: int):
+    """Connection to the shard holding the messages of a chat (for reads)."""
+    return connect_shard(shard_for(chat_id))
+
+def next_message_id_sql(shard: int) -> str:
+    """SQL expression for the id of the next message inserted into a shard.
+
+    Ids stay globally unique by giving shard s only ids congruent to s modulo
+    SHARD_COUNT. The expression is evaluated inside the INSERT, so it is
+    atomic with respect to other processes writing the same shard.
+    """
+    if SHARD_COUNT == 1:
+        return "NULL"
+    seq = "(SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'messages')"
+    return f"({seq} + {SHARD_COUNT} - ((({seq} - {shard}) % {SHARD_COUNT}) + {SHARD_COUNT}) % {SHARD_COUNT})"
+
+def _writer_connection(shard: int):
+    connections = getattr(_writer_local, "connections", None)
+    if connections is None:
+        connections = _writer_local.connections = {}
+    if shard not in connections:
+        connections[shard] = connect_shard(shard)
+    return connections[shard]
+
+def _run_write(shard: int, fn, args):
+    conn = _writer_connection(shard)
+    try:
+        result = fn(conn.cursor(), *args)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+
+async def write(chat_id: int, fn, *args):
+    """Run `fn(cursor, *args)` in one transaction on the chat's shard writer thread."""
+    shard = shard_for(chat_id)
+    if shard not in _executors:
+        _executors[shard] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard-{shard}")
+    loop = asyncio.get_running_loop()
+    # Carry the caller's context over, like asyncio.to_thread, so slow writes are attributed to their route
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executors[shard], context.run, _run_write, shard, fn, args)
+
+def _close_writer_connections():
+    for conn in getattr(_writer_local, "connections", {}).values():
+        conn.close()
+    _writer_local.connections = {}
+
+def shutdown():
+    """Let the writer threads finish the queued writes, then stop them."""
+    for executor in _executors.values():
+        executor.submit(_close_writer_connections)
+        executor.shutdown(wait=True)
+    _executors.clear()
+
+def participants_source(shard: int) -> str:
+    """Participants of the chats stored in a shard; the metadata database must
+    be attached as `meta` when there is more than one shard."""
+    if SHARD_COUNT == 1:
+        return "participants"
+    return f"(SELECT chat_id, user_id FROM meta.participants WHERE chat_id % {SHARD_COUNT} = {shard})"
+
+def rebuild_summaries(conn, shard: int):
+    conn.execute("ATTACH DATABASE ? AS meta", (DB_PATH,))
+    try:
+        backfill_chat_summaries(conn.cursor(), participants_source(shard))
+        conn.commit()
+    finally:
+        conn.execute("DETACH DATABASE meta")
+
+def migrate_legacy_messages(batch_size: int = 1000) -> int:
+    """Move messages left in the metadata database into their shards.
+
+    Needed once after raising SHARD_COUNT above 1 on an existing install,
+    before the first archive pass (archived months are not moved). Rows keep
+    their ids; every shard's id sequence is then moved past the largest
+    legacy id so newly generated ids cannot collide with them.
+    """
+    if SHARD_COUNT == 1:
+        return 0
+    meta = get_connection()
+    moved = 0
+    try:
+        legacy = meta.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'messages'").fetchone()
+        if not legacy:
+            return 0
+        max_id = meta.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        columns = [column.strip() for column in MESSAGE_COLUMNS.split(",")] + ["client_msg_id"]
+        # Last migrated while unsharded, the table has every column; a
+        # metadata database from before versioned migrations lacks the later ones
+        present = {row[1] for row in meta.execute("PRAGMA table_info(messages)")}
+        select = ", ".join(column if column in present else ("'message' AS type" if column == "type" else f"NULL AS {column}")
+                           for column in columns)
+        while True:
+            rows = meta.execute(f"SELECT {select} FROM messages ORDER BY id LIMIT ?", (batch_size,)).fetchall()
+            if not rows:
+                break
+            by_shard = {}
+            for row in rows:
+                by_shard.setdefault(shard_for(row["chat_id"]), []).append(tuple(row))
+            for shard, shard_rows in by_shard.items():
+                conn = connect_shard(shard)
+                try:
+                    conn.executemany(f"INSERT OR IGNORE INTO messages ({', '.join(columns)}) "
+                                     f"VALUES ({', '.join('?' * len(columns))})", shard_rows)
+                    conn.commit()
+                finally:
+                    conn.close()
+            meta.execute(f"DELETE FROM messages WHERE id IN ({', '.join('?' * len(rows))})", [row["id"] for row in rows])
+            meta.commit()
+            moved += len(rows)
+            logger.info(f"Moved {moved} legacy messages into shards")
+
+        for shard in all_shards():
+            conn = connect_shard(shard)
+            try:
+                conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'messages'", (max_id,))
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'messages', ? "
+                             "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'messages')", (max_id,))
+                conn.execute("DELETE FROM chat_summaries")
+                # Only rows copied from before versioned migrations still carry attachments as JSON content
+                migrate_attachments(conn.cursor())
+                backfill_storage_usage(conn.cursor())
+                conn.commit()
+                rebuild_summaries(conn, shard)
+            finally:
+                conn.close()
+        return moved
+    finally:
+        meta.close()
+
+if __name__ == "__main__":
+    from server import migrations
+    migrations.migrate()
+    print(f"Moved {migrate_legacy_messages()} messages into {SHARD_COUNT} shards")
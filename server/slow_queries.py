@@ -0,0 +1,119 @@
+import contextvars
+import os
+import sqlite3
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+# Every connection to the metadata database, the shards and the archive is a
+# TracedConnection. Statements slower than MESSENGER_SLOW_QUERY_MS (default
+# 100, negative to turn tracing off) are kept in a ring of the last
+# MESSENGER_SLOW_QUERY_LOG entries with their parameter types, the route that
+# ran them and EXPLAIN QUERY PLAN output. GET /admin/slow-queries serves the ring.
+
+SLOW_QUERY_MS = float(os.environ.get("MESSENGER_SLOW_QUERY_MS", "100"))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get("MESSENGER_SLOW_QUERY_LOG", "200"))
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+threshold = SLOW_QUERY_MS / 1000 if SLOW_QUERY_MS >= 0 else float("inf")
+records = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+# "GET /messages/history/42", "WS /ws/chat/42"; None outside requests (background jobs)
+current_route = contextvars.ContextVar("current_route", default=None)
+
+def params_shape(params) -> str:
+    """Types of the bound parameters with runs collapsed: "(int, str×3)"."""
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in params.items()) + "}"
+    runs = []
+    for value in params:
+        name = type(value).__name__
+        if runs and runs[-1][0] == name:
+            runs[-1][1] += 1
+        else:
+            runs.append([name, 1])
+    return "(" + ", ".join(name if count == 1 else f"{name}×{count}" for name, count in runs) + ")"
+
+def explain(conn: sqlite3.Connection, sql: str, params) -> list[str] | None:
+    if not sql.lstrip().upper().startswith(EXPLAINABLE):
+        return None
+    try:
+        # A plain cursor, so the plan query is neither traced nor disturbs the caller's cursor
+        rows = sqlite3.Cursor(conn).execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        return [row[3] for row in rows]
+    except sqlite3.Error as e:
+        return [f"unavailable: {e}"]
+
+def record(conn: "TracedConnection", sql: str, params, elapsed: float, rows: int | None = None):
+    records.append({
+        "timestamp": datetime.utcnow().isoformat(),
+        "duration_ms": round(elapsed * 1000, 3),
+        "database": conn.database_name,
+        "route": current_route.get() or "background",
+        "sql": " ".join(sql.split()),
+        "params": params_shape(params),
+        "executemany_rows": rows,
+        "plan": explain(conn, sql, params),
+    })
+
+class TracedCursor(sqlite3.Cursor):
+    """Times execute() and fetchall(); a SELECT only does most of its work
+    while the rows are fetched."""
+
+    _last = None  # (sql, params, elapsed) of the last statement if it was not recorded yet
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        elapsed = time.perf_counter() - start
+        if elapsed >= threshold:
+            record(self.connection, sql, parameters, elapsed)
+            self._last = None
+        else:
+            self._last = (sql, parameters, elapsed)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        if not isinstance(seq_of_parameters, (list, tuple)):
+            seq_of_parameters = list(seq_of_parameters)
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        elapsed = time.perf_counter() - start
+        if elapsed >= threshold and seq_of_parameters:
+            record(self.connection, sql, seq_of_parameters[0], elapsed, len(seq_of_parameters))
+        self._last = None
+        return self
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        if self._last is not None:
+            sql, params, elapsed = self._last
+            self._last = None
+            elapsed += time.perf_counter() - start
+            if elapsed >= threshold:
+                record(self.connection, sql, params, elapsed)
+        return rows
+
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.database_name = Path(str(database).removeprefix("file:").split("?")[0]).name
+
+    def cursor(self, factory=TracedCursor):
+        # Connection.execute() goes through cursor() as well
+        return super().cursor(factory)
+
+class RouteContextMiddleware:
+    """Plain ASGI middleware that sets `current_route` for the request or socket."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            current_route.set(f"{scope['method']} {scope['path']}")
+        elif scope["type"] == "websocket":
+            current_route.set(f"WS {scope['path']}")
+        await self.app(scope, receive, send)
@@ -0,0 +1,27 @@
+import logging
+import os
+from server.repositories.base import Repositories
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# "sqlite" (default) or "memory". Routes always go through `storage.repos`
+# so the backend can be swapped with `use()` before the app starts.
+STORAGE_BACKEND = os.environ.get("MESSENGER_STORAGE", "sqlite")
+
+def create_repositories(backend: str) -> Repositories:
+    # Imported lazily so the memory backend never touches the database files
+    if backend == "sqlite":
+        from server.repositories.sqlite import SQLiteRepositories
+        return SQLiteRepositories()
+    if backend == "memory":
+        from server.repositories.memory import MemoryRepositories
+        return MemoryRepositories()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def use(repositories: Repositories):
+    global repos
+    repos = repositories
+    logger.info(f"Using {repositories.backend} storage")
+
+repos = create_repositories(STORAGE_BACKEND)
@@ -0,0 +1,266 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+from server import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Resumable uploads. A session is a `.part` file that chunks are appended to
+# and a `.json` file with what was declared when it was created, both under
+# MESSENGER_UPLOAD_DIR, which is not served. The size of the `.part` file is
+# the session's offset, so progress survives dropped connections and
+# restarts alike:
+#
+#   MESSENGER_UPLOAD_DIR       unfinished uploads (default server/partial_uploads)
+#   MESSENGER_UPLOAD_MAX_MB    largest file accepted this way (default 200)
+#   MESSENGER_UPLOAD_TTL       seconds a session may go without a chunk before it is deleted (default 86400)
+#   MESSENGER_UPLOAD_MAX_OPEN  sessions a user may have open at once (default 5)
+#
+# Each session also has a marker in users/<user_id>/ holding its declared
+# size, so a user's open sessions are counted against their quota without
+# reading every session.
+#
+# The SHA-256 is computed as chunks arrive and kept per process; a session
+# resumed in another process is hashed once from disk.
+
+PARTIAL_DIR = Path(os.environ.get("MESSENGER_UPLOAD_DIR", "server/partial_uploads"))
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MESSENGER_UPLOAD_MAX_MB", "200")) * 1024 * 1024)
+UPLOAD_TTL_SECONDS = float(os.environ.get("MESSENGER_UPLOAD_TTL", "86400"))
+MAX_OPEN_UPLOADS = int(os.environ.get("MESSENGER_UPLOAD_MAX_OPEN", "5"))
+USERS_DIR = PARTIAL_DIR / "users"
+WRITE_BUFFER_BYTES = 1024 * 1024
+EXPIRE_INTERVAL_SECONDS = 600
+
+UPLOAD_ID = re.compile(r"[0-9a-f]{32}")
+
+EXPIRED = metrics.Counter(
+    "upload_sessions_expired_total", "Resumable uploads deleted after going without a chunk for MESSENGER_UPLOAD_TTL."
+)
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+
+class UploadSession:
+    def __init__(self, upload_id: str, user_id: int, chat_id: int, file_name: str, file_type: str,
+                 file_size: int, sha256: str | None = None, created_at: float | None = None):
+        self.upload_id = upload_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.file_name = file_name
+        self.file_type = file_type
+        self.file_size = file_size
+        self.sha256 = sha256
+        self.created_at = created_at if created_at is not None else time.time()
+
+    @property
+    def part_path(self) -> Path:
+        return PARTIAL_DIR / f"{self.upload_id}.part"
+
+    @property
+    def meta_path(self) -> Path:
+        return PARTIAL_DIR / f"{self.upload_id}.json"
+
+    @property
+    def user_path(self) -> Path:
+        return USERS_DIR / str(self.user_id) / self.upload_id
+
+    def offset(self) -> int:
+        try:
+            return self.part_path.stat().st_size
+        except FileNotFoundError:
+            raise UploadError(404, "Upload not found")  # Finished, cancelled or expired meanwhile
+
+    def expires_at(self) -> float:
+        try:
+            return self.part_path.stat().st_mtime + UPLOAD_TTL_SECONDS
+        except FileNotFoundError:
+            raise UploadError(404, "Upload not found")
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "user_id": self.user_id, "chat_id": self.chat_id, "file_name": self.file_name,
+            "file_type": self.file_type, "file_size": self.file_size, "sha256": self.sha256,
+            "created_at": self.created_at
+        })
+
+_hashers = {}  # { upload_id: (sha256 object, offset it has seen) }
+_locks = {}  # { upload_id: asyncio.Lock }
+
+def create(user_id: int, chat_id: int, file_name: str, file_type: str, file_size: int,
+           sha256: str | None = None) -> UploadSession:
+    if file_size > MAX_UPLOAD_BYTES:
+        raise UploadError(413, f"File size exceeds {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit")
+    session = UploadSession(uuid.uuid4().hex, user_id, chat_id, file_name, file_type, file_size,
+                            sha256.lower() if sha256 else None)
+    session.user_path.parent.mkdir(parents=True, exist_ok=True)
+    session.part_path.touch()
+    session.meta_path.write_text(session.to_json())
+    session.user_path.write_text(str(file_size))
+    # Counted after the marker is written, so concurrent requests cannot all slip under the limit
+    if open_uploads(user_id)[0] > MAX_OPEN_UPLOADS:
+        discard(session)
+        raise UploadError(429, f"At most {MAX_OPEN_UPLOADS} uploads may be in progress at once")
+    _hashers[session.upload_id] = (hashlib.sha256(), 0)
+    return session
+
+def open_uploads(user_id: int, exclude: str | None = None) -> tuple[int, int]:
+    """Number and declared bytes of the user's open sessions, but `exclude`."""
+    count = size = 0
+    try:
+        markers = list(os.scandir(USERS_DIR / str(user_id)))
+    except FileNotFoundError:
+        return 0, 0
+    for marker in markers:
+        if marker.name == exclude:
+            continue
+        try:
+            size += int(Path(marker.path).read_text() or 0)
+        except (FileNotFoundError, ValueError):
+            continue  # Finished or cancelled meanwhile
+        count += 1
+    return count, size
+
+def load(upload_id: str, user_id: int) -> UploadSession:
+    """The user's session, or UploadError 404 if there is none by that id."""
+    try:
+        if not UPLOAD_ID.fullmatch(upload_id):
+            raise FileNotFoundError(upload_id)
+        meta = json.loads((PARTIAL_DIR / f"{upload_id}.json").read_text())
+    except FileNotFoundError:
+        raise UploadError(404, "Upload not found")
+    if meta["user_id"] != user_id:
+        raise UploadError(404, "Upload not found")
+    return UploadSession(upload_id, **meta)
+
+def _lock(session: UploadSession) -> asyncio.Lock:
+    lock = _locks.setdefault(session.upload_id, asyncio.Lock())
+    if lock.locked():
+        raise UploadError(409, "Another request is writing to this upload")
+    return lock
+
+def _hash_file(path: Path, length: int):
+    hasher = hashlib.sha256()
+    with path.open("rb") as f:
+        while length > 0:
+            data = f.read(min(WRITE_BUFFER_BYTES, length))
+            if not data:
+                break
+            hasher.update(data)
+            length -= len(data)
+    return hasher
+
+async def _hasher(session: UploadSession, offset: int):
+    hasher, seen = _hashers.get(session.upload_id, (None, -1))
+    if seen != offset:
+        # Started in another process or before a restart
+        hasher = await asyncio.to_thread(_hash_file, session.part_path, offset)
+    return hasher
+
+def _append(f, hasher, data: bytes):
+    f.write(data)
+    hasher.update(data)
+
+async def write_chunk(session: UploadSession, offset: int, chunks, length: int | None = None) -> int:
+    """Append the byte chunks of one request at `offset`, which must be the
+    session's current offset. Returns the new offset; what arrived before a
+    dropped connection is kept."""
+    async with _lock(session):
+        current = session.offset()
+        if offset != current:
+            raise UploadError(409, f"Upload is at offset {current}, not {offset}")
+        if length is not None and offset + length > session.file_size:
+            raise UploadError(413, "Chunk runs past the declared file size")
+        hasher = await _hasher(session, current)
+        f = await asyncio.to_thread(session.part_path.open, "ab")
+        buffer = bytearray()
+        try:
+            async for data in chunks:
+                if current + len(buffer) + len(data) > session.file_size:
+                    raise UploadError(413, "Chunk runs past the declared file size")
+                buffer += data
+                if len(buffer) >= WRITE_BUFFER_BYTES:
+                    await asyncio.to_thread(_append, f, hasher, bytes(buffer))
+                    current += len(buffer)
+                    buffer = bytearray()
+        finally:
+            if buffer:
+                await asyncio.to_thread(_append, f, hasher, bytes(buffer))
+                current += len(buffer)
+            await asyncio.to_thread(f.close)
+            _hashers[session.upload_id] = (hasher, current)
+        return current
+
+async def finish(session: UploadSession, destination: Path) -> str:
+    """Check the upload is complete and matches its declared SHA-256, then
+    move it to `destination`. Returns the SHA-256. The session stays until
+    `discard`, so `restore` can put the file back if it cannot be posted."""
+    async with _lock(session):
+        offset = session.offset()
+        if offset != session.file_size:
+            raise UploadError(409, f"Upload is at offset {offset} of {session.file_size}")
+        digest = (await _hasher(session, offset)).hexdigest()
+        if session.sha256 is not None and digest != session.sha256:
+            discard(session)
+            raise UploadError(400, "Uploaded file does not match its sha256")
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(session.part_path, destination)
+        return digest
+
+def restore(session: UploadSession, path: Path):
+    """Move a finished upload's file back, so it can be finalized again."""
+    os.replace(path, session.part_path)
+
+def discard(session: UploadSession):
+    session.part_path.unlink(missing_ok=True)
+    session.meta_path.unlink(missing_ok=True)
+    session.user_path.unlink(missing_ok=True)
+    _hashers.pop(session.upload_id, None)
+    _locks.pop(session.upload_id, None)
+
+def expire() -> int:
+    """Delete the sessions that went without a chunk for longer than the TTL."""
+    if not PARTIAL_DIR.exists():
+        return 0
+    cutoff = time.time() - UPLOAD_TTL_SECONDS
+    expired = 0
+    for meta_path in PARTIAL_DIR.glob("*.json"):
+        part_path = meta_path.with_suffix(".part")
+        try:
+            last_write = (part_path if part_path.exists() else meta_path).stat().st_mtime
+        except FileNotFoundError:
+            continue  # Finished or cancelled meanwhile
+        if last_write < cutoff:
+            part_path.unlink(missing_ok=True)
+            meta_path.unlink(missing_ok=True)
+            _hashers.pop(meta_path.stem, None)
+            _locks.pop(meta_path.stem, None)
+            expired += 1
+    # Markers are written after their session's files and removed with them,
+    # so one without a session is left over from an interrupted discard
+    for marker in USERS_DIR.glob("*/*"):
+        if not (PARTIAL_DIR / f"{marker.name}.json").exists():
+            marker.unlink(missing_ok=True)
+    EXPIRED.inc(amount=expired)
+    return expired
+
+async def run_expirer():
+    """Background task: delete abandoned uploads."""
+    while True:
+        try:
+            expired = await asyncio.to_thread(expire)
+            if expired:
+                logger.info(f"Deleted {expired} abandoned uploads")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error while deleting abandoned uploads: {e}")
+        await asyncio.sleep(EXPIRE_INTERVAL_SECONDS)
@@ -0,0 +1,141 @@
+import asyncio
+import base64
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Duration and waveform of uploaded voice messages, read from the Ogg/Opus
+# container in worker processes so parsing never holds up the event loop:
+#
+#   MESSENGER_VOICE_WORKERS   processes parsing voice messages (default 2, 0 parses in a thread)
+#
+# The duration comes from the last granule position minus the encoder's
+# pre-skip. The waveform is WAVEFORM_PEAKS peaks of the Opus bitrate over
+# time: the encoder spends bytes on loud and busy passages and next to
+# nothing on silence, which is enough for a preview without decoding audio.
+# It is stored base64-encoded, one byte (0-255) per peak.
+
+VOICE_WORKERS = int(os.environ.get("MESSENGER_VOICE_WORKERS", "2"))
+WAVEFORM_PEAKS = 64
+OPUS_SAMPLES_PER_MS = 48  # Opus granule positions always count 48 kHz samples
+
+# Frame length in 48 kHz samples by TOC config: SILK, hybrid and CELT modes (RFC 6716, 3.1)
+FRAME_SAMPLES = [480, 960, 1920, 2880] * 3 + [480, 960] * 2 + [120, 240, 480, 960] * 4
+
+def ogg_packets(data: bytes):
+    """Yield (packet, granule position of its page) for the first logical stream of an Ogg file."""
+    pos = 0
+    serial = None
+    packet = bytearray()
+    while pos < len(data):
+        if data[pos:pos + 4] != b"OggS":
+            raise ValueError(f"No Ogg page at byte {pos}")
+        if pos + 27 > len(data):
+            raise ValueError("Truncated Ogg page header")
+        granule = int.from_bytes(data[pos + 6:pos + 14], "little", signed=True)
+        page_serial = data[pos + 14:pos + 18]
+        segments = data[pos + 26]
+        lacing = data[pos + 27:pos + 27 + segments]
+        pos += 27 + segments
+        if pos + sum(lacing) > len(data):
+            raise ValueError("Truncated Ogg page")
+        if serial is None:
+            serial = page_serial
+        if page_serial != serial:
+            pos += sum(lacing)
+            continue
+        for size in lacing:
+            packet += data[pos:pos + size]
+            pos += size
+            if size < 255:
+                yield bytes(packet), granule
+                packet = bytearray()
+
+def packet_samples(packet: bytes) -> int:
+    """Length of an Opus packet in 48 kHz samples, from its TOC byte."""
+    if not packet:
+        return 0
+    toc = packet[0]
+    frames = (1, 2, 2)[toc & 3] if toc & 3 != 3 else (packet[1] & 0x3F if len(packet) > 1 else 0)
+    return FRAME_SAMPLES[toc >> 3] * frames
+
+def waveform(packets: list[tuple[int, int]], total_samples: int, peaks: int = WAVEFORM_PEAKS) -> bytes:
+    """Peak bytes-per-sample of the packets in each of `peaks` equal time slices, scaled to 0-255."""
+    levels = [0.0] * peaks
+    filled = [False] * peaks
+    start = 0
+    for size, samples in packets:
+        if samples:
+            peak = min(peaks - 1, start * peaks // max(total_samples, 1))
+            levels[peak] = max(levels[peak], size / samples)
+            filled[peak] = True
+        start += samples
+    # Clips with fewer packets than peaks repeat the previous level
+    for i in range(1, peaks):
+        if not filled[i]:
+            levels[i] = levels[i - 1]
+    loudest = max(levels)
+    if loudest <= 0:
+        return bytes(peaks)
+    return bytes(round(level * 255 / loudest) for level in levels)
+
+def analyze_file(path: str) -> dict:
+    """Duration and waveform of an Ogg/Opus file; raises ValueError if it is not one."""
+    with open(path, "rb") as f:
+        data = f.read()
+    packets = ogg_packets(data)
+    head = next(packets, (b"", 0))[0]
+    if len(head) < 19 or not head.startswith(b"OpusHead"):
+        raise ValueError("Not an Ogg/Opus stream")
+    pre_skip = int.from_bytes(head[10:12], "little")
+    next(packets, None)  # OpusTags
+
+    audio = []
+    last_granule = -1
+    for packet, granule in packets:
+        audio.append((len(packet), packet_samples(packet)))
+        if granule >= 0:
+            last_granule = granule
+    if not audio:
+        raise ValueError("Ogg/Opus stream has no audio packets")
+    total_samples = sum(samples for _, samples in audio)
+    # The last page's granule position trims the final packet's padding; streams cut short have none
+    end = last_granule if last_granule >= 0 else total_samples
+    return {
+        "duration_ms": max(end - pre_skip, 0) // OPUS_SAMPLES_PER_MS,
+        "waveform": base64.b64encode(waveform(audio, total_samples)).decode()
+    }
+
+_pool = None
+
+def pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Spawned, not forked: the server process runs threads and an event loop
+        _pool = ProcessPoolExecutor(VOICE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+async def analyze(path: str) -> dict:
+    """{duration_ms, waveform} of a stored voice message, both None if it cannot be parsed."""
+    try:
+        if VOICE_WORKERS <= 0:
+            return await asyncio.to_thread(analyze_file, path)
+        return await asyncio.get_running_loop().run_in_executor(pool(), analyze_file, path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read voice message {path}: {e}")
+    except BrokenProcessPool:
+        # A worker died; the next upload starts a fresh pool
+        logger.error(f"Voice worker pool broke while reading {path}")
+        shutdown()
+    return {"duration_ms": None, "waveform": None}
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
@@ -1,384 +1,495 @@
 from fastapi import WebSocket, WebSocketDisconnect, Query
 from fastapi.routing import APIRouter
-from server.database import get_connection
+from server import client_ids, history_cache, logs, metrics, outbox, storage
+from server.repositories.base import DuplicateMessageError, MessageStoreError
 from server.routes.auth import verify_token
+from server.wire import JSON, negotiate_encoding, encode, send_frame, receive_frame
 from datetime import datetime
+import asyncio
 import logging
-import sqlite3
-import json
+import os
+import random
+import time
+import weakref
 
 router = APIRouter()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+LARGEST_CHATS_REPORTED = 10  # Per-chat socket gauges are limited to keep /metrics small
+# On shutdown clients are told to reconnect after a random delay of up to
+# MESSENGER_DRAIN_RECONNECT_SECONDS, so a restart does not bring them all back at once
+DRAIN_RECONNECT_SECONDS = float(os.environ.get("MESSENGER_DRAIN_RECONNECT_SECONDS", "10"))
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get("MESSENGER_DRAIN_TIMEOUT", "10"))  # For frames still being handled
+SERVICE_RESTART = 1012  # WebSocket close code
+
 class ConnectionManager:
     def __init__(self):
         self.active_chats = {}  # { chat_id: [websockets] }
-
-    async def connect(self, chat_id: int, websocket: WebSocket):
+        self.encodings = weakref.WeakKeyDictionary()  # { websocket: wire encoding }
+        self.socket_users = weakref.WeakKeyDictionary()  # { websocket: user_id }
+        self.busy = weakref.WeakSet()  # Sockets whose last frame is still being handled
+        self.draining = False
+
+    async def accept(self, websocket: WebSocket, encoding: str = JSON, subprotocol: str | None = None):
+        await websocket.accept(subprotocol=subprotocol)
+        self.encodings[websocket] = encoding
+
+    async def connect(self, chat_id: int, websocket: WebSocket, user_id: int | None = None) -> dict[int, list[dict]]:
+        """Register the socket; returns the events the user missed while
+        offline, by chat (see server/outbox.py): first this chat's, unless
+        they are not known, then those queued in the user's other chats."""
+        if user_id is not None:
+            self.socket_users[websocket] = user_id
         if chat_id not in self.active_chats:
             self.active_chats[chat_id] = []
         self.active_chats[chat_id].append(websocket)
         logger.info(f"Connected to chat {chat_id}. Active connections: {len(self.active_chats[chat_id])}")
+        if user_id is None:
+            return {}
+        missed = outbox.pending.take(chat_id, user_id)
+        return {**({chat_id: missed} if missed is not None else {}), **outbox.pending.take_others(chat_id, user_id)}
 
     def disconnect(self, chat_id: int, websocket: WebSocket):
-        if chat_id in self.active_chats:
+        self.busy.discard(websocket)
+        if chat_id in self.active_chats and websocket in self.active_chats[chat_id]:
             self.active_chats[chat_id].remove(websocket)
+            user_id = self.socket_users.get(websocket)
             if not self.active_chats[chat_id]:
                 del self.active_chats[chat_id]
             logger.info(f"Disconnected from chat {chat_id}. Active connections: {len(self.active_chats.get(chat_id, []))}")
+            if user_id is not None and user_id not in self.chat_user_ids(chat_id):
+                outbox.pending.track(chat_id, user_id)
 
-    async def broadcast(self, chat_id: int, message: dict):
-        if chat_id in self.active_chats:
-            logger.info(f"Broadcasting to chat {chat_id}: {message}, clients: {len(self.active_chats[chat_id])}")
-            for websocket in self.active_chats[chat_id]:
+    def chat_user_ids(self, chat_id: int) -> set:
+        return {self.socket_users.get(websocket) for websocket in self.active_chats.get(chat_id, [])}
+
+    async def close_users(self, chat_id: int, user_ids: set[int], code: int = 1008):
+        """Close the sockets that the given users have open in a chat."""
+        for websocket in list(self.active_chats.get(chat_id, [])):
+            if self.socket_users.get(websocket) in user_ids:
+                self.disconnect(chat_id, websocket)
                 try:
-                    await websocket.send_text(json.dumps(message))
-                    logger.info(f"Sent message to client in chat {chat_id}")
+                    await websocket.close(code=code)
                 except Exception as e:
-                    logger.error(f"Error broadcasting to chat {chat_id}: {e}")
-
-    async def broadcast_to_chat(self, chat_id: int, message: dict):
+                    logger.error(f"Error closing socket in chat {chat_id}: {e}")
+        outbox.pending.forget(chat_id, user_ids)
+
+    async def close_chat(self, chat_id: int, code: int = 1000):
+        for websocket in list(self.active_chats.get(chat_id, [])):
+            self.disconnect(chat_id, websocket)
+            try:
+                await websocket.close(code=code)
+            except Exception as e:
+                logger.error(f"Error closing socket in chat {chat_id}: {e}")
+        outbox.pending.drop_chat(chat_id)
+
+    async def close_user(self, user_id: int, code: int = 1008):
+        for chat_id in list(self.active_chats):
+            await self.close_users(chat_id, {user_id}, code)
+        outbox.pending.forget_user(user_id)
+
+    async def send(self, websocket: WebSocket, message: dict):
+        await send_frame(websocket, encode(message, self.encodings.get(websocket, JSON)))
+
+    async def broadcast(self, chat_id: int, message: dict, user_ids: set[int] | None = None):
+        """Send to every socket in the chat, or only to those of `user_ids`."""
+        if outbox.pending.tracks(chat_id):
+            # Before the first await, so a user connecting meanwhile finds the event in their outbox
+            outbox.pending.add(chat_id, message, self.chat_user_ids(chat_id), user_ids)
         if chat_id in self.active_chats:
-            logger.info(f"Broadcasting to chat {chat_id}: {message}")
-            for websocket in self.active_chats[chat_id]:
+            if logs.enabled(logger, "ws.broadcast"):
+                logger.debug(f"Broadcasting {message.get('type')} to chat {chat_id}, clients: {len(self.active_chats[chat_id])}")
+            start = time.perf_counter()
+            recipients = [websocket for websocket in self.active_chats.get(chat_id, [])
+                          if user_ids is None or self.socket_users.get(websocket) in user_ids]
+            # Serialize once per encoding instead of once per recipient
+            frames = {}
+            for websocket in recipients:
+                encoding = self.encodings.get(websocket, JSON)
+                if encoding not in frames:
+                    frames[encoding] = encode(message, encoding)
                 try:
-                    await websocket.send_text(json.dumps(message))
+                    await send_frame(websocket, frames[encoding])
                 except Exception as e:
                     logger.error(f"Error broadcasting to chat {chat_id}: {e}")
+            metrics.WS_BROADCAST_RECIPIENTS.observe(len(recipients))
+            metrics.WS_BROADCAST_DURATION.observe(time.perf_counter() - start)
+
+    def reconnect_frame(self) -> dict:
+        return {"type": "reconnect", "reason": "restart",
+                "delay_ms": int(random.uniform(0, DRAIN_RECONNECT_SECONDS) * 1000)}
+
+    async def drain(self):
+        """Move every client off this process before it exits.
+
+        New sockets are turned away, open ones get a reconnect frame with a
+        jittered delay, frames already received are handled (so their writes
+        and broadcasts go out) and then the sockets are closed with 1012.
+        """
+        self.draining = True
+        sockets = sum(len(chat_sockets) for chat_sockets in self.active_chats.values())
+        logger.info(f"Draining {sockets} sockets in {len(self.active_chats)} chats")
+        for chat_id, chat_sockets in list(self.active_chats.items()):
+            for websocket in list(chat_sockets):
+                try:
+                    await self.send(websocket, self.reconnect_frame())
+                except Exception as e:
+                    logger.error(f"Error sending reconnect frame in chat {chat_id}: {e}")
+        deadline = time.monotonic() + DRAIN_TIMEOUT_SECONDS
+        while self.busy and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.busy:
+            logger.warning(f"Closing {len(self.busy)} sockets with frames still being handled")
+        for chat_id in list(self.active_chats):
+            await self.close_chat(chat_id, SERVICE_RESTART)
+        logger.info("Drained all sockets")
+
+    def socket_gauges(self) -> list:
+        """Scrape-time gauges over active_chats: totals plus the largest chats."""
+        sizes = {chat_id: len(sockets) for chat_id, sockets in self.active_chats.items()}
+        largest = sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:LARGEST_CHATS_REPORTED]
+        return [
+            ("ws_active_chats", "Chats with at least one open socket.", [({}, len(sizes))]),
+            ("ws_active_sockets", "Open chat sockets.", [({}, sum(sizes.values()))]),
+            ("ws_chat_sockets", f"Open sockets of the {LARGEST_CHATS_REPORTED} busiest chats.",
+             [({"chat_id": chat_id}, size) for chat_id, size in largest]),
+        ]
+
+    async def broadcast_to_chat(self, chat_id: int, message: dict):
+        await self.broadcast(chat_id, message)
 
 manager = ConnectionManager()
 
+async def ack_duplicate(websocket: WebSocket, client_msg_id: str, message_id: int):
+    """Answer a resent message frame with the id of the message already stored."""
+    await manager.send(websocket, {"type": "ack", "client_msg_id": client_msg_id, "message_id": message_id,
+                                   "duplicate": True})
+
 @router.websocket("/ws/chat/{chat_id}")
 async def websocket_endpoint(websocket: WebSocket, chat_id: int, token: str = Query(...)):
+    encoding, subprotocol = negotiate_encoding(websocket)
+
+    if manager.draining:
+        await manager.accept(websocket, encoding, subprotocol)
+        await manager.send(websocket, manager.reconnect_frame())
+        await websocket.close(code=SERVICE_RESTART)
+        return
+
     # Проверка токена
-    user = verify_token(token)
+    user = await verify_token(token)
     if not user:
-        await websocket.accept()
-        await websocket.send_text(json.dumps({"type": "error", "message": "Invalid token"}))
+        await manager.accept(websocket, encoding, subprotocol)
+        metrics.AUTH_FAILURES.inc("websocket_token")
+        await manager.send(websocket, {"type": "error", "message": "Invalid token"})
         await websocket.close(code=1008)
         return
 
     username = user["username"]
     user_id = user["id"]
 
-    # Подключение к базе данных
-    conn = get_connection()
-    cursor = conn.cursor()
+    # verify_token already loaded the account, so a deleted user never gets here
+    # Принимаем соединение WebSocket после проверки токена и пользователя
+    await manager.accept(websocket, encoding, subprotocol)
 
-    try:
-        # Проверка существования пользователя
-        cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-        if not cursor.fetchone():
-            await websocket.accept()
-            await websocket.send_text(json.dumps({"type": "error", "message": "Account does not exist"}))
+    # Пропускаем проверку для chat_id=0 (глобальные уведомления)
+    if chat_id != 0:
+        # Проверка существования чата
+        if not await storage.repos.chats.get_chat(chat_id):
+            await manager.send(websocket, {"type": "error", "message": "Chat does not exist"})
             await websocket.close(code=1008)
+            logger.error(f"Chat {chat_id} does not exist")
             return
 
-        # Принимаем соединение WebSocket после проверки токена и пользователя
-        await websocket.accept()
-
-        # Пропускаем проверку для chat_id=0 (глобальные уведомления)
-        if chat_id != 0:
-            # Проверка существования чата
-            cursor.execute("SELECT id FROM chats WHERE id = ?", (chat_id,))
-            if not cursor.fetchone():
-                await websocket.send_text(json.dumps({"type": "error", "message": "Chat does not exist"}))
-                await websocket.close(code=1008)
-                logger.error(f"Chat {chat_id} does not exist")
-                return
-
-            # Проверка участия пользователя
-            cursor.execute("SELECT * FROM participants WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
-            participant = cursor.fetchone()
-            if not participant:
-                await websocket.send_text(json.dumps({"type": "error", "message": "You are not a member of this chat"}))
-                await websocket.close(code=1008)
-                logger.error(f"User {user_id} not found in participants for chat {chat_id}")
-                return
-            logger.info(f"User {user_id} verified as participant in chat {chat_id}")
-
-        # Получаем avatar_url пользователя
-        cursor.execute("SELECT avatar_url FROM users WHERE id = ?", (user_id,))
-        user_data = cursor.fetchone()
-        avatar_url = user_data["avatar_url"] if user_data and user_data["avatar_url"] else "/static/avatars/default.jpg"
-
-        # Подключение клиента к WebSocket
-        await manager.connect(chat_id, websocket)
-        logger.info(f"WebSocket CONNECTED for {username} in chat {chat_id}")
-
-        try:
-            while True:
-                data = await websocket.receive_text()
-                logger.info(f"Received message in chat {chat_id} from {username}: {data}")
+        # Проверка участия пользователя
+        if not await storage.repos.chats.is_member(chat_id, user_id):
+            await manager.send(websocket, {"type": "error", "message": "You are not a member of this chat"})
+            await websocket.close(code=1008)
+            logger.error(f"User {user_id} not found in participants for chat {chat_id}")
+            return
+        if logs.enabled(logger, "ws.connect"):
+            logger.debug(f"User {user_id} verified as participant in chat {chat_id}")
 
-                try:
-                    parsed_data = json.loads(data)
-                    message_type = parsed_data.get("type", "message")
-                    content = parsed_data.get("content")
-                    message_id = parsed_data.get("message_id")
-                    reply_to = parsed_data.get("reply_to")
-                    file_url = parsed_data.get("file_url")
-                    file_name = parsed_data.get("file_name")
-                    file_type = parsed_data.get("file_type")
-                    file_size = parsed_data.get("file_size")
-                    reaction = parsed_data.get("reaction")
-                except (json.JSONDecodeError, KeyError) as e:
-                    await websocket.send_text(json.dumps({"type": "error", "message": "Invalid message format"}))
-                    logger.error(f"JSON parsing error: {e}")
+    avatar_url = user["avatar_url"] or "/static/avatars/default.jpg"
+
+    # Подключение клиента к WebSocket
+    missed = await manager.connect(chat_id, websocket, user_id)
+    logger.info(f"WebSocket CONNECTED for {username} in chat {chat_id}")
+    for missed_chat_id, events in missed.items():
+        await manager.send(websocket, {"type": "outbox", "chat_id": missed_chat_id, "events": events})
+
+    try:
+        while True:
+            manager.busy.discard(websocket)
+            try:
+                parsed_data = await receive_frame(websocket)
+                manager.busy.add(websocket)
+                message_type = parsed_data.get("type", "message")
+                if logs.enabled(logger, "ws.frame"):
+                    logger.debug(f"Received {message_type} frame in chat {chat_id} from {username}")
+                content = parsed_data.get("content")
+                message_id = parsed_data.get("message_id")
+                reply_to = parsed_data.get("reply_to")
+                file_url = parsed_data.get("file_url")
+                file_name = parsed_data.get("file_name")
+                file_type = parsed_data.get("file_type")
+                file_size = parsed_data.get("file_size")
+                reaction = parsed_data.get("reaction")
+                client_msg_id = parsed_data.get("client_msg_id")
+            except (ValueError, KeyError) as e:
+                await manager.send(websocket, {"type": "error", "message": "Invalid message format"})
+                logger.error(f"JSON parsing error: {e}")
+                continue
+
+            if message_type in ("message", "file") and client_msg_id is not None:
+                if not client_ids.valid(client_msg_id):
+                    await manager.send(websocket, {"type": "error", "message": "Invalid client_msg_id"})
+                    continue
+                original_id = client_ids.recent.get(user_id, chat_id, client_msg_id)
+                if original_id is not None:
+                    client_ids.DUPLICATES.inc("window")
+                    await ack_duplicate(websocket, client_msg_id, original_id)
                     continue
 
-                if message_type == "message":
-                    if not content or not content.strip():
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Empty message"}))
-                        continue
-
-                    try:
-                        cursor.execute("""
-                            INSERT INTO messages (chat_id, sender_id, sender_name, content, timestamp, reply_to)
-                            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?)
-                        """, (chat_id, user_id, username, content, reply_to))
-                        conn.commit()
-                        message_id = cursor.lastrowid
-                        logger.info(f"Message saved in db: {{'chat_id': {chat_id}, 'sender_name': '{username}', 'content': '{content}', 'reply_to': {reply_to}}}, ID: {message_id}")
-                    except sqlite3.Error as e:
-                        logger.error(f"Error while saving message to db: {e}")
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Failed to save message"}))
-                        continue
-
-                    message = {
-                        "type": "message",
-                        "username": username,
-                        "avatar_url": avatar_url,
-                        "is_deleted": False,
-                        "data": {
-                            "chat_id": chat_id,
-                            "content": content,
-                            "message_id": message_id,
-                            "reply_to": reply_to
-                        },
-                        "timestamp": datetime.utcnow().isoformat()
-                    }
-                    await manager.broadcast(chat_id, message)
-
-                elif message_type == "file":
-                    if not file_url or not file_name or not file_type or not file_size:
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Missing file metadata"}))
-                        continue
-
-                    try:
-                        cursor.execute("""
-                            INSERT INTO messages (chat_id, sender_id, sender_name, content, timestamp, reply_to)
-                            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?)
-                        """, (chat_id, user_id, username, json.dumps({
-                            "file_url": file_url,
-                            "file_name": file_name,
-                            "file_type": file_type,
-                            "file_size": file_size
-                        }), reply_to))
-                        conn.commit()
-                        message_id = cursor.lastrowid
-                        logger.info(f"File message saved in db: {{'chat_id': {chat_id}, 'sender_name': '{username}', 'file_url': '{file_url}'}}, ID: {message_id}")
-                    except sqlite3.Error as e:
-                        logger.error(f"Error while saving file message to db: {e}")
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Failed to save file message"}))
-                        continue
-
-                    file_message = {
-                        "type": "file",
-                        "username": username,
-                        "avatar_url": avatar_url,
-                        "is_deleted": False,
-                        "data": {
-                            "chat_id": chat_id,
-                            "file_url": file_url,
-                            "file_name": file_name,
-                            "file_type": file_type,
-                            "file_size": file_size,
-                            "message_id": message_id,
-                            "reply_to": reply_to
-                        },
-                        "timestamp": datetime.utcnow().isoformat()
-                    }
-                    await manager.broadcast(chat_id, file_message)
-
-                elif message_type == "edit":
-                    if not message_id or not content:
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Missing message_id or content"}))
-                        continue
-
-                    try:
-                        cursor.execute("SELECT sender_id FROM messages WHERE id = ?", (message_id,))
-                        sender_id = cursor.fetchone()
-                        if not sender_id or sender_id["sender_id"] != user_id:
-                            await websocket.send_text(json.dumps({"type": "error", "message": "You are not the author of this message"}))
-                            continue
-
-                        cursor.execute("UPDATE messages SET content = ?, edited_at = CURRENT_TIMESTAMP WHERE id = ?", (content, message_id))
-                        conn.commit()
-                        logger.info(f"Message edited: {{'message_id': {message_id}, 'new_content': '{content}'}}")
-                    except sqlite3.Error as e:
-                        logger.error(f"Error while editing message: {e}")
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Failed to edit message"}))
-                        continue
-
-                    edit_message = {
-                        "type": "edit",
-                        "message_id": message_id,
-                        "new_content": content,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }
-                    await manager.broadcast(chat_id, edit_message)
-
-                elif message_type == "delete":
-                    if not message_id:
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Missing message_id"}))
-                        continue
-
-                    try:
-                        cursor.execute("SELECT sender_id FROM messages WHERE id = ?", (message_id,))
-                        sender_id = cursor.fetchone()
-                        if not sender_id or sender_id["sender_id"] != user_id:
-                            await websocket.send_text(json.dumps({"type": "error", "message": "You are not the author of this message"}))
-                            continue
-
-                        cursor.execute("DELETE FROM messages WHERE id = ?", (message_id,))
-                        conn.commit()
-                        logger.info(f"Message deleted: {{'message_id': {message_id}}}")
-                    except sqlite3.Error as e:
-                        logger.error(f"Error while deleting message: {e}")
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Failed to delete message"}))
-                        continue
-
-                    delete_message = {
-                        "type": "delete",
-                        "message_id": message_id,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }
-                    await manager.broadcast(chat_id, delete_message)
-
-                elif message_type == "reaction_add":
-                    if not message_id or not reaction:
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Missing message_id or reaction"}))
-                        continue
-
-                    try:
-                        cursor.execute("SELECT reactions FROM messages WHERE id = ?", (message_id,))
-                        result = cursor.fetchone()
-                        if not result:
-                            await websocket.send_text(json.dumps({"type": "error", "message": "Message not found"}))
-                            continue
-
-                        reactions = json.loads(result["reactions"]) if result["reactions"] else []
-                        if any(r["user_id"] == user_id and r["reaction"] == reaction for r in reactions):
-                            await websocket.send_text(json.dumps({"type": "error", "message": "You already reacted with this reaction"}))
-                            continue
-
-                        reactions.append({"user_id": user_id, "reaction": reaction})
-                        cursor.execute("UPDATE messages SET reactions = ? WHERE id = ?", (json.dumps(reactions), message_id))
-                        conn.commit()
-                        logger.info(f"Reaction added: {{'message_id': {message_id}, 'user_id': {user_id}, 'reaction': '{reaction}'}}")
-                    except sqlite3.Error as e:
-                        logger.error(f"Error while adding reaction: {e}")
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Failed to add reaction"}))
-                        continue
-
-                    reaction_message = {
-                        "type": "reaction_add",
-                        "message_id": message_id,
-                        "user_id": user_id,
-                        "reaction": reaction,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }
-                    await manager.broadcast(chat_id, reaction_message)
-
-                elif message_type == "reaction_remove":
-                    if not message_id or not reaction:
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Missing message_id or reaction"}))
-                        continue
-
-                    try:
-                        cursor.execute("SELECT reactions FROM messages WHERE id = ?", (message_id,))
-                        result = cursor.fetchone()
-                        if not result:
-                            await websocket.send_text(json.dumps({"type": "error", "message": "Message not found"}))
-                            continue
-
-                        reactions = json.loads(result["reactions"]) if result["reactions"] else []
-                        if not any(r["user_id"] == user_id and r["reaction"] == reaction for r in reactions):
-                            await websocket.send_text(json.dumps({"type": "error", "message": "You cannot remove this reaction"}))
-                            continue
-
-                        new_reactions = [r for r in reactions if not (r["user_id"] == user_id and r["reaction"] == reaction)]
-                        cursor.execute("UPDATE messages SET reactions = ? WHERE id = ?", (json.dumps(new_reactions), message_id))
-                        conn.commit()
-                        logger.info(f"Reaction removed: {{'message_id': {message_id}, 'user_id': {user_id}, 'reaction': '{reaction}'}}")
-                    except sqlite3.Error as e:
-                        logger.error(f"Error while removing reaction: {e}")
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Failed to remove reaction"}))
-                        continue
-
-                    reaction_message = {
-                        "type": "reaction_remove",
+            if message_type == "message":
+                if not content or not content.strip():
+                    await manager.send(websocket, {"type": "error", "message": "Empty message"})
+                    continue
+
+                created_at = history_cache.timestamp()
+                try:
+                    message_id = await storage.repos.messages.insert(
+                        chat_id, user_id, username, content, reply_to, timestamp=created_at, client_msg_id=client_msg_id
+                    )
+                    if logs.enabled(logger, "ws.message"):
+                        logger.debug(f"Message saved in db: {{'chat_id': {chat_id}, 'sender_name': '{username}', 'content': '{logs.redact(content)}', 'reply_to': {reply_to}}}, ID: {message_id}")
+                except DuplicateMessageError as e:
+                    # Stored by an earlier copy of this frame that the window no longer remembers
+                    client_ids.recent.add(user_id, chat_id, client_msg_id, e.message_id)
+                    client_ids.DUPLICATES.inc("database")
+                    await ack_duplicate(websocket, client_msg_id, e.message_id)
+                    continue
+                except Exception as e:
+                    logger.error(f"Error while saving message to db: {e}")
+                    await manager.send(websocket, {"type": "error", "message": "Failed to save message"})
+                    continue
+                if client_msg_id is not None:
+                    client_ids.recent.add(user_id, chat_id, client_msg_id, message_id)
+                history_cache.cache.add_message(chat_id, message_id, user_id, username, user["avatar_url"],
+                                                content, created_at, reply_to)
+
+                message = {
+                    "type": "message",
+                    "username": username,
+                    "avatar_url": avatar_url,
+                    "is_deleted": False,
+                    "data": {
+                        "chat_id": chat_id,
+                        "content": content,
                         "message_id": message_id,
-                        "user_id": user_id,
-                        "reaction": reaction,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }
-                    await manager.broadcast(chat_id, reaction_message)
-
-                elif message_type == "is_read":
-                    if not message_id:
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Missing message_id"}))
-                        continue
-
-                    try:
-                        cursor.execute("SELECT id, sender_id, read_by FROM messages WHERE id = ?", (message_id,))
-                        message = cursor.fetchone()
-                        if not message:
-                            await websocket.send_text(json.dumps({"type": "error", "message": "Message not found"}))
-                            continue
-                        
-                        if message["sender_id"] == user_id:
-                            await websocket.send_text(json.dumps({"type": "error", "message": "Cannot mark own message as read"}))
-                            continue
-
-                        read_by = json.loads(message["read_by"]) if message["read_by"] else []
-                        if any(r["user_id"] == user_id for r in read_by):
-                            # await websocket.send_text(json.dumps({"type": "error", "message": "Message already marked as read"}))
-                            continue
-
-                        read_by.append({"user_id": user_id, "read_at": datetime.utcnow().isoformat()})
-                        cursor.execute("UPDATE messages SET read_by = ? WHERE id = ?", (json.dumps(read_by), message_id))
-                        conn.commit()
-                        logger.info(f"Message marked as read: {{'message_id': {message_id}, 'user_id': {user_id}}}")
-
-                    except sqlite3.Error as e:
-                        logger.error(f"Error while marking message as read: {e}")
-                        await websocket.send_text(json.dumps({"type": "error", "message": "Failed to mark message as read"}))
-                        continue
-
-                    read_message = {
-                        "type": "is_read",
+                        "reply_to": reply_to,
+                        "client_msg_id": client_msg_id
+                    },
+                    "timestamp": datetime.utcnow().isoformat()
+                }
+                await manager.broadcast(chat_id, message)
+
+            elif message_type == "file":
+                if not file_url or not file_name or not file_type or not file_size:
+                    await manager.send(websocket, {"type": "error", "message": "Missing file metadata"})
+                    continue
+
+                attachment = {
+                    "file_url": file_url,
+                    "file_name": file_name,
+                    "file_type": file_type,
+                    "file_size": file_size
+                }
+                created_at = history_cache.timestamp()
+                try:
+                    message_id = await storage.repos.messages.insert(
+                        chat_id, user_id, username, file_name, reply_to, attachment, created_at, client_msg_id
+                    )
+                    if logs.enabled(logger, "ws.file"):
+                        logger.debug(f"File message saved in db: {{'chat_id': {chat_id}, 'sender_name': '{username}', 'file_url': '{file_url}'}}, ID: {message_id}")
+                except DuplicateMessageError as e:
+                    # Stored by an earlier copy of this frame that the window no longer remembers
+                    client_ids.recent.add(user_id, chat_id, client_msg_id, e.message_id)
+                    client_ids.DUPLICATES.inc("database")
+                    await ack_duplicate(websocket, client_msg_id, e.message_id)
+                    continue
+                except Exception as e:
+                    logger.error(f"Error while saving file message to db: {e}")
+                    await manager.send(websocket, {"type": "error", "message": "Failed to save file message"})
+                    continue
+                if client_msg_id is not None:
+                    client_ids.recent.add(user_id, chat_id, client_msg_id, message_id)
+                history_cache.cache.add_message(chat_id, message_id, user_id, username, user["avatar_url"],
+                                                file_name, created_at, reply_to, attachment)
+
+                file_message = {
+                    "type": "file",
+                    "username": username,
+                    "avatar_url": avatar_url,
+                    "is_deleted": False,
+                    "data": {
+                        "chat_id": chat_id,
+                        "file_url": file_url,
+                        "file_name": file_name,
+                        "file_type": file_type,
+                        "file_size": file_size,
                         "message_id": message_id,
-                        "user_id": user_id,
-                        "username": username,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }
-                    await manager.broadcast(chat_id, read_message)
-
-                elif message_type == "group_created":
-                    if chat_id == 0:
-                        logger.info(f"Received group_created for chat {parsed_data.get('chat_id')}")
-                        await manager.broadcast(chat_id, parsed_data)
-
-        except WebSocketDisconnect:
-            logger.info(f"{username} DISCONNECTED from {chat_id}")
-            manager.disconnect(chat_id, websocket)
-        except Exception as e:
-            logger.error(f"Unexpected error in WebSocket for {username} in chat {chat_id}: {e}")
-            manager.disconnect(chat_id, websocket)
-            await websocket.close(code=1000)
-    finally:
-        conn.close()
\ No newline at end of file
+                        "reply_to": reply_to,
+                        "client_msg_id": client_msg_id
+                    },
+                    "timestamp": datetime.utcnow().isoformat()
+                }
+                await manager.broadcast(chat_id, file_message)
+
+            elif message_type == "edit":
+                if not message_id or not content:
+                    await manager.send(websocket, {"type": "error", "message": "Missing message_id or content"})
+                    continue
+
+                try:
+                    await storage.repos.messages.edit(chat_id, message_id, user_id, content)
+                    if logs.enabled(logger, "ws.edit"):
+                        logger.debug(f"Message edited: {{'message_id': {message_id}, 'new_content': '{logs.redact(content)}'}}")
+                except MessageStoreError as e:
+                    await manager.send(websocket, {"type": "error", "message": str(e)})
+                    continue
+                except Exception as e:
+                    logger.error(f"Error while editing message: {e}")
+                    await manager.send(websocket, {"type": "error", "message": "Failed to edit message"})
+                    continue
+                history_cache.cache.edit_message(chat_id, message_id, content)
+
+                edit_message = {
+                    "type": "edit",
+                    "message_id": message_id,
+                    "new_content": content,
+                    "timestamp": datetime.utcnow().isoformat()
+                }
+                await manager.broadcast(chat_id, edit_message)
+
+            elif message_type == "delete":
+                if not message_id:
+                    await manager.send(websocket, {"type": "error", "message": "Missing message_id"})
+                    continue
+
+                try:
+                    await storage.repos.messages.delete(chat_id, message_id, user_id)
+                    if logs.enabled(logger, "ws.delete"):
+                        logger.debug(f"Message deleted: {{'message_id': {message_id}}}")
+                except MessageStoreError as e:
+                    await manager.send(websocket, {"type": "error", "message": str(e)})
+                    continue
+                except Exception as e:
+                    logger.error(f"Error while deleting message: {e}")
+                    await manager.send(websocket, {"type": "error", "message": "Failed to delete message"})
+                    continue
+                history_cache.cache.delete_message(chat_id, message_id)
+
+                delete_message = {
+                    "type": "delete",
+                    "message_id": message_id,
+                    "timestamp": datetime.utcnow().isoformat()
+                }
+                await manager.broadcast(chat_id, delete_message)
+
+            elif message_type == "reaction_add":
+                if not message_id or not reaction:
+                    await manager.send(websocket, {"type": "error", "message": "Missing message_id or reaction"})
+                    continue
+
+                try:
+                    await storage.repos.messages.add_reaction(chat_id, message_id, user_id, reaction)
+                    if logs.enabled(logger, "ws.reaction"):
+                        logger.debug(f"Reaction added: {{'message_id': {message_id}, 'user_id': {user_id}, 'reaction': '{reaction}'}}")
+                except MessageStoreError as e:
+                    await manager.send(websocket, {"type": "error", "message": str(e)})
+                    continue
+                except Exception as e:
+                    logger.error(f"Error while adding reaction: {e}")
+                    await manager.send(websocket, {"type": "error", "message": "Failed to add reaction"})
+                    continue
+                history_cache.cache.add_reaction(chat_id, message_id, user_id, reaction)
+
+                reaction_message = {
+                    "type": "reaction_add",
+                    "message_id": message_id,
+                    "user_id": user_id,
+                    "reaction": reaction,
+                    "timestamp": datetime.utcnow().isoformat()
+                }
+                await manager.broadcast(chat_id, reaction_message)
+
+            elif message_type == "reaction_remove":
+                if not message_id or not reaction:
+                    await manager.send(websocket, {"type": "error", "message": "Missing message_id or reaction"})
+                    continue
+
+                try:
+                    await storage.repos.messages.remove_reaction(chat_id, message_id, user_id, reaction)
+                    if logs.enabled(logger, "ws.reaction"):
+                        logger.debug(f"Reaction removed: {{'message_id': {message_id}, 'user_id': {user_id}, 'reaction': '{reaction}'}}")
+                except MessageStoreError as e:
+                    await manager.send(websocket, {"type": "error", "message": str(e)})
+                    continue
+                except Exception as e:
+                    logger.error(f"Error while removing reaction: {e}")
+                    await manager.send(websocket, {"type": "error", "message": "Failed to remove reaction"})
+                    continue
+                history_cache.cache.remove_reaction(chat_id, message_id, user_id, reaction)
+
+                reaction_message = {
+                    "type": "reaction_remove",
+                    "message_id": message_id,
+                    "user_id": user_id,
+                    "reaction": reaction,
+                    "timestamp": datetime.utcnow().isoformat()
+                }
+                await manager.broadcast(chat_id, reaction_message)
+
+            elif message_type == "is_read":
+                if not message_id:
+                    await manager.send(websocket, {"type": "error", "message": "Missing message_id"})
+                    continue
+
+                try:
+                    read_at = await storage.repos.messages.mark_read(chat_id, message_id, user_id)
+                    if not read_at:
+                        continue  # Already marked as read
+                    if logs.enabled(logger, "ws.read"):
+                        logger.debug(f"Message marked as read: {{'message_id': {message_id}, 'user_id': {user_id}}}")
+                except MessageStoreError as e:
+                    await manager.send(websocket, {"type": "error", "message": str(e)})
+                    continue
+                except Exception as e:
+                    logger.error(f"Error while marking message as read: {e}")
+                    await manager.send(websocket, {"type": "error", "message": "Failed to mark message as read"})
+                    continue
+                history_cache.cache.mark_read(chat_id, message_id, user_id, read_at)
+
+                read_message = {
+                    "type": "is_read",
+                    "message_id": message_id,
+                    "user_id": user_id,
+                    "username": username,
+                    "timestamp": datetime.utcnow().isoformat()
+                }
+                await manager.broadcast(chat_id, read_message)
+
+            elif message_type == "group_created":
+                if chat_id == 0:
+                    logger.info(f"Received group_created for chat {parsed_data.get('chat_id')}")
+                    await manager.broadcast(chat_id, parsed_data)
+
+    except WebSocketDisconnect:
+        logger.info(f"{username} DISCONNECTED from {chat_id}")
+        manager.disconnect(chat_id, websocket)
+    except Exception as e:
+        logger.error(f"Unexpected error in WebSocket for {username} in chat {chat_id}: {e}")
+        manager.disconnect(chat_id, websocket)
+        await websocket.close(code=1000)
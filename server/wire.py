@@ -0,0 +1,60 @@
+import json
+from fastapi import WebSocket, WebSocketDisconnect
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, JSON keeps working without it
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+def supported_encodings() -> list[str]:
+    return [MSGPACK, JSON] if msgpack is not None else [JSON]
+
+def negotiate_encoding(websocket: WebSocket) -> tuple[str, str | None]:
+    """Pick the wire encoding for a socket during the handshake.
+
+    Clients ask for MessagePack either through the `Sec-WebSocket-Protocol`
+    header (`msgpack`) or the `encoding` query parameter. Returns the encoding
+    and the subprotocol to echo back in `accept()` (None if none was offered).
+    """
+    offered = websocket.scope.get("subprotocols") or []
+    for encoding in supported_encodings():
+        if encoding in offered:
+            return encoding, encoding
+    requested = websocket.query_params.get("encoding", JSON).lower()
+    if requested in supported_encodings():
+        return requested, None
+    return JSON, None
+
+def encode(message: dict, encoding: str = JSON) -> str | bytes:
+    if encoding == MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message, separators=(",", ":"))
+
+def decode(frame: str | bytes) -> dict:
+    if isinstance(frame, bytes):
+        if msgpack is None:
+            raise ValueError("Binary frames are not supported")
+        data = msgpack.unpackb(frame, raw=False)
+    else:
+        data = json.loads(frame)
+    if not isinstance(data, dict):
+        raise ValueError("Frame must be an object")
+    return data
+
+async def send_frame(websocket: WebSocket, frame: str | bytes):
+    if isinstance(frame, bytes):
+        await websocket.send_bytes(frame)
+    else:
+        await websocket.send_text(frame)
+
+async def receive_frame(websocket: WebSocket) -> dict:
+    """Receive one text (JSON) or binary (MessagePack) frame and decode it."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        return decode(message["bytes"])
+    return decode(message.get("text") or "")
@@ -4,4 +4,4 @@ python -m venv .
 
 source bin/activate
 
-uvicorn server.main:app --host 0.0.0.0 --port 8000
+python -m server.launcher --host 0.0.0.0 --port 8000